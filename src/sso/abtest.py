@@ -0,0 +1,244 @@
+import csv
+import glob
+import os
+
+from sso import scylla, stats
+from sso.common import Iteration
+from sso.util import log_important
+from sso import hdrhistogram
+
+# (metric, higher is better); the latencies are in milliseconds.
+METRICS = [("throughput", True), ("p50", False), ("p99", False), ("p99.9", False)]
+
+
+class Variant:
+    """
+    One side of an A/B test: a cluster configuration.
+    """
+
+    def __init__(self, name, cluster_public_ips, cluster_private_ips, setup=None, clear=None):
+        """
+        Parameters
+        ----------
+        name: str
+            The name of the variant, e.g. the version; used as directory name.
+        setup: callable
+            Called without arguments to put the cluster in this configuration (e.g. install a
+            Scylla version or start Cassandra(cassandra_version=...)); called before a run when
+            the previous run on the same cluster was of another variant.
+        clear: callable
+            Called without arguments before every run to remove all data and restart the cluster.
+            Defaults to scylla.clear_cluster.
+        """
+        self.name = name
+        self.cluster_public_ips = cluster_public_ips
+        self.cluster_private_ips = cluster_private_ips
+        self.setup = setup
+        self.clear = clear
+
+    def nodes(self):
+        return ",".join(self.cluster_private_ips)
+
+
+def _run_metrics(run_dir, trimmed):
+    """
+    Returns {(file, tag): {metric: value}} for the merged hdr files of a run.
+    """
+    result = {}
+    for file in sorted(glob.glob(os.path.join(run_dir, "*.hdr"))):
+        filename = os.path.basename(file)
+        if filename.startswith("trimmed_") != trimmed:
+            continue
+        log = hdrhistogram.read_log(file)
+        by_tag = log.split_by_tag()
+        for tag in hdrhistogram.response_time_tags(by_tag.keys()):
+            tag_log = by_tag[tag]
+            histogram = tag_log.total()
+            begin, end = tag_log.time_range()
+            if histogram is None or end <= begin:
+                continue
+            ratio = hdrhistogram.DEFAULT_VALUE_UNIT_RATIO
+            result[(filename, tag if tag is not None else "")] = {
+                "throughput": histogram.total_count() / (end - begin),
+                "p50": histogram.value_at_percentile(50) / ratio,
+                "p99": histogram.value_at_percentile(99) / ratio,
+                "p99.9": histogram.value_at_percentile(99.9) / ratio,
+                "histogram": histogram,
+            }
+    return result
+
+
+class ABTest:
+    """
+    Compares two cluster configurations with the same cassandra-stress workload. The trials of
+    both variants are interleaved (ABBA order), so drift of the environment (noisy neighbours,
+    time of day) hits both variants equally, and the cluster is cleared before every run. The
+    per-run throughput and latency percentiles from the merged hdr files are compared using the
+    confidence interval of the difference of the means; a significant change for the worse is a
+    regression.
+
+    The runs are stored in <iteration dir>/<variant>/trial-NN and the report in report.txt and
+    report.csv of the iteration dir.
+    """
+
+    def __init__(self, name, cs, properties, baseline, candidate, stress_command, trials=5, populate=None,
+                 warmup_seconds=None, cooldown_seconds=None, confidence=0.95, threshold_percent=0.0,
+                 description=None, stress_kwargs=None, steady_state=False):
+        """
+        Parameters
+        ----------
+        cs: CassandraStress
+            The load generators.
+        baseline: Variant
+        candidate: Variant
+        stress_command: str
+            The cassandra-stress command; '{nodes}' is replaced by the nodes of the variant. It
+            needs '-log hdrfile=<file>'.
+        trials: int
+            The number of runs per variant; at least 2 are needed for a confidence interval.
+        populate: callable
+            Called with (variant, nodes) after clearing the cluster, e.g. to cs.insert the data.
+        threshold_percent: float
+            Only significant changes for the worse bigger than this percentage are regressions.
+        stress_kwargs: dict
+            Additional arguments for CassandraStress.stress.
+        steady_state: bool
+            If True, every run is trimmed to its detected steady state instead of using
+            warmup_seconds and cooldown_seconds (see CassandraStress.collect_results).
+        """
+        if not hdrhistogram.has_numpy():
+            raise Exception("ABTest requires numpy")
+        if "hdrfile=" not in stress_command:
+            raise Exception("ABTest requires '-log hdrfile=<file>' in the stress command")
+        if trials < 2:
+            raise Exception("ABTest requires at least 2 trials")
+        self.name = name
+        self.cs = cs
+        self.properties = properties
+        self.baseline = baseline
+        self.candidate = candidate
+        self.stress_command = stress_command
+        self.trials = trials
+        self.populate = populate
+        self.warmup_seconds = warmup_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self.confidence = confidence
+        self.threshold_percent = threshold_percent
+        self.description = description
+        self.stress_kwargs = stress_kwargs if stress_kwargs is not None else {}
+        self.steady_state = steady_state
+        # the variant that is currently set up per cluster.
+        self.__current = {}
+
+    def run(self):
+        """
+        Runs all trials and analyzes the results.
+
+        Returns
+        -------
+        The number of regressions; use it as exit code to gate on the result.
+        """
+        iteration = Iteration(self.name, description=self.description)
+        for trial in range(self.trials):
+            order = [self.baseline, self.candidate] if trial % 2 == 0 else [self.candidate, self.baseline]
+            for variant in order:
+                self.__run(variant, trial, iteration.dir)
+        return self.analyze(iteration.dir)
+
+    def __run(self, variant, trial, dir):
+        log_important(f"ABTest {self.name}: {variant.name} trial {trial + 1}/{self.trials} started")
+        cluster = tuple(variant.cluster_public_ips)
+        if self.__current.get(cluster) is not variant:
+            if variant.setup is not None:
+                variant.setup()
+            self.__current[cluster] = variant
+
+        if variant.clear is not None:
+            variant.clear()
+        else:
+            scylla.clear_cluster(variant.cluster_public_ips, self.properties['cluster_user'],
+                                 self.properties['ssh_options'])
+        if self.populate is not None:
+            self.populate(variant, variant.nodes())
+
+        self.cs.stress(self.stress_command.replace("{nodes}", variant.nodes()), **self.stress_kwargs)
+        run_dir = os.path.join(dir, variant.name, f"trial-{trial:02d}")
+        os.makedirs(run_dir, exist_ok=True)
+        self.cs.collect_results(run_dir, warmup_seconds=self.warmup_seconds, cooldown_seconds=self.cooldown_seconds,
+                                steady_state=self.steady_state)
+        log_important(f"ABTest {self.name}: {variant.name} trial {trial + 1}/{self.trials} done")
+
+    def __load(self, dir, variant):
+        trimmed = self.steady_state or self.warmup_seconds is not None or self.cooldown_seconds is not None
+        runs = []
+        for run_dir in sorted(glob.glob(os.path.join(dir, variant.name, "trial-*"))):
+            runs.append(_run_metrics(run_dir, trimmed))
+        return runs
+
+    def analyze(self, dir):
+        """
+        Compares the runs of both variants in dir and writes report.txt and report.csv. Can be
+        called again on the dir of an earlier run.
+
+        Returns
+        -------
+        The number of regressions.
+        """
+        baseline_runs = self.__load(dir, self.baseline)
+        candidate_runs = self.__load(dir, self.candidate)
+        keys = set()
+        for run in baseline_runs + candidate_runs:
+            keys.update(run.keys())
+
+        ratio = hdrhistogram.DEFAULT_VALUE_UNIT_RATIO
+        lines = [f"A/B test {self.name}: {self.baseline.name} (A) vs {self.candidate.name} (B), "
+                 f"{len(baseline_runs)}/{len(candidate_runs)} runs, {self.confidence * 100:.0f}% confidence", ""]
+        rows = []
+        regressions = 0
+        for key in sorted(keys):
+            a_runs = [run[key] for run in baseline_runs if key in run]
+            b_runs = [run[key] for run in candidate_runs if key in run]
+            if len(a_runs) < 2 or len(b_runs) < 2:
+                lines.append(f"{key[0]} {key[1]}: not enough runs")
+                continue
+            lines.append(f"{key[0]} {key[1]}")
+            lines.append(f"    {'metric':<12}{'A':>12}{'B':>12}{'delta':>12}{'CI':>22}{'p-value':>10}")
+            for metric, higher_is_better in METRICS:
+                a = [run[metric] for run in a_runs]
+                b = [run[metric] for run in b_runs]
+                difference, half_width = stats.difference_confidence_interval(a, b, self.confidence)
+                _, _, p_value = stats.welch_t_test(a, b)
+                a_mean = stats.mean(a)
+                delta = difference / a_mean * 100 if a_mean else 0.0
+                low, high = difference - half_width, difference + half_width
+                # the whole interval is on the wrong side of 0.
+                significant = high < 0 if higher_is_better else low > 0
+                worse = delta < -self.threshold_percent if higher_is_better else delta > self.threshold_percent
+                regression = significant and worse
+                regressions += regression
+                lines.append(f"    {metric:<12}{a_mean:>12.3f}{stats.mean(b):>12.3f}{delta:>11.1f}%"
+                             f"{f'[{low:.3f}, {high:.3f}]':>22}{p_value:>10.4f}{'  REGRESSION' if regression else ''}")
+                rows.append([key[0], key[1], metric, a_mean, stats.mean(b), delta, low, high, p_value, regression])
+
+            # the percentiles of all runs together.
+            for name, runs in [("A", a_runs), ("B", b_runs)]:
+                histogram = runs[0]["histogram"].copy()
+                for run in runs[1:]:
+                    histogram.add(run["histogram"])
+                lines.append(f"    {name} all runs: p50 {histogram.value_at_percentile(50) / ratio:.3f}ms "
+                             f"p99 {histogram.value_at_percentile(99) / ratio:.3f}ms "
+                             f"p99.9 {histogram.value_at_percentile(99.9) / ratio:.3f}ms "
+                             f"max {histogram.max() / ratio:.3f}ms")
+            lines.append("")
+        lines.append(f"{regressions} regressions" if regressions else "No regressions")
+
+        with open(os.path.join(dir, "report.txt"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+        with open(os.path.join(dir, "report.csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["file", "tag", "metric", "baseline", "candidate", "delta_percent", "ci_low", "ci_high",
+                             "p_value", "regression"])
+            writer.writerows(rows)
+        print("\n".join(lines))
+        log_important(f"ABTest {self.name}: {regressions} regressions")
+        return regressions
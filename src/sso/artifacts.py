@@ -0,0 +1,125 @@
+import hashlib
+import os
+import urllib.request
+from threading import Lock
+
+from sso.util import log_important
+
+# Per host manifest of what sso has installed; makes repeated installs a no-op.
+MANIFEST_DIR = ".sso/installed"
+# Where the artifacts are pushed to on the hosts.
+REMOTE_ARTIFACT_DIR = ".sso/artifacts"
+
+APACHE_MIRRORS = ["https://downloads.apache.org", "https://archive.apache.org/dist"]
+
+
+def is_installed(ssh, name):
+    return ssh.test(f"test -f {MANIFEST_DIR}/{name}")
+
+
+def mark_installed(ssh, name):
+    ssh.exec(f"mkdir -p {MANIFEST_DIR} && touch {MANIFEST_DIR}/{name}")
+
+
+def cassandra_tarball(cache, cassandra_version):
+    """
+    Returns the local path of the Cassandra binary tarball; downloads it into the cache if needed.
+    """
+    filename = f"apache-cassandra-{cassandra_version}-bin.tar.gz"
+    path = f"cassandra/{cassandra_version}/{filename}"
+    return cache.fetch(filename,
+                       [f"{mirror}/{path}" for mirror in APACHE_MIRRORS],
+                       sha512_urls=[f"{mirror}/{path}.sha512" for mirror in APACHE_MIRRORS])
+
+
+class ArtifactCache:
+    """
+    Artifacts (e.g. tarballs) are downloaded once to the controller, verified and then pushed
+    to the hosts. This prevents every host from downloading from a (flaky) public mirror.
+    """
+
+    def __init__(self, properties):
+        self.dir = os.path.expanduser(properties.get('artifact_cache_dir', '~/.cache/sso/artifacts'))
+        self.__lock = Lock()
+
+    def __download(self, urls, path):
+        last_error = None
+        for url in urls:
+            try:
+                print(f"    Downloading [{url}]")
+                urllib.request.urlretrieve(url, path)
+                return
+            except Exception as e:
+                print(f"    Failed to download [{url}]: {e}")
+                last_error = e
+        raise Exception(f"Failed to download from any of {urls}") from last_error
+
+    def __expected_sha512(self, sha512_urls):
+        for url in sha512_urls:
+            try:
+                with urllib.request.urlopen(url) as response:
+                    # the file is either just the checksum or the checksum followed by the filename.
+                    return response.read().decode().split()[0].lower()
+            except Exception as e:
+                print(f"    Failed to download [{url}]: {e}")
+        raise Exception(f"Failed to download the checksum from any of {sha512_urls}")
+
+    def fetch(self, filename, urls, sha512=None, sha512_urls=None):
+        """
+        Returns the local path of the artifact. If it isn't in the cache yet, it is downloaded
+        from the first url that works and verified against the sha512 (or the checksum found at
+        one of the sha512_urls).
+        """
+        path = os.path.join(self.dir, filename)
+        with self.__lock:
+            if os.path.exists(path):
+                return path
+
+            log_important(f"Fetching {filename}: started")
+            os.makedirs(self.dir, exist_ok=True)
+            download_path = path + ".download"
+            self.__download(urls, download_path)
+
+            if sha512 is None and sha512_urls:
+                sha512 = self.__expected_sha512(sha512_urls)
+            if sha512 is not None:
+                actual = sha512sum(download_path)
+                if actual != sha512.lower():
+                    os.remove(download_path)
+                    raise Exception(f"Checksum mismatch for {filename}: expected {sha512}, found {actual}")
+
+            os.rename(download_path, path)
+            log_important(f"Fetching {filename}: done")
+            return path
+
+    def push(self, ssh, path):
+        """
+        Copies the artifact to the host unless it is already there. Returns the remote path.
+        """
+        remote_path = f"{REMOTE_ARTIFACT_DIR}/{os.path.basename(path)}"
+        checksum = sha512sum(path)
+        if ssh.test(f"echo \"{checksum}  {remote_path}\" | sha512sum --status -c -"):
+            print(f'    [{ssh.ip}] {os.path.basename(path)} already present')
+            return remote_path
+
+        print(f'    [{ssh.ip}] Uploading {os.path.basename(path)}')
+        ssh.exec(f"mkdir -p {REMOTE_ARTIFACT_DIR}")
+        ssh.scp_to_remote(path, remote_path)
+        return remote_path
+
+
+__sha512_cache = {}
+
+
+def sha512sum(path):
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    checksum = __sha512_cache.get(key)
+    if checksum is None:
+        sha512 = hashlib.sha512()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha512.update(chunk)
+        checksum = sha512.hexdigest()
+        __sha512_cache[key] = checksum
+    return checksum
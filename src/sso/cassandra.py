@@ -3,6 +3,8 @@ import os
 import time
 
 from datetime import datetime
+from sso import artifacts
+from sso.artifacts import ArtifactCache
 from sso.hdr import HdrLogProcessor
 from sso.ssh import SSH
 from sso.util import run_parallel, find_java, WorkerThread, log_important
@@ -19,35 +21,42 @@ class Cassandra:
             self.cassandra_version = properties['cassandra_version']
             
         self.ssh_user = properties['cluster_user']
+        self.artifact_cache = ArtifactCache(properties)
         # trigger early detection of missing java.
         find_java(properties)
   
     def __new_ssh(self, ip):
         return SSH(ip, self.ssh_user, self.properties['ssh_options'])
 
-    def __install(self, ip):
+    def __install(self, ip, tarball):
         ssh = self.__new_ssh(ip)
+        manifest = f"cassandra-{self.cassandra_version}"
+        if artifacts.is_installed(ssh, manifest):
+            print(f'    [{ip}] Installing Cassandra: already installed')
+            return
+
+        # e.g. installed before the manifests were recorded; checked before pushing the tarball.
+        if ssh.test(f"test -d apache-cassandra-{self.cassandra_version}"):
+            print(f'    [{ip}] Installing Cassandra: Cassandra {self.cassandra_version} already exists')
+            artifacts.mark_installed(ssh, manifest)
+            return
+
         ssh.update()
         print(f'    [{ip}] Installing Cassandra: started')
         ssh.install_one('openjdk-8-jdk', 'java-1.8.0-openjdk')
-        ssh.install('wget')
+        remote_tarball = self.artifact_cache.push(ssh, tarball)
         seeds = ",".join(self.cluster_private_ips)
         private_ip = self.__find_private_ip(ip)
         ssh.exec(f"""
             set -e
             
-            if [ -d 'apache-cassandra-{self.cassandra_version}' ]; then
-                echo Cassandra {self.cassandra_version} already installed.
-                exit 0
-            fi
-            
-            wget -q -N https://mirrors.netix.net/apache/cassandra/{self.cassandra_version}/apache-cassandra-{self.cassandra_version}-bin.tar.gz
-            tar -xzf apache-cassandra-{self.cassandra_version}-bin.tar.gz
+            tar -xzf {remote_tarball}
             cd apache-cassandra-{self.cassandra_version}
             sudo sed -i \"s/seeds:.*/seeds: {seeds} /g\" conf/cassandra.yaml
             sudo sed -i \"s/listen_address:.*/listen_address: {private_ip} /g\" conf/cassandra.yaml
             sudo sed -i \"s/rpc_address:.*/rpc_address: {private_ip} /g\" conf/cassandra.yaml
         """)
+        artifacts.mark_installed(ssh, manifest)
         print(f'    [{ip}] Installing Cassandra: done')
 
     def __find_private_ip(self, public_ip):
@@ -56,7 +65,9 @@ class Cassandra:
 
     def install(self):
         log_important("Installing Cassandra: started")
-        run_parallel(self.__install, [(ip,) for ip in self.cluster_public_ips])
+        # downloaded once to the controller instead of by every node.
+        tarball = artifacts.cassandra_tarball(self.artifact_cache, self.cassandra_version)
+        run_parallel(self.__install, [(ip, tarball) for ip in self.cluster_public_ips])
         log_important("Installing Cassandra: done")
         
     def __start(self, ip):
@@ -19,6 +19,8 @@ class Iteration:
         self.trials_dir_name = "trials"
         self.trials_dir = os.path.join(os.getcwd(), self.trials_dir_name)
         self.trial_name = trial_name
+        # used to select the metrics of the iteration; see prometheus.extract.
+        self.start_time = time.time()
         self.trial_dir = os.path.join(self.trials_dir, trial_name)
 
         while True:
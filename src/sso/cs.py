@@ -1,10 +1,26 @@
+import csv
+import math
 import os
+import re
 import time
 
 from datetime import datetime
+from fractions import Fraction
+from threading import Lock
+from sso import artifacts, hdrstream, results, scylla
+from sso.artifacts import ArtifactCache
+from sso.distribute import Distributor
 from sso.hdr import HdrLogProcessor
+from sso.hdrstream import HdrStream
 from sso.ssh import SSH
 from sso.util import run_parallel, WorkerThread,log_important
+from sso import hdrhistogram
+
+
+# Where bulk_load runs the local Cassandra on the load generators.
+BULK_DIR = ".sso/bulk"
+# The exit code of the remote command of a load generator that missed the start barrier.
+_MISSED_BARRIER_EXITCODE = 97
 
 
 class CassandraStress:
@@ -13,14 +29,28 @@ class CassandraStress:
         self.properties = properties
         self.load_ips = load_ips
         self.cassandra_version = properties['cassandra_version']
+        # the version of the Scylla repository scylla-tools is installed from.
+        self.scylla_tools_version = str(properties.get('scylla_tools_version', '4.3'))
         self.ssh_user = properties['load_generator_user']
         self.scylla_tools = scylla_tools
+        self.artifact_cache = ArtifactCache(properties)
+        # the HdrStreams of the streamed stress runs that haven't been collected yet; a hdr file
+        # can be streamed by more than one run.
+        self.hdr_streams = []
 
     def __new_ssh(self, ip):
         return SSH(ip, self.ssh_user, self.properties['ssh_options'])
 
-    def __install(self, ip):
+    def __install(self, ip, tarball=None):
         ssh = self.__new_ssh(ip)
+        if self.scylla_tools:
+            manifest = f"scylla-tools-{self.scylla_tools_version}"
+        else:
+            manifest = f"cassandra-stress-{self.cassandra_version}"
+        if artifacts.is_installed(ssh, manifest):
+            print(f'    [{ip}] Installing cassandra-stress: already installed')
+            return
+
         ssh.update()
         if self.scylla_tools:
             print(f'    [{ip}] Installing cassandra-stress (Scylla): started')
@@ -29,12 +59,12 @@ class CassandraStress:
                 if hash apt-get 2>/dev/null; then
                     sudo apt-get install -y apt-transport-https
                     sudo apt-key adv --keyserver hkp://keyserver.ubuntu.com:80 --recv-keys 5e08fbd8b5d6ec9c
-                    sudo curl -L --output /etc/apt/sources.list.d/scylla.list http://downloads.scylladb.com/deb/ubuntu/scylla-4.3-$(lsb_release -s -c).list
+                    sudo curl -L --output /etc/apt/sources.list.d/scylla.list http://downloads.scylladb.com/deb/ubuntu/scylla-{self.scylla_tools_version}-$(lsb_release -s -c).list
                     sudo apt-get update -y
                     sudo apt-get install -y scylla-tools
                 elif hash yum 2>/dev/null; then
                     sudo yum install  -y -q https://dl.fedoraproject.org/pub/epel/epel-release-latest-7.noarch.rpm
-                    sudo curl -o /etc/yum.repos.d/scylla.repo -L http://repositories.scylladb.com/scylla/repo/603fc559-4518-4f8e-8ceb-2851dec4ab23/centos/scylladb-4.3.repo
+                    sudo curl -o /etc/yum.repos.d/scylla.repo -L http://repositories.scylladb.com/scylla/repo/603fc559-4518-4f8e-8ceb-2851dec4ab23/centos/scylladb-{self.scylla_tools_version}.repo
                     sudo yum install -y -q scylla-tools
                 else
                     echo "Cannot install scylla-tools: yum/apt not found"
@@ -44,91 +74,593 @@ class CassandraStress:
         else:
             print(f'    [{ip}] Installing cassandra-stress (Cassandra): started')
             ssh.install_one('openjdk-8-jdk', 'java-1.8.0-openjdk')
-            ssh.install('wget')
-            ssh.exec(f"""
-                set -e
-                wget -q -N https://mirrors.netix.net/apache/cassandra/{self.cassandra_version}/apache-cassandra-{self.cassandra_version}-bin.tar.gz
-                tar -xzf apache-cassandra-{self.cassandra_version}-bin.tar.gz
-            """)
+            remote_tarball = self.artifact_cache.push(ssh, tarball)
+            ssh.exec(f"tar -xzf {remote_tarball}")
 
+        artifacts.mark_installed(ssh, manifest)
         print(f'    [{ip}] Installing cassandra-stress: done')
 
     def install(self):
         log_important("Installing Cassandra-Stress: started")
-        run_parallel(self.__install, [(ip,) for ip in self.load_ips])
+        tarball = None
+        if not self.scylla_tools:
+            # downloaded once to the controller instead of by every load generator.
+            tarball = artifacts.cassandra_tarball(self.artifact_cache, self.cassandra_version)
+        run_parallel(self.__install, [(ip, tarball) for ip in self.load_ips])
         log_important("Installing Cassandra-Stress: done")
 
-    def __stress(self, ip, cmd):
+    def __stress(self, ip, cmd, start_time=None, log_file=None, quiet=False):
         if self.scylla_tools:
             full_cmd = f'cassandra-stress {cmd}'
         else:
             cassandra_stress_dir = f'apache-cassandra-{self.cassandra_version}/tools/bin'
             full_cmd = f'{cassandra_stress_dir}/cassandra-stress {cmd}'
             
-        dt=datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
-        full_cmd = full_cmd + f" 2>&1 | tee -a cassandra-stress-{dt}.log"    
-        print(full_cmd)
-        self.__new_ssh(ip).exec(full_cmd)
-      
-    def stress(self, command, load_index=None):
-        if load_index is None:
-            log_important("Cassandra-Stress: started")
-            run_parallel(self.__stress, [(ip, command) for ip in self.load_ips])
-            log_important("Cassandra-Stress: done")
+        if log_file is None:
+            dt=datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+            log_file = f"cassandra-stress-{dt}.log"
+        if quiet:
+            # e.g. the dashboard is showing; the output only goes to the log file.
+            full_cmd = full_cmd + f" >> {log_file} 2>&1"
+        else:
+            full_cmd = full_cmd + f" 2>&1 | tee -a {log_file}"    
+            print(full_cmd)
+        if start_time is not None:
+            # start_time is in the clock of the load generator. A load generator that is armed
+            # after the start barrier doesn't start, the run wouldn't be valid.
+            full_cmd = f"""
+                delay=$(awk "BEGIN {{ printf \\"%.6f\\", {start_time:.6f} - $(date +%s.%N) }}")
+                case $delay in
+                    -*) echo "Armed ${{delay#-}} seconds after the start barrier, not started"
+                        exit {_MISSED_BARRIER_EXITCODE} ;;
+                    *) echo "Armed, starting in $delay seconds"
+                       sleep $delay ;;
+                esac
+                {full_cmd}"""
+        try:
+            self.__new_ssh(ip).exec(full_cmd)
+        except Exception as e:
+            if start_time is not None and f"exitcode={_MISSED_BARRIER_EXITCODE}" in str(e):
+                raise Exception(f"Load generator {ip} missed the start barrier; increase start_delay_seconds") from e
+            raise
+
+    def __clock_offset(self, ip, offsets):
+        ssh = self.__new_ssh(ip)
+        # the first call also establishes the connection.
+        ssh.output("true")
+        samples = []
+        for i in range(3):
+            before = time.time()
+            remote = float(ssh.output("date +%s.%N"))
+            after = time.time()
+            samples.append((after - before, remote - (before + after) / 2))
+        round_trip, offset = min(samples)
+        # an offset within the round trip can't be told apart from the latency; the clocks
+        # (ntp) are trusted then.
+        offsets[ip] = offset if abs(offset) > round_trip else 0.0
+
+    def __start_times(self, ips, start_delay_seconds):
+        """
+        Returns the common start time of the load generators, in the clock of every load generator.
+        """
+        offsets = {}
+        run_parallel(self.__clock_offset, [(ip, offsets) for ip in ips])
+        start_time = time.time() + start_delay_seconds
+        print(f"Start barrier at {datetime.fromtimestamp(start_time).strftime('%H:%M:%S.%f')[:-3]}, "
+              f"max corrected clock offset {max(abs(o) for o in offsets.values()) * 1000:.1f}ms")
+        return {ip: start_time + offsets[ip] for ip in ips}
+
+    def __stress_all(self, ips, commands, barrier, start_delay_seconds, log_file=None, quiet=False):
+        start_times = self.__start_times(ips, start_delay_seconds) if barrier else {}
+        # one worker per load generator; they all run for the whole benchmark.
+        run_parallel(self.__stress, [(ip, command, start_times.get(ip), log_file, quiet)
+                                     for ip, command in zip(ips, commands)], max_workers=len(ips))
+
+    def stress(self, command, load_index=None, stream_hdr=False, aggregate_rate=None, barrier=True,
+               start_delay_seconds=3, dashboard=None, profiler=None, fail_on_coordinated_omission=False):
+        """
+        Parameters
+        ----------
+        command: str
+            The cassandra-stress command.
+        load_index: int
+            The index of the load generator to run on. If None, all load generators are used.
+        stream_hdr: bool
+            If True, the '-log hdrfile=' file is streamed from the load generators and merged
+            while the benchmark is running. The cluster wide throughput and latencies are 
+            printed every interval and collect_results doesn't need to download and merge the
+            hdr file.
+        aggregate_rate: int
+            The total rate (ops/second) divided over the load generators as '-rate fixed='. The
+            command needs '-rate threads=<n>'. With stream_hdr, the result is checked for
+            coordinated omission (see verify_fixed_rate).
+        barrier: bool
+            If True, the load generators are connected first and then started at the same
+            moment (start_delay_seconds later), corrected for the clock offset of every load
+            generator.
+        dashboard: Dashboard
+            If set, the dashboard is shown while the benchmark is running instead of the output
+            of cassandra-stress. Implies stream_hdr. If the dashboard aborts the run, an
+            exception is raised.
+        profiler: ContinuousProfiler
+            If set, the cluster is profiled while the benchmark is running.
+        fail_on_coordinated_omission: bool
+            If True, an exception is raised when verify_fixed_rate fails.
+        Returns
+        -------
+        The result of verify_fixed_rate with aggregate_rate and stream_hdr; otherwise None.
+        """
+        ips = self.load_ips if load_index is None else [self.load_ips[load_index]]
+        if aggregate_rate is None:
+            commands = [command] * len(ips)
         else:
-            print("using load_index " + str(load_index))
-            self.__stress(self.load_ips[load_index], command)
+            commands = [_with_fixed_rate(command, rate) for rate in _split(aggregate_rate, len(ips))]
+
+        hdr_stream = None
+        if stream_hdr or dashboard is not None:
+            match = re.search(r'hdrfile=(\S+)', command)
+            if not match:
+                raise Exception("stream_hdr requires '-log hdrfile=<file>' in the command")
+            hdr_stream = HdrStream(ips, self.ssh_user, self.properties['ssh_options'], match.group(1),
+                                   print_intervals=dashboard is None)
+            hdr_stream.start()
+
+        log_file = None
+        if dashboard is not None:
+            log_file = f"cassandra-stress-{datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}.log"
+            dashboard.start(ips, self.ssh_user, self.properties['ssh_options'], hdr_stream, log_file,
+                            lambda reason: run_parallel(self.__kill, [(ip,) for ip in ips]))
+
+        if profiler is not None:
+            profiler.start()
 
-    def async_stress(self, command, load_index=None):
-        thread = WorkerThread(self.stress, (command, load_index))
+        try:
+            if load_index is None:
+                log_important("Cassandra-Stress: started")
+                self.__stress_all(ips, commands, barrier, start_delay_seconds, log_file, dashboard is not None)
+                log_important("Cassandra-Stress: done")
+            else:
+                print("using load_index " + str(load_index))
+                self.__stress(ips[0], commands[0], None, log_file, dashboard is not None)
+        except Exception as e:
+            # the dashboard kills cassandra-stress when it aborts; the reason matters, not the exit code.
+            if dashboard is not None and dashboard.abort_reason is not None:
+                raise Exception(f"Cassandra-Stress aborted: {dashboard.abort_reason}") from e
+            raise
+        finally:
+            if profiler is not None:
+                profiler.stop()
+            if dashboard is not None:
+                dashboard.stop()
+            if hdr_stream is not None:
+                hdr_stream.stop()
+                self.hdr_streams.append(hdr_stream)
+
+        if dashboard is not None and dashboard.abort_reason is not None:
+            raise Exception(f"Cassandra-Stress aborted: {dashboard.abort_reason}")
+
+        if hdr_stream is None or aggregate_rate is None:
+            return None
+        verified = self.verify_fixed_rate(hdr_stream.log(), aggregate_rate)
+        if not verified and fail_on_coordinated_omission:
+            raise Exception("Cassandra-Stress didn't sustain the fixed rate (coordinated omission)")
+        return verified
+
+    def async_stress(self, *args, **kwargs):
+        """
+        Runs stress (same arguments) in the background. Returns a future that is set to True
+        when stress completes or to the exception if it fails.
+        """
+        thread = WorkerThread(self.stress, args, kwargs)
         thread.start()
         return thread.future
 
-    def insert(self, profile, item_count, nodes, mode="native cql3", rate="threads=100", sequence_start=None):
+    def verify_fixed_rate(self, log, aggregate_rate, warmup_seconds=None, max_ratio=1.5, tolerance=0.05):
+        """
+        Checks that a fixed rate run didn't suffer from coordinated omission: the load generators
+        kept up with the schedule, so the achieved rate is within tolerance of aggregate_rate and
+        the response time (measured from the intended start, -rt tags) p99 isn't more than
+        max_ratio times the service time (measured from the actual start, -st tags) p99.
+
+        Parameters
+        ----------
+        log: HistogramLog or str
+            The merged log or the path of the merged hdr file.
+        Returns
+        -------
+        True if no coordinated omission was detected.
+        """
+        if isinstance(log, str):
+            log = hdrhistogram.read_log(log)
+        log = log.trim(warmup_seconds, None)
+        begin, end = log.time_range()
+        rt_tags = [tag for tag in log.tags() if tag is not None and tag.endswith("-rt")]
+        if not rt_tags or end <= begin:
+            log_important("Coordinated omission check: no response time (-rt) data found")
+            return False
+
+        ok = True
+        ratio = hdrhistogram.DEFAULT_VALUE_UNIT_RATIO
+        count = 0
+        for rt_tag in rt_tags:
+            rt = log.total(rt_tag)
+            count += rt.total_count()
+            st = log.total(rt_tag[:-3] + "-st")
+            if st is None:
+                continue
+            rt_p99 = rt.value_at_percentile(99) / ratio
+            st_p99 = st.value_at_percentile(99) / ratio
+            print(f"    {rt_tag[:-3]}: p99 response time={rt_p99:.3f}ms p99 service time={st_p99:.3f}ms")
+            if rt_p99 > st_p99 * max_ratio:
+                print(f"    {rt_tag[:-3]}: the load generators fell behind the schedule")
+                ok = False
+
+        throughput = count / (end - begin)
+        print(f"    Throughput {throughput:.0f} ops/s, target {aggregate_rate} ops/s")
+        if throughput < aggregate_rate * (1 - tolerance):
+            print(f"    The target rate wasn't sustained")
+            ok = False
+        log_important(f"Coordinated omission check: {'passed' if ok else 'FAILED'}")
+        return ok
+
+    def insert(self, profile, item_count, nodes, mode="native cql3", rate="threads=100", sequence_start=None,
+               calibration_seconds=None, steal_fraction=0.0, steal_chunks=4):
+        """
+        Inserts the items [sequence_start, sequence_start + item_count) using all load generators.
+
+        Parameters
+        ----------
+        calibration_seconds: int
+            If set, every load generator first inserts for calibration_seconds and the items
+            are divided proportional to the measured throughput instead of evenly; so a slower
+            load generator doesn't determine the duration of the insert.
+        steal_fraction: float
+            The fraction of the items that isn't assigned up front, but is split into
+            steal_chunks sub-ranges per load generator that are handed out to the load
+            generators that finish first.
+        """
         log_important(f"Inserting {item_count} items")
         start_seconds = time.time()
 
-        per_load_generator = item_count // len(self.load_ips)
         start = sequence_start
         if sequence_start is None:
             start = 1
 
-        end = start + per_load_generator - 1
-        cmd_list = []
-        for i in range(0, len(self.load_ips)):
-            cmd = f'user profile={profile} "ops(insert=1)" n={per_load_generator} no-warmup -pop seq={start}..{end} -mode {mode} -rate {rate}  -node {nodes}'
-            print(self.load_ips[i] + " " + cmd)
-            cmd_list.append(cmd)
-            start = end + 1
-            end = end + per_load_generator
-
-        futures = []
-        for i in range(0, len(self.load_ips)):
-            f = self.async_stress(cmd_list[i], load_index=i)
-            futures.append(f)
-            if i == 0:
-                time.sleep(10)
-
-        for f in futures:
-            f.join()
+        # the schema is created by a single load generator, so the load generators don't
+        # race on creating it when they are started together.
+        self.stress(f'user profile={profile} "ops(insert=1)" n=1 no-warmup -pop seq={start}..{start} -mode {mode} -rate threads=1 -node {nodes}',
+                    load_index=0)
+
+        def command(first, count):
+            return f'user profile={profile} "ops(insert=1)" n={count} no-warmup -pop seq={first}..{first + count - 1} -mode {mode} -rate {rate}  -node {nodes}'
+
+        if calibration_seconds:
+            weights = self.__calibrate(start, item_count, calibration_seconds, profile, nodes, mode, rate)
+        else:
+            weights = [1] * len(self.load_ips)
+
+        steal_count = int(item_count * steal_fraction)
+        ranges = []
+        for count in _split_weighted(item_count - steal_count, weights):
+            ranges.append((start, count))
+            start += count
+        # the chunks are handed out from the front of the list.
+        chunks = []
+        for count in _split(steal_count, len(self.load_ips) * steal_chunks):
+            if count > 0:
+                chunks.append((start, count))
+                start += count
+        chunks.reverse()
+
+        for ip, (first, count) in zip(self.load_ips, ranges):
+            print(f"{ip} {command(first, count)}")
+        start_times = self.__start_times(self.load_ips, 3)
+        inserted = {}
+        lock = Lock()
+        run_parallel(self.__insert, [(ip, command, ranges[i], start_times[ip], chunks, lock, inserted)
+                                     for i, ip in enumerate(self.load_ips)], max_workers=len(self.load_ips))
 
         duration_seconds = time.time() - start_seconds
+        for ip in self.load_ips:
+            print(f"    [{ip}] Inserted {inserted.get(ip, 0)} items")
         print(f"Duration : {duration_seconds} seconds")
         print(f"Insertion rate: {item_count // duration_seconds} items/second")
         log_important(f"Inserting {item_count} items: done")
 
+    def __insert(self, ip, command, assigned, start_time, chunks, lock, inserted):
+        first, count = assigned
+        while True:
+            if count > 0:
+                self.__stress(ip, command(first, count), start_time)
+                start_time = None
+                with lock:
+                    inserted[ip] = inserted.get(ip, 0) + count
+            with lock:
+                if not chunks:
+                    return
+                first, count = chunks.pop()
+            print(f'    [{ip}] Stealing items {first}..{first + count - 1}')
+
+    def bulk_load(self, profile, item_count, nodes, cluster_public_ips, sequence_start=None, rate="threads=50",
+                  heap="4G", throttle_mbits=None, timeout_seconds=300):
+        """
+        Populates the cluster by generating sstables on the load generators and loading them
+        with load-and-stream, instead of inserting through the coordinators. Every load
+        generator runs a local single node Cassandra, inserts its part of the items
+        [sequence_start, sequence_start + item_count) into it with the same profile and
+        flushes. The sstables are copied directly from the load generator into the upload
+        directory of a cluster node, and 'nodetool refresh --load-and-stream' on that node
+        streams them to the replicas. The time is bounded by the disks and the network instead
+        of the write path of the cluster. Requires a Scylla version with load-and-stream.
+
+        The keyspace definition of the profile has to work on a single node Cassandra (e.g.
+        SimpleStrategy); the replication of the cluster is done by the load-and-stream. The load
+        generators copy to the nodes with ssh using the forwarded ssh agent of the controller
+        (like the relays of Distributor).
+
+        Parameters
+        ----------
+        nodes: str
+            The comma separated (private) ips of the cluster nodes, in the same order as
+            cluster_public_ips; the load generators copy to these ips.
+        heap: str
+            The heap of the local Cassandra.
+        throttle_mbits: int
+            The maximum throughput of the copy per load generator in Mbit/s.
+        """
+        log_important(f"Bulk loading {item_count} items: started")
+        start_seconds = time.time()
+        start = sequence_start if sequence_start is not None else 1
+
+        # the table has to exist in the cluster before the sstables are loaded.
+        self.stress(f'user profile={profile} "ops(insert=1)" n=1 no-warmup -pop seq={start}..{start} -mode native cql3 -rate threads=1 -node {nodes}',
+                    load_index=0)
+
+        tarball = artifacts.cassandra_tarball(self.artifact_cache, self.cassandra_version)
+        ranges = []
+        for count in _split(item_count, len(self.load_ips)):
+            ranges.append((start, count))
+            start += count
+        private_ips = nodes.split(",")
+        # the load generators are spread over the nodes; a node loads one upload at a time.
+        targets = [(cluster_public_ips[i % len(cluster_public_ips)], private_ips[i % len(private_ips)])
+                   for i in range(len(self.load_ips))]
+        node_locks = {public_ip: Lock() for public_ip in cluster_public_ips}
+        run_parallel(self.__bulk_load, [(ip, tarball, profile, first, count, target, node_locks[target[0]], rate,
+                                         heap, throttle_mbits, timeout_seconds)
+                                        for ip, (first, count), target in zip(self.load_ips, ranges, targets)],
+                     max_workers=len(self.load_ips))
+
+        duration_seconds = time.time() - start_seconds
+        print(f"Duration : {duration_seconds} seconds")
+        print(f"Load rate: {item_count // duration_seconds} items/second")
+        log_important(f"Bulk loading {item_count} items: done")
+
+    def __bulk_load(self, ip, tarball, profile, first, count, target, node_lock, rate, heap, throttle_mbits,
+                    timeout_seconds):
+        if count <= 0:
+            return
+        ssh = self.__new_ssh(ip)
+        cassandra_dir = f"apache-cassandra-{self.cassandra_version}"
+        if not ssh.test(f"[ -x {cassandra_dir}/bin/cassandra ]"):
+            ssh.install_one('openjdk-8-jdk', 'java-1.8.0-openjdk')
+            remote_tarball = self.artifact_cache.push(ssh, tarball)
+            ssh.exec(f"tar -xzf {remote_tarball}")
+
+        try:
+            try:
+                print(f'    [{ip}] Starting local Cassandra')
+                ssh.exec(f"""
+                    set -e
+                    rm -fr {BULK_DIR}
+                    mkdir -p {BULK_DIR}/data {BULK_DIR}/commitlog {BULK_DIR}/saved_caches {BULK_DIR}/hints
+                    cp -r {cassandra_dir}/conf {BULK_DIR}/conf
+                    cd {BULK_DIR}
+                    sed -i "s|^# *data_file_directories:.*|data_file_directories:|; s|^# *- /var/lib/cassandra/data|    - $PWD/data|" conf/cassandra.yaml
+                    sed -i "s|^# *commitlog_directory:.*|commitlog_directory: $PWD/commitlog|" conf/cassandra.yaml
+                    sed -i "s|^# *saved_caches_directory:.*|saved_caches_directory: $PWD/saved_caches|" conf/cassandra.yaml
+                    sed -i "s|^# *hints_directory:.*|hints_directory: $PWD/hints|" conf/cassandra.yaml
+                    sed -i "s|seeds:.*|seeds: \"127.0.0.1\"|; s|^listen_address:.*|listen_address: 127.0.0.1|; s|^rpc_address:.*|rpc_address: 127.0.0.1|" conf/cassandra.yaml
+                    cd
+                    CASSANDRA_CONF=$PWD/{BULK_DIR}/conf MAX_HEAP_SIZE={heap} HEAP_NEWSIZE=800M nohup {cassandra_dir}/bin/cassandra -p {BULK_DIR}/cassandra.pid > {BULK_DIR}/cassandra.log 2>&1 < /dev/null
+                    for i in $(seq 1 {timeout_seconds}); do
+                        if {cassandra_dir}/bin/nodetool -h 127.0.0.1 status 2>/dev/null | grep -q '^UN'; then exit 0; fi
+                        sleep 1
+                    done
+                    echo "Local Cassandra didn't start"; tail -n 50 {BULK_DIR}/cassandra.log
+                    exit 2
+                    """)
+                ssh.exec(f"{cassandra_dir}/bin/nodetool -h 127.0.0.1 disableautocompaction")
+                self.__stress(ip, f'user profile={profile} "ops(insert=1)" n={count} no-warmup -pop seq={first}..{first + count - 1} -mode native cql3 -rate {rate} -node 127.0.0.1')
+                ssh.exec(f"{cassandra_dir}/bin/nodetool -h 127.0.0.1 flush")
+            finally:
+                # also when the start failed; the JVM may be running without answering nodetool.
+                ssh.exec(f"[ -f {BULK_DIR}/cassandra.pid ] || exit 0; "
+                         f"kill $(cat {BULK_DIR}/cassandra.pid); "
+                         f"while kill -0 $(cat {BULK_DIR}/cassandra.pid) 2>/dev/null; do sleep 1; done",
+                         ignore_errors=True)
+            self.__upload_sstables(ip, ssh, target, node_lock, throttle_mbits)
+        finally:
+            ssh.exec(f"rm -fr {BULK_DIR}", ignore_errors=True)
+        print(f'    [{ip}] Loaded items {first}..{first + count - 1}')
+
+    def __upload_sstables(self, ip, ssh, target, node_lock, throttle_mbits):
+        node_public_ip, node_private_ip = target
+        cluster_user = self.properties['cluster_user']
+        node_ssh = SSH(node_public_ip, cluster_user, self.properties['ssh_options'])
+        # the ssh agent of the controller is forwarded, so the load generator can ssh to the node.
+        relay_ssh = SSH(ip, self.ssh_user, f"{self.properties['ssh_options']} -o ForwardAgent=yes")
+        staging_dir = f".sso/bulk-upload/{ip}"
+        limit = f"-l {throttle_mbits * 1000}" if throttle_mbits else ""
+
+        # <keyspace>/<table>-<id> directories with sstables.
+        table_dirs = ssh.output(f"cd {BULK_DIR}/data && for d in */*; do "
+                                f"ls $d/*-Data.db > /dev/null 2>&1 && echo $d; done; true").split()
+        for table_dir in table_dirs:
+            keyspace, table_id = table_dir.split("/")
+            if keyspace.startswith("system"):
+                continue
+            table = re.sub(r'-[0-9a-f]{32}$', '', table_id)
+            print(f'    [{ip}] Copying sstables of {keyspace}.{table} to [{node_public_ip}]')
+            node_ssh.exec(f"rm -fr {staging_dir} && mkdir -p {staging_dir}")
+            relay_ssh.exec(f"scp -q -o BatchMode=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null "
+                           f"{limit} $(find {BULK_DIR}/data/{table_dir} -maxdepth 1 -type f) "
+                           f"{cluster_user}@{node_private_ip}:{staging_dir}/ || exit 2")
+            # the sstables of every load generator are numbered from 1, so the uploads to a node
+            # are loaded one at a time; refresh empties the upload directory.
+            with node_lock:
+                print(f'    [{node_public_ip}] Load and stream of {keyspace}.{table} from [{ip}]')
+                # exit 1 isn't treated as a failure by exec.
+                node_ssh.exec(f"""
+                    table_dir=$(ls -d {scylla.SCYLLA_DIR}/data/{keyspace}/{table}-* | head -n 1)
+                    [ -n "$table_dir" ] || exit 2
+                    sudo mv {staging_dir}/* $table_dir/upload/ || exit 2
+                    sudo chown -R scylla:scylla $table_dir/upload || exit 2
+                    nodetool refresh --load-and-stream {keyspace} {table} || exit 2
+                    """)
+            node_ssh.exec(f"rm -fr {staging_dir}")
+
+    def __calibrate(self, start, item_count, calibration_seconds, profile, nodes, mode, rate):
+        log_important("Calibrating load generators: started")
+        log_file = "sso-calibration.log"
+        commands = []
+        for count in _split(item_count, len(self.load_ips)):
+            # the calibration writes items that are inserted anyway.
+            commands.append(f'user profile={profile} "ops(insert=1)" duration={calibration_seconds}s no-warmup -pop seq={start}..{start + max(count, 1) - 1} -mode {mode} -rate {rate}  -node {nodes}')
+            start += count
+        start_times = self.__start_times(self.load_ips, 3)
+        run_parallel(self.__stress, [(ip, cmd, start_times[ip], log_file) for ip, cmd in zip(self.load_ips, commands)],
+                     max_workers=len(self.load_ips))
+
+        weights = []
+        for ip in self.load_ips:
+            ssh = self.__new_ssh(ip)
+            output = ssh.output(f"grep 'Op rate' {log_file} | tail -n 1")
+            match = re.search(r'Op rate\s*:\s*([\d,]+)', output)
+            if not match:
+                raise Exception(f"Failed to find the op rate in the calibration output of {ip}")
+            weights.append(int(match.group(1).replace(",", "")))
+            print(f'    [{ip}] Calibrated at {weights[-1]} op/s')
+        self.ssh(f"rm -f {log_file}")
+        log_important("Calibrating load generators: done")
+        return weights
+
+    def find_max_throughput(self, profile, slo_p99_ms, nodes, dir, ops="ops(insert=1)", mode="native cql3",
+                            threads=100, start_rate=10000, max_rate=None, step_rate=None, stage_seconds=60,
+                            warmup_seconds=15, precision=0.05, max_stages=20):
+        """
+        Finds the highest rate (ops/second over all load generators) at which the p99 latency
+        stays below the SLO. Short stages with a fixed rate are run on all load generators. The
+        rate is doubled till the SLO is violated or the rate can't be sustained, followed by a
+        binary search between the last passing and the first failing rate. Every stage is
+        recorded in dir/max-throughput.
+
+        Parameters
+        ----------
+        slo_p99_ms: float
+            The maximum p99 latency (response time, so including coordinated omission).
+        dir: str
+            The iteration directory.
+        step_rate: int
+            If set, the rate is increased by step_rate every stage till the first failing stage
+            instead of the binary search.
+        warmup_seconds: int
+            The start of every stage that isn't used for the evaluation.
+        precision: float
+            The binary search stops when the passing and failing rate are within this fraction;
+            it is also the fraction of the rate a stage may fall short of the target rate.
+        Returns
+        -------
+        The highest passing rate or None if no stage passed.
+        """
+        log_important(f"Find max throughput: started")
+        result_dir = os.path.join(dir, "max-throughput")
+        os.makedirs(result_dir, exist_ok=True)
+        stages = []
+        passing_rate = None
+        failing_rate = None
+        rate = start_rate
+        while len(stages) < max_stages:
+            stage = self.__run_stage(len(stages) + 1, rate, profile, nodes, result_dir, ops, mode, threads,
+                                     stage_seconds, warmup_seconds)
+            passed = stage['p99_ms'] <= slo_p99_ms and stage['throughput'] >= rate * (1 - precision)
+            stage['passed'] = passed
+            stages.append(stage)
+            self.__write_stages(result_dir, stages)
+            print(f"    Stage {len(stages)}: rate={rate} throughput={stage['throughput']:.0f} "
+                  f"p99={stage['p99_ms']:.3f}ms {'passed' if passed else 'failed'}")
+
+            if passed:
+                passing_rate = rate
+            else:
+                failing_rate = rate
+
+            if failing_rate is None:
+                if max_rate is not None and rate >= max_rate:
+                    break
+                rate = rate + step_rate if step_rate else rate * 2
+                if max_rate is not None:
+                    rate = min(rate, max_rate)
+            else:
+                lower = passing_rate if passing_rate is not None else 0
+                if step_rate or failing_rate - lower <= failing_rate * precision:
+                    break
+                rate = (lower + failing_rate) // 2
+
+        with open(os.path.join(result_dir, "result.txt"), "w") as f:
+            print(f"slo_p99_ms={slo_p99_ms}", file=f)
+            print(f"max_throughput={passing_rate}", file=f)
+        log_important(f"Find max throughput: done, max throughput={passing_rate} ops/s")
+        return passing_rate
+
+    def __run_stage(self, index, rate, profile, nodes, result_dir, ops, mode, threads, stage_seconds,
+                    warmup_seconds):
+        hdr_file = f"sso-stage-{index}.hdr"
+        cmd = f'user profile={profile} "{ops}" duration={stage_seconds}s no-warmup -mode {mode} ' \
+              f'-rate threads={threads} -log hdrfile={hdr_file} -node {nodes}'
+        self.stress(cmd, stream_hdr=True, aggregate_rate=rate)
+        hdr_stream = [s for s in self.hdr_streams if s.hdr_file == hdr_file][-1]
+        self.hdr_streams.remove(hdr_stream)
+        # the stage hdr files shouldn't end up in the results of collect_results.
+        self.ssh(f"rm -f {hdr_file}")
+        hdr_stream.write(os.path.join(result_dir, f"stage-{index:02d}-{rate}"))
+
+        log = hdr_stream.log().trim(warmup_seconds, None)
+        histogram = None
+        for tag in hdrhistogram.response_time_tags(log.tags()):
+            total = log.total(tag)
+            if histogram is None:
+                histogram = total
+            else:
+                histogram.add(total)
+        begin, end = log.time_range()
+        if histogram is None or end <= begin:
+            return {'rate': rate, 'throughput': 0.0, 'p50_ms': math.inf, 'p99_ms': math.inf, 'p999_ms': math.inf}
+        ratio = hdrhistogram.DEFAULT_VALUE_UNIT_RATIO
+        return {'rate': rate,
+                'throughput': histogram.total_count() / (end - begin),
+                'p50_ms': histogram.value_at_percentile(50) / ratio,
+                'p99_ms': histogram.value_at_percentile(99) / ratio,
+                'p999_ms': histogram.value_at_percentile(99.9) / ratio}
+
+    def __write_stages(self, result_dir, stages):
+        with open(os.path.join(result_dir, "stages.csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=['rate', 'throughput', 'p50_ms', 'p99_ms', 'p999_ms', 'passed'])
+            writer.writeheader()
+            writer.writerows(stages)
+
     def __ssh(self, ip, command):
         self.__new_ssh(ip).exec(command)
 
     def ssh(self, command):
         run_parallel(self.__ssh, [(ip, command) for ip in self.load_ips])
 
-    def __upload(self, ip, file):
-        self.__new_ssh(ip).scp_to_remote(file, "")
-
     def upload(self, file):
         log_important(f"Upload: started")
-        run_parallel(self.__upload, [(ip, file) for ip in self.load_ips])
+        # with relaying, the load generators forward the file to each other.
+        relay_fanout = self.properties.get('distribute_relay_fanout')
+        Distributor(self.load_ips, self.ssh_user, self.properties['ssh_options'],
+                    relay_fanout=relay_fanout).distribute(file, "")
         log_important(f"Upload: done")
 
     def __collect(self, ip, dir):
@@ -136,11 +668,14 @@ class CassandraStress:
         os.makedirs(dest_dir, exist_ok=True)
         print(f'    [{ip}] Collecting to [{dest_dir}]')
         ssh = self.__new_ssh(ip)
-        ssh.scp_from_remote(f'*.{{html,hdr,log}}', dest_dir)
+        # the hdr files that were streamed from this load generator are written by the HdrStream.
+        streamed = sorted({os.path.basename(hdr_stream.hdr_file) for hdr_stream in self.hdr_streams
+                           if ip in hdr_stream.load_ips})
+        ssh.download(f'*.{{html,hdr,log}}', dest_dir, exclude=streamed)
         ssh.exec(f'rm -fr *.html *.hdr *.log')
         print(f'    [{ip}] Collecting to [{dest_dir}] done')
 
-    def collect_results(self, dir, warmup_seconds=None, cooldown_seconds=None):
+    def collect_results(self, dir, warmup_seconds=None, cooldown_seconds=None, steady_state=False):
         """
         Parameters
         ----------
@@ -152,18 +687,29 @@ class CassandraStress:
         cooldown_seconds : str
             The cooldown period in seconds. If the value is set, additional files will 
             be created where the cooldown period is trimmed.            
+        steady_state: bool
+            If True, the warmup and cooldown are detected from the throughput and p99 per
+            interval of the merged hdr files instead of being passed in; the trimmed files
+            are created for the detected steady state and the bounds are recorded in
+            steady_state.csv. Requires numpy.
         """
 
         log_important(f"Collecting results: started")
         run_parallel(self.__collect, [(ip, dir) for ip in self.load_ips])
-        p = HdrLogProcessor(self.properties, warmup_seconds=warmup_seconds, cooldown_seconds=cooldown_seconds)
-        p.trim_recursivly(dir)
-        p.merge_recursivly(dir)
-        p.process_recursivly(dir)
-        p.summarize_recursivly(dir)        
+        hdrstream.write_all(self.hdr_streams, dir)
+        self.hdr_streams = []
+        p = HdrLogProcessor(self.properties, warmup_seconds=warmup_seconds, cooldown_seconds=cooldown_seconds,
+                            steady_state=steady_state)
+        p.process_all(dir)
+        if hdrhistogram.has_numpy():
+            # catalog the iteration, so it can be compared with others using bin/results.
+            results.add_iteration(dir, self.properties)
         log_important(f"Collecting results: done")
         print(f"Results can be found in [{dir}]")
      
+    def __kill(self, ip):
+        self.__new_ssh(ip).exec('killall -q -9 java', ignore_errors=True)
+
     def __prepare(self, ip):
         print(f'    [{ip}] Preparing: started')
         ssh = self.__new_ssh(ip)
@@ -175,3 +721,36 @@ class CassandraStress:
         log_important(f"Preparing load generator: started")
         run_parallel(self.__prepare, [(ip,) for ip in self.load_ips])
         log_important(f"Preparing load generator: done")
+
+
+def _split(total, parts):
+    """
+    Splits total into parts that differ at most 1.
+    """
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def _split_weighted(total, weights):
+    """
+    Splits total into parts proportional to the weights; the rounding remainder goes to the
+    parts with the largest fractions.
+    """
+    # exact arithmetic; with floats the parts of a large total don't add up to the total.
+    weights = [Fraction(w) for w in weights]
+    weight_sum = sum(weights)
+    if weight_sum <= 0:
+        return _split(total, len(weights))
+    exact = [total * w / weight_sum for w in weights]
+    parts = [math.floor(x) for x in exact]
+    by_fraction = sorted(range(len(weights)), key=lambda i: exact[i] - parts[i], reverse=True)
+    for i in by_fraction[:total - sum(parts)]:
+        parts[i] += 1
+    return parts
+
+
+def _with_fixed_rate(command, rate):
+    if re.search(r'\b(fixed|throttle)=', command):
+        raise Exception("aggregate_rate can't be combined with 'fixed=' or 'throttle=' in the command")
+    if not re.search(r'-rate\s+threads=', command):
+        raise Exception("aggregate_rate requires '-rate threads=<n>' in the command")
+    return re.sub(r'-rate\s+', f'-rate fixed={rate}/s ', command, count=1)
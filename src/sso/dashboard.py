@@ -0,0 +1,201 @@
+import sys
+import time
+from datetime import datetime
+from threading import Thread, Lock, Event
+
+from sso.ssh import SSH
+from sso.util import log_important
+from sso import hdrhistogram
+
+# The per node metrics shown when a Prometheus instance is passed; label -> PromQL returning a
+# value per instance.
+NODE_QUERIES = {
+    "reactor %": 'avg by (instance) (scylla_reactor_utilization)',
+    "cpu %": '100 * (1 - avg by (instance) (rate(node_cpu_seconds_total{mode="idle"}[30s])))',
+}
+
+CLEAR_SCREEN = "\033[H\033[J"
+
+
+class Dashboard:
+    """
+    A live view on a running stress: ops/s per load generator and in total, the merged latency
+    percentiles, the errors reported by cassandra-stress and per node metrics from Prometheus;
+    refreshed every second in the terminal. A run that violates one of the abort conditions
+    for abort_after_seconds is aborted, so a bad run is discovered in the first minute instead
+    of after collecting the results.
+
+    The latencies come from the streamed hdr file (see HdrStream), so the stress command needs
+    '-log hdrfile=<file>'.
+    """
+
+    def __init__(self, prometheus=None, node_queries=None, refresh_seconds=1.0, warmup_seconds=10,
+                 abort_p99_ms=None, abort_min_ops=None, abort_errors=None, abort_after_seconds=5):
+        """
+        Parameters
+        ----------
+        prometheus: Prometheus
+            If set, node_queries (default NODE_QUERIES) are shown per node.
+        warmup_seconds: int
+            The abort conditions are only checked after the warmup.
+        abort_p99_ms: float
+            Abort if the p99 latency of an interval is higher.
+        abort_min_ops: int
+            Abort if the total ops/s of an interval is lower.
+        abort_errors: int
+            Abort if the total number of errors is higher.
+        """
+        if not hdrhistogram.has_numpy():
+            raise Exception("The dashboard requires numpy")
+        self.prometheus = prometheus
+        self.node_queries = node_queries if node_queries is not None else NODE_QUERIES
+        self.refresh_seconds = refresh_seconds
+        self.warmup_seconds = warmup_seconds
+        self.abort_p99_ms = abort_p99_ms
+        self.abort_min_ops = abort_min_ops
+        self.abort_errors = abort_errors
+        self.abort_after_seconds = abort_after_seconds
+        self.abort_reason = None
+        self.__lock = Lock()
+        self.__stopped = Event()
+        self.__threads = []
+        self.__processes = {}
+
+    def start(self, load_ips, ssh_user, ssh_options, hdr_stream, log_file, abort):
+        """
+        Starts the dashboard for a stress run that writes its output to log_file on every load
+        generator. abort is called with the reason when an abort condition is violated.
+        """
+        self.load_ips = load_ips
+        self.ssh_user = ssh_user
+        self.ssh_options = ssh_options
+        self.hdr_stream = hdr_stream
+        self.log_file = log_file
+        self.abort = abort
+        self.abort_reason = None
+        self.start_time = time.time()
+        self.__errors = {ip: 0 for ip in load_ips}
+        self.__node_metrics = {}
+        self.__violation_start = None
+        self.__stopped.clear()
+        self.__threads = []
+
+        for ip in load_ips:
+            process = SSH(ip, ssh_user, ssh_options).popen(f"tail -F -n +1 {log_file} 2>/dev/null")
+            self.__processes[ip] = process
+            self.__start_thread(self.__tail, (ip, process))
+        if self.prometheus is not None:
+            self.__start_thread(self.__poll_prometheus, ())
+        self.__start_thread(self.__refresh, ())
+
+    def __start_thread(self, target, args):
+        thread = Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.__threads.append(thread)
+
+    def __tail(self, ip, process):
+        errors_column = None
+        for line in process.stdout:
+            fields = [f.strip() for f in line.split(",")]
+            # the header of the cassandra-stress interval reports tells which column the errors are.
+            if fields[0].startswith("type") and "errors" in fields:
+                errors_column = fields.index("errors")
+            elif fields[0] == "total" and errors_column is not None and len(fields) > errors_column:
+                try:
+                    errors = int(float(fields[errors_column]))
+                except ValueError:
+                    continue
+                with self.__lock:
+                    self.__errors[ip] = errors
+
+    def __poll_prometheus(self):
+        while not self.__stopped.wait(self.refresh_seconds):
+            metrics = {}
+            for name, expr in self.node_queries.items():
+                try:
+                    for labels, value in self.prometheus.query(expr, timeout_seconds=self.refresh_seconds * 5):
+                        metrics.setdefault(labels.get('instance', '?'), {})[name] = value
+                except Exception:
+                    # a dashboard shouldn't fail the run; the metric is shown as missing.
+                    pass
+            with self.__lock:
+                self.__node_metrics = metrics
+
+    def __refresh(self):
+        while not self.__stopped.wait(self.refresh_seconds):
+            slot = self.hdr_stream.completed_slot()
+            histogram, ops = self.hdr_stream.slot_summary(slot)
+            with self.__lock:
+                errors = dict(self.__errors)
+                node_metrics = dict(self.__node_metrics)
+            interval_seconds = self.hdr_stream.interval_seconds
+            ops_per_second = {ip: count / interval_seconds for ip, count in ops.items()}
+            self.__render(histogram, ops_per_second, errors, node_metrics)
+            if self.abort_reason is None and histogram is not None:
+                self.__check(histogram, ops_per_second, errors)
+
+    def __render(self, histogram, ops_per_second, errors, node_metrics):
+        elapsed = int(time.time() - self.start_time)
+        lines = [f"[{datetime.now().strftime('%H:%M:%S')}] elapsed {elapsed // 60:02d}:{elapsed % 60:02d}", ""]
+        lines.append(f"{'load generator':<20}{'ops/s':>12}{'errors':>10}")
+        for ip in self.load_ips:
+            lines.append(f"{ip:<20}{ops_per_second.get(ip, 0):>12,.0f}{errors.get(ip, 0):>10}")
+        lines.append(f"{'total':<20}{sum(ops_per_second.values()):>12,.0f}{sum(errors.values()):>10}")
+        lines.append("")
+        if histogram is not None and histogram.total_count() > 0:
+            ratio = hdrhistogram.DEFAULT_VALUE_UNIT_RATIO
+            lines.append(f"latency (ms)   p50 {histogram.value_at_percentile(50) / ratio:.3f}   "
+                         f"p99 {histogram.value_at_percentile(99) / ratio:.3f}   "
+                         f"p99.9 {histogram.value_at_percentile(99.9) / ratio:.3f}   "
+                         f"max {histogram.max() / ratio:.3f}")
+        else:
+            lines.append("latency (ms)   waiting for data")
+        if self.prometheus is not None:
+            lines.append("")
+            lines.append(f"{'node':<24}" + "".join(f"{name:>12}" for name in self.node_queries))
+            for instance in sorted(node_metrics):
+                values = node_metrics[instance]
+                lines.append(f"{instance:<24}" + "".join(
+                    f"{values[name]:>12.1f}" if name in values else f"{'n/a':>12}" for name in self.node_queries))
+        if self.abort_reason is not None:
+            lines.append("")
+            lines.append(f"ABORTED: {self.abort_reason}")
+        sys.stdout.write(CLEAR_SCREEN + "\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+    def __check(self, histogram, ops_per_second, errors):
+        if time.time() - self.start_time < self.warmup_seconds:
+            return
+
+        reason = None
+        ratio = hdrhistogram.DEFAULT_VALUE_UNIT_RATIO
+        p99_ms = histogram.value_at_percentile(99) / ratio
+        total_ops = sum(ops_per_second.values())
+        if self.abort_p99_ms is not None and p99_ms > self.abort_p99_ms:
+            reason = f"p99 {p99_ms:.3f}ms > {self.abort_p99_ms}ms"
+        elif self.abort_min_ops is not None and total_ops < self.abort_min_ops:
+            reason = f"{total_ops:.0f} ops/s < {self.abort_min_ops} ops/s"
+        elif self.abort_errors is not None and sum(errors.values()) > self.abort_errors:
+            reason = f"{sum(errors.values())} errors > {self.abort_errors}"
+
+        if reason is None:
+            self.__violation_start = None
+            return
+        if self.__violation_start is None:
+            self.__violation_start = time.time()
+        if time.time() - self.__violation_start >= self.abort_after_seconds:
+            self.abort_reason = reason
+            self.abort(reason)
+
+    def stop(self):
+        self.__stopped.set()
+        for ip, process in self.__processes.items():
+            process.terminate()
+            # the remote tail doesn't get terminated when the ssh connection is closed.
+            SSH(ip, self.ssh_user, self.ssh_options).exec(f"pkill -f \"tail -F -n [+]1 {self.log_file}\"",
+                                                          ignore_errors=True)
+        for thread in self.__threads:
+            thread.join()
+        self.__processes = {}
+        if self.abort_reason is not None:
+            log_important(f"Dashboard: run aborted, {self.abort_reason}")
@@ -1,5 +1,6 @@
 import os
 from datetime import datetime
+from sso import artifacts
 from sso.ssh import SSH
 from sso.util import run_parallel,log_important
 
@@ -16,8 +17,12 @@ class DiskExplorer:
         return SSH(ip, self.ssh_user, self.ssh_options)
 
     def __install(self, ip):
-        print(f'    [{ip}] Installing disk-explorer: started')
         ssh = self.__new_ssh(ip)
+        if artifacts.is_installed(ssh, "diskplorer"):
+            print(f'    [{ip}] Installing disk-explorer: already installed')
+            return
+
+        print(f'    [{ip}] Installing disk-explorer: started')
         ssh.update()
         ssh.install('git', 'fio', 'python3', 'python3-pip')
         ssh.exec(f"""
@@ -25,6 +30,7 @@ class DiskExplorer:
             rm -fr diskplorer
             git clone -q https://github.com/scylladb/diskplorer.git
             """)
+        artifacts.mark_installed(ssh, "diskplorer")
         print(f'    [{ip}] Installing disk-explorer: done')
 
     def install(self):
@@ -52,7 +58,7 @@ class DiskExplorer:
         print(f'    [{ip}] Run: done')
 
     def run(self, command):
-       log_important(f'Disk Explorer run: started [{datetime.now().strftime("%H:%M:%S")}]')        
+        log_important(f'Disk Explorer run: started [{datetime.now().strftime("%H:%M:%S")}]')        
         print(f"python3 diskplorer.py {command}")
         run_parallel(self.__run, [(ip, command) for ip in self.ips])
         log_important(f'Disk Explorer run: done [{datetime.now().strftime("%H:%M:%S")}]')
@@ -62,9 +68,10 @@ class DiskExplorer:
         os.makedirs(dest_dir, exist_ok=True)
 
         print(f'    [{ip}] Downloading to [{dest_dir}]')
-        self.__new_ssh(ip).scp_from_remote(f'diskplorer/*.{{svg,csv}}', dest_dir)
+        ssh = self.__new_ssh(ip)
+        ssh.download(f'diskplorer/*.{{svg,csv}}', dest_dir)
         if self.capture_lsblk:
-            self.__new_ssh(ip).scp_from_remote(f'lsblk.out', dest_dir)
+            ssh.download(f'lsblk.out', dest_dir)
         print(f'    [{ip}] Downloading to [{dest_dir}] done')
 
     def download(self, dir):
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha512
+
+from sso import util
+from sso.artifacts import sha512sum
+from sso.ssh import SSH
+from sso.util import log_important
+
+# Where the archive is kept on the hosts, so they can relay it to other hosts.
+REMOTE_DISTRIBUTE_DIR = ".sso/distribute"
+
+
+def digest(src):
+    """
+    Returns the checksum of the file or directory. It is the same checksum as the one calculated
+    on the hosts by _remote_digest_command, so that hosts that already have the content can be
+    skipped.
+    """
+    parent = os.path.dirname(os.path.abspath(src))
+    paths = []
+    if os.path.isdir(src):
+        for root, _, files in os.walk(src):
+            for file in files:
+                path = os.path.join(root, file)
+                if os.path.isfile(path):
+                    paths.append(os.path.relpath(path, parent))
+    else:
+        paths.append(os.path.basename(src))
+    # same order as 'LC_ALL=C sort'
+    paths.sort(key=os.fsencode)
+
+    result = sha512()
+    for path in paths:
+        result.update(f"{sha512sum(os.path.join(parent, path))}  {path}\n".encode())
+    return result.hexdigest()
+
+
+def _remote_digest_command(dst, name):
+    return (f"cd {dst} 2>/dev/null && find {shlex.quote(name)} -type f -print0 | LC_ALL=C sort -z "
+            f"| xargs -0 -r sha512sum | sha512sum | cut -d' ' -f1")
+
+
+def _pack(src, archive, compress):
+    parent = os.path.dirname(os.path.abspath(src))
+    tar = ['tar', '-C', parent, '-cf', '-', os.path.basename(src)]
+    with open(archive, "wb") as out:
+        if not compress:
+            subprocess.run(tar, stdout=out, check=True)
+            return
+        # pigz produces gzip compatible output using all cores.
+        compressor = 'pigz' if shutil.which('pigz') else 'gzip'
+        tar_process = subprocess.Popen(tar, stdout=subprocess.PIPE)
+        subprocess.run([compressor, '-c'], stdin=tar_process.stdout, stdout=out, check=True)
+        tar_process.stdout.close()
+        if tar_process.wait() != 0:
+            raise Exception(f"Failed to create archive of {src}")
+
+
+class Distributor:
+    """
+    Copies a file or directory to many hosts. The content is archived (and compressed) once,
+    hosts that already have the same content are skipped and the archive is sent once to every
+    other host. With relay_fanout, hosts that received the archive send it on to other hosts,
+    so that the upload link of the controller isn't the bottleneck. Relaying requires the
+    hosts to be able to ssh to each other using the forwarded ssh agent of the controller.
+    """
+
+    def __init__(self, ip_list, user, ssh_options, relay_fanout=None, max_in_flight=None, compress=True):
+        """
+        Parameters
+        ----------
+        relay_fanout: int
+            The number of concurrent transfers done by the controller and by every host that
+            received the archive. If None, the controller sends to every host itself.
+        max_in_flight: int
+            The maximum number of concurrent transfers from the controller when not relaying.
+            Defaults to util.max_parallelism.
+        compress: bool
+            Compress the archive; pointless for content that is already compressed.
+        """
+        self.ip_list = ip_list
+        self.user = user
+        self.ssh_options = ssh_options
+        self.relay_fanout = relay_fanout
+        self.max_in_flight = max_in_flight if max_in_flight is not None else util.max_parallelism
+        self.compress = compress
+
+    def __new_ssh(self, ip, forward_agent=False):
+        ssh_options = f"{self.ssh_options} -o ForwardAgent=yes" if forward_agent else self.ssh_options
+        return SSH(ip, self.user, ssh_options)
+
+    def distribute(self, src, dst=""):
+        """
+        Copies src to the directory dst (created if needed; "" is the home directory) on all hosts.
+        """
+        dst = dst if dst else "."
+        name = os.path.basename(os.path.abspath(src))
+        log_important(f"Distribute {name}: started")
+
+        expected = digest(src)
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_in_flight, len(self.ip_list)))) as executor:
+            up_to_date = list(executor.map(lambda ip: self.__up_to_date(ip, dst, name, expected), self.ip_list))
+        targets = [ip for ip, skip in zip(self.ip_list, up_to_date) if not skip]
+        if not targets:
+            log_important(f"Distribute {name}: done, all hosts up to date")
+            return
+
+        tmp_dir = tempfile.mkdtemp(prefix="sso-distribute-")
+        try:
+            archive_name = f"{expected[:16]}.tar.gz" if self.compress else f"{expected[:16]}.tar"
+            archive = os.path.join(tmp_dir, archive_name)
+            _pack(src, archive, self.compress)
+            size = os.path.getsize(archive)
+            start = time.time()
+            asyncio.run(self.__distribute(archive, archive_name, dst, targets))
+            duration = time.time() - start
+            print(f"    Sent {size} bytes to {len(targets)} hosts in {duration:.1f}s "
+                  f"({size * len(targets) / max(duration, 0.001) / (1024 * 1024):.1f} MB/s aggregate)")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        log_important(f"Distribute {name}: done")
+
+    def __up_to_date(self, ip, dst, name, expected):
+        ssh = self.__new_ssh(ip)
+        if ssh.test(f"[ \"$({_remote_digest_command(dst, name)})\" = \"{expected}\" ]"):
+            print(f'    [{ip}] {name} is up to date')
+            return True
+        return False
+
+    def __receive_command(self, archive_name, dst):
+        remote_archive = f"{REMOTE_DISTRIBUTE_DIR}/{archive_name}"
+        tar = "tar -xzf" if self.compress else "tar -xf"
+        if self.relay_fanout:
+            # the archive is kept, so that the host can send it to other hosts.
+            return (f"set -e; mkdir -p {REMOTE_DISTRIBUTE_DIR} {dst}; cat > {remote_archive}.tmp; "
+                    f"mv {remote_archive}.tmp {remote_archive}; {tar} {remote_archive} -C {dst}")
+        return f"set -e; mkdir -p {dst}; {tar} - -C {dst}"
+
+    async def __send(self, source, target, archive, archive_name, dst):
+        receive = self.__receive_command(archive_name, dst)
+        try:
+            if source is None:
+                print(f'    [{target}] Receiving from controller')
+                await self.__new_ssh(target).exec_async(receive, stdin_path=archive)
+            else:
+                print(f'    [{target}] Receiving from [{source}]')
+                relay = (f"ssh -o BatchMode=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null "
+                         f"{self.user}@{target} {shlex.quote(receive)} < {REMOTE_DISTRIBUTE_DIR}/{archive_name}")
+                await self.__new_ssh(source, forward_agent=True).exec_async(relay)
+            return source, target, None
+        except Exception as e:
+            return source, target, e
+
+    async def __distribute(self, archive, archive_name, dst, targets):
+        pending = list(reversed(targets))
+        # None is the controller; every entry is a free transfer slot of that source.
+        if self.relay_fanout:
+            free = [None] * self.relay_fanout
+        else:
+            free = [None] * self.max_in_flight
+        running = set()
+        failures = []
+        while pending or running:
+            while pending and free:
+                running.add(asyncio.ensure_future(self.__send(free.pop(), pending.pop(), archive, archive_name, dst)))
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                source, target, error = task.result()
+                # the relays go first; they can serve other hosts while the controller is busy.
+                free.append(source)
+                if error is not None:
+                    failures.append((target, error))
+                elif self.relay_fanout:
+                    free.extend([target] * self.relay_fanout)
+        if failures:
+            raise Exception(f"Failed to distribute to {[ip for ip, _ in failures]}") from failures[0][1]
+
+        if self.relay_fanout:
+            await asyncio.gather(*[self.__new_ssh(ip).exec_async(f"rm -f {REMOTE_DISTRIBUTE_DIR}/{archive_name}")
+                                   for ip in targets])
@@ -1,5 +1,6 @@
 import os
 from datetime import datetime
+from sso.distribute import Distributor
 from sso.ssh import SSH
 from sso.util import run_parallel,log_important
 
@@ -16,14 +17,9 @@ class Fio:
     def __new_ssh(self, ip):
         return SSH(ip, self.ssh_user, self.ssh_options)
 
-    def __upload(self, ip, file):
-        ssh = self.__new_ssh(ip)
-        ssh.exec(f"mkdir -p {self.dir_name}")
-        ssh.scp_to_remote(file, self.dir_name)
-
-    def upload(self, file):
+    def upload(self, file, relay_fanout=None):
         log_important(f"Upload: started")
-        run_parallel(self.__upload, [(ip, file) for ip in self.ips])
+        Distributor(self.ips, self.ssh_user, self.ssh_options, relay_fanout=relay_fanout).distribute(file, self.dir_name)
         log_important(f"Upload-Stress: done")
 
     def __install(self, ip):
@@ -63,9 +59,9 @@ class Fio:
 
         print(f'    [{ip}] Downloading to [{dest_dir}]')
         ssh = self.__new_ssh(ip)
-        ssh.scp_from_remote(f'{self.dir_name}/*', dest_dir)
+        ssh.download(f'{self.dir_name}/*', dest_dir)
         if self.capture_lsblk:
-            self.__new_ssh(ip).scp_from_remote(f'lsblk.out', dest_dir)
+            ssh.download(f'lsblk.out', dest_dir)
 
         print(f'    [{ip}] Downloading to [{dest_dir}] done')
 
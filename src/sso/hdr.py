@@ -1,17 +1,107 @@
 import os
 import glob
 import csv
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from sso.util import find_java,log_important
 
+from sso import hdrhistogram
+from sso import steadystate
+
+
+def _trim_range(file, warmup_seconds, cooldown_seconds):
+    """
+    Returns the (start, end) offsets in seconds relative to the start time of the log to pass to
+    processor.jar, selecting the same intervals as HistogramLog.trim: the jar compares the start
+    of an interval with the range, while the cooldown is the last cooldown_seconds of the log.
+    Only the timestamps are read, so it doesn't require numpy.
+    """
+    log = hdrhistogram.read_log(file)
+    if not log.intervals:
+        return None, None
+    kept = log.trim(warmup_seconds, cooldown_seconds).intervals
+    if not kept:
+        # an empty range.
+        return 0.0, -1.0
+    return min(i.start for i in kept) - log.start_time - 0.0005, max(i.start for i in kept) - log.start_time + 0.0005
+
+
 class HdrLogProcessor:
     
-    def __init__(self, properties, warmup_seconds=None, cooldown_seconds=None):
+    def __init__(self, properties, warmup_seconds=None, cooldown_seconds=None, native=None, steady_state=False):
+        """
+        Parameters
+        ----------
+        native: bool
+            If True, the hdr files are processed in process instead of starting a JVM per
+            file. If None, native processing is used when numpy is available.
+        steady_state: bool
+            If True, the warmup and cooldown are detected per merged hdr file (see
+            steadystate.detect) instead of using warmup_seconds and cooldown_seconds. The
+            merged file is trimmed to the steady state and the detected bounds are written to
+            steady_state.csv. Requires native processing.
+        """
         self.properties = properties
-        self.java_path = find_java(self.properties)       
         self.warmup_seconds = warmup_seconds
         self.cooldown_seconds = cooldown_seconds
+        if native is None:
+            # without numpy the processing falls back to the HdrHistogram/processor jars.
+            native = hdrhistogram.has_numpy()
+        elif native and not hdrhistogram.has_numpy():
+            raise RuntimeError("Native hdr processing requires numpy")
+        if steady_state:
+            if not native:
+                raise RuntimeError("Steady state detection requires native hdr processing")
+            if warmup_seconds is not None or cooldown_seconds is not None:
+                raise RuntimeError("steady_state can't be combined with warmup_seconds/cooldown_seconds")
+        self.native = native
+        self.steady_state = steady_state
+        self.java_path = None if native else find_java(self.properties)
+
+    def __trim_native(self, file):
+        filename = os.path.basename(file)
+        filename_no_ext = os.path.splitext(filename)[0]
+        dir = os.path.dirname(os.path.realpath(file))
+        log = hdrhistogram.read_log(file)
+        log.trim(self.warmup_seconds, self.cooldown_seconds).write(os.path.join(dir, f"trimmed_{filename_no_ext}.hdr"))
+
+    def trim_steady_state(self, file):
+        """
+        Trims the file to its detected steady state into trimmed_<file>.
+
+        Returns
+        -------
+        The detected bounds (see steadystate.detect) or None if the file has no intervals.
+        """
+        filename_no_ext = os.path.splitext(os.path.basename(file))[0]
+        dir = os.path.dirname(os.path.realpath(file))
+        log = hdrhistogram.read_log(file)
+        bounds = steadystate.detect(log)
+        if bounds is None:
+            log.write(os.path.join(dir, f"trimmed_{filename_no_ext}.hdr"))
+            return None
+        log.trim(bounds['warmup_seconds'], bounds['cooldown_seconds']) \
+            .write(os.path.join(dir, f"trimmed_{filename_no_ext}.hdr"))
+        return bounds
+
+    def __write_steady_state(self, dir, bounds_by_file):
+        with open(os.path.join(dir, "steady_state.csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["file", "begin", "end", "warmup_seconds", "cooldown_seconds", "intervals",
+                             "change_points"])
+            for file, bounds in sorted(bounds_by_file.items()):
+                if bounds is None:
+                    continue
+                writer.writerow([os.path.basename(file), f"{bounds['begin']:.3f}", f"{bounds['end']:.3f}",
+                                 f"{bounds['warmup_seconds']:.3f}", f"{bounds['cooldown_seconds']:.3f}",
+                                 bounds['intervals'], " ".join(f"{p:.3f}" for p in bounds['change_points'])])
+                print(f"    [{os.path.basename(file)}] Steady state: warmup {bounds['warmup_seconds']:.0f}s, "
+                      f"cooldown {bounds['cooldown_seconds']:.0f}s")
+
+    def trim_file(self, file):
+        if self.native:
+            self.__trim_native(file)
+            return
 
-    def __trim(self, file):
         filename = os.path.basename(file)
         filename_no_ext = os.path.splitext(filename)[0]
         dir = os.path.dirname(os.path.realpath(file))
@@ -22,10 +112,11 @@ class HdrLogProcessor:
   
         lib_dir=f"{os.environ['SSO']}/lib/"     
         args = f'union -if {filename} -of trimmed_{filename_no_ext}.hdr'        
-        if self.warmup_seconds is not None:
-            args = f'{args} -start {self.warmup_seconds}'
-        if self.cooldown_seconds is not None:
-            args = f'{args} -end {self.cooldown_seconds}'
+        # the jar takes an end offset instead of a cooldown; the range is derived from the log so
+        # the window is the same as with native processing.
+        start, end = _trim_range(filename, self.warmup_seconds, self.cooldown_seconds)
+        if start is not None:
+            args = f'{args} -start {start:.4f} -end {end:.4f}'
             
         cmd = f'{self.java_path} -cp {lib_dir}/processor.jar CommandDispatcherMain {args}'
         print(cmd)
@@ -33,7 +124,7 @@ class HdrLogProcessor:
         os.chdir(old_cwd)
         
     def trim_recursivly(self, dir):
-        if self.warmup_seconds is None and self.warmup_seconds is None:
+        if self.warmup_seconds is None and self.cooldown_seconds is None:
             return
         
         log_important("HdrLogProcessor.trim_recursivly")
@@ -44,7 +135,7 @@ class HdrLogProcessor:
                 continue
             
             print(hdr_file)
-            self.__trim(hdr_file)
+            self.trim_file(hdr_file)
         
         log_important("HdrLogProcessor.trim_recursivly")
      
@@ -64,18 +155,35 @@ class HdrLogProcessor:
                 files_map[base] = files
             files.append(hdr_file)
 
-        lib_dir=f"{os.environ['SSO']}/lib/"    
         for name, files in files_map.items():
-            input = ""
-            for file in files:
-                input = input + " -ifp " + file
-            cmd = f'{self.java_path} -cp {lib_dir}/processor.jar CommandDispatcherMain union {input} -of {dir}/{name}.hdr'
-            print(cmd)
-            os.system(cmd)
+            self.merge_files(files, f'{dir}/{name}.hdr')
 
         log_important("HdrLogProcessor.merge_recursivly")
 
-    def __summarize(self, file):
+    def merge_files(self, files, output):
+        if self.native:
+            hdrhistogram.union([hdrhistogram.read_log(file) for file in files]).write(output)
+            return
+
+        lib_dir=f"{os.environ['SSO']}/lib/"    
+        input = ""
+        for file in files:
+            input = input + " -ifp " + file
+        cmd = f'{self.java_path} -cp {lib_dir}/processor.jar CommandDispatcherMain union {input} -of {output}'
+        print(cmd)
+        os.system(cmd)
+
+    def __summarize_native(self, file):
+        filename_no_ext = os.path.splitext(os.path.realpath(file))[0]
+        log = hdrhistogram.read_log(file)
+        with open(f'{filename_no_ext}-summary.txt', "w") as summary_file:
+            hdrhistogram.write_summary(summary_file, log)
+
+    def summarize_file(self, file):
+        if self.native:
+            self.__summarize_native(file)
+            return
+
         filename = os.path.basename(file)
         filename_no_ext = os.path.splitext(filename)[0]
         old_cwd = os.getcwd()
@@ -91,10 +199,25 @@ class HdrLogProcessor:
         log_important("HdrLogProcessor.summarize_recursivly")
         for hdr_file in glob.iglob(dir + '/**/*.hdr', recursive=True):
             print(hdr_file)
-            self.__summarize(hdr_file)
+            self.summarize_file(hdr_file)
         log_important("HdrLogProcessor.summarize_recursivly")
 
-    def __process(self, file):
+    def __process_native(self, file):
+        filename_no_ext = os.path.splitext(os.path.realpath(file))[0]
+        log = hdrhistogram.read_log(file)
+        for tag, tag_log in log.split_by_tag().items():
+            histogram = tag_log.total()
+            output = filename_no_ext if tag is None else f'{filename_no_ext}_{tag}'
+            with open(f'{output}.hgrm.csv', "w") as hgrm_file:
+                histogram.output_percentile_distribution(hgrm_file, csv=True)
+            with open(f'{output}.hgrm', "w") as hgrm_file:
+                histogram.output_percentile_distribution(hgrm_file)
+
+    def process_file(self, file):
+        if self.native:
+            self.__process_native(file)
+            return
+
         filename = os.path.basename(file)
         filename_no_ext = os.path.splitext(filename)[0]
         old_cwd = os.getcwd()
@@ -130,6 +253,88 @@ class HdrLogProcessor:
         log_important("HdrLogProcessor.summarize_recursivly")       
         for hdr_file in glob.iglob(dir + '/**/*.hdr', recursive=True):
             print(hdr_file)
-            self.__process(hdr_file)
+            self.process_file(hdr_file)
         log_important("HdrLogProcessor.summarize_recursivly")
        
+
+    def process_all(self, dir, max_workers=None):
+        """
+        Trims, merges, processes and summarizes all hdr files in the download directory
+        (one subdirectory per load generator). The dependencies between the files are
+        determined once and independent steps are executed on a process pool.
+
+        Parameters
+        ----------
+        dir: str
+            The download directory.
+        max_workers: int
+            The maximum number of processes. Defaults to the number of cores.
+        """
+        log_important("HdrLogProcessor.process_all: started")
+        trim = self.warmup_seconds is not None or self.cooldown_seconds is not None
+
+        # task name -> (function, args, dependencies)
+        tasks = {}
+        merge_inputs = {}
+        for hdr_file in sorted(glob.glob(dir + '/*/*.hdr')):
+            filename = os.path.basename(hdr_file)
+            if filename.startswith("trimmed_"):
+                continue
+            name = os.path.splitext(filename)[0]
+            merge_inputs.setdefault(name, []).append((hdr_file, None))
+            if trim:
+                trimmed_file = os.path.join(os.path.dirname(hdr_file), f"trimmed_{name}.hdr")
+                tasks[trimmed_file] = (self.trim_file, (hdr_file,), [])
+                merge_inputs.setdefault(f"trimmed_{name}", []).append((trimmed_file, trimmed_file))
+
+        for name, inputs in merge_inputs.items():
+            files = [file for file, _ in inputs]
+            output = f'{dir}/{name}.hdr'
+            producers = [task for _, task in inputs if task is not None]
+            # e.g. the merged file was already created while streaming the hdr files.
+            if not producers and os.path.exists(output) \
+                    and all(os.path.getmtime(output) >= os.path.getmtime(file) for file in files):
+                continue
+            tasks[output] = (self.merge_files, (files, output), producers)
+
+        for name, inputs in merge_inputs.items():
+            for file, producer in inputs + [(f'{dir}/{name}.hdr', f'{dir}/{name}.hdr')]:
+                dependencies = [] if producer is None or producer not in tasks else [producer]
+                tasks[f'process {file}'] = (self.process_file, (file,), dependencies)
+                tasks[f'summarize {file}'] = (self.summarize_file, (file,), dependencies)
+
+        # the steady state is detected on the merged files, so the bounds are the same for all
+        # load generators.
+        steady_state_tasks = []
+        if self.steady_state:
+            for name in list(merge_inputs):
+                merged_file = f'{dir}/{name}.hdr'
+                trimmed_file = f'{dir}/trimmed_{name}.hdr'
+                dependencies = [merged_file] if merged_file in tasks else []
+                tasks[trimmed_file] = (self.trim_steady_state, (merged_file,), dependencies)
+                tasks[f'process {trimmed_file}'] = (self.process_file, (trimmed_file,), [trimmed_file])
+                tasks[f'summarize {trimmed_file}'] = (self.summarize_file, (trimmed_file,), [trimmed_file])
+                steady_state_tasks.append((merged_file, trimmed_file))
+
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            completed = {}
+            running = {}
+            while len(completed) < len(tasks):
+                for name, (function, args, dependencies) in tasks.items():
+                    if name in completed or name in running.values():
+                        continue
+                    if all(d in completed for d in dependencies):
+                        print(name)
+                        running[executor.submit(function, *args)] = name
+
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    # raises the exception of the task if it failed.
+                    completed[running.pop(future)] = future.result()
+
+        if self.steady_state:
+            self.__write_steady_state(dir, {merged_file: completed[trimmed_file]
+                                            for merged_file, trimmed_file in steady_state_tasks})
+        log_important("HdrLogProcessor.process_all: done")
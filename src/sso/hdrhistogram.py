@@ -0,0 +1,610 @@
+import base64
+import decimal
+import heapq
+import importlib.util
+import math
+import struct
+import time
+import zlib
+
+# Native (in process) support for the HdrHistogram log format as written by cassandra-stress
+# (-log hdrfile=...). This avoids starting a JVM per file/tag when processing the results.
+# The encoding follows HdrHistogram 2.1.x: V2 compressed histograms, ZigZag LEB128 counts.
+# numpy is only needed for the histograms themselves; it's imported on first use (see
+# _import_numpy), so the parsing of the logs (LogParser, read_log, trim) works without it.
+np = None
+
+V2_ENCODING_COOKIE = 0x1c849303
+V2_COMPRESSED_ENCODING_COOKIE = 0x1c849304
+ENCODING_HEADER_SIZE = 40
+LOG_FORMAT_VERSION = "1.3"
+LOG_LEGEND = '"StartTimestamp","Interval_Length","Interval_Max","Interval_Compressed_Histogram"'
+
+# cassandra-stress records in nanoseconds, the reports are in milliseconds.
+DEFAULT_VALUE_UNIT_RATIO = 1000000.0
+
+# Timestamps below this are considered relative to the StartTime of the log (same rule as the
+# Java HistogramLogReader).
+REASONABLE_ABSOLUTE_TIME = 365 * 24 * 3600.0
+
+SUMMARY_PERCENTILES = [50.0, 90.0, 99.0, 99.9, 99.99, 99.999]
+
+
+def has_numpy():
+    """
+    Returns True if numpy is installed, so the histograms can be decoded.
+    """
+    return np is not None or importlib.util.find_spec("numpy") is not None
+
+
+def _import_numpy():
+    global np
+    if np is None:
+        import numpy as np
+
+
+def _cookie_base(cookie):
+    return cookie & ~0xf0
+
+
+class Layout:
+    """
+    The bucket layout of a histogram. Histograms with the same layout (or the same sub bucket
+    configuration) can be added by simply adding the counts arrays.
+    """
+
+    __cache = {}
+
+    def __init__(self, lowest_discernible_value, highest_trackable_value, significant_digits):
+        # every histogram has a layout, so this is where numpy is needed first.
+        _import_numpy()
+        self.lowest_discernible_value = lowest_discernible_value
+        self.highest_trackable_value = highest_trackable_value
+        self.significant_digits = significant_digits
+
+        largest_value_with_single_unit_resolution = 2 * (10 ** significant_digits)
+        sub_bucket_count_magnitude = int(math.ceil(math.log2(largest_value_with_single_unit_resolution)))
+        self.sub_bucket_half_count_magnitude = max(sub_bucket_count_magnitude, 1) - 1
+        self.unit_magnitude = int(math.floor(math.log2(lowest_discernible_value)))
+        self.sub_bucket_count = 1 << (self.sub_bucket_half_count_magnitude + 1)
+        self.sub_bucket_half_count = self.sub_bucket_count // 2
+
+        smallest_untrackable_value = self.sub_bucket_count << self.unit_magnitude
+        buckets_needed = 1
+        while smallest_untrackable_value <= highest_trackable_value:
+            if smallest_untrackable_value > (2 ** 63 - 1) // 2:
+                buckets_needed += 1
+                break
+            smallest_untrackable_value <<= 1
+            buckets_needed += 1
+        self.bucket_count = buckets_needed
+        self.counts_len = (self.bucket_count + 1) * self.sub_bucket_half_count
+
+        index = np.arange(self.counts_len, dtype=np.int64)
+        bucket = (index >> self.sub_bucket_half_count_magnitude) - 1
+        sub_bucket = (index & (self.sub_bucket_half_count - 1)) + self.sub_bucket_half_count
+        first_bucket = bucket < 0
+        sub_bucket[first_bucket] -= self.sub_bucket_half_count
+        bucket[first_bucket] = 0
+        shift = bucket + self.unit_magnitude
+        size = np.left_shift(np.int64(1), shift)
+        self.lowest_equivalent = np.left_shift(sub_bucket, shift)
+        self.highest_equivalent = self.lowest_equivalent + size - 1
+        self.median_equivalent = self.lowest_equivalent + (size >> 1)
+
+    def sub_bucket_key(self):
+        return self.unit_magnitude, self.sub_bucket_half_count_magnitude
+
+    def index_of(self, value):
+        value = int(value)
+        bucket = 64 - self.unit_magnitude - self.sub_bucket_half_count_magnitude - 1 \
+                 - (64 - ((value | ((self.sub_bucket_count - 1) << self.unit_magnitude)).bit_length()))
+        sub_bucket = value >> (bucket + self.unit_magnitude)
+        return ((bucket + 1) << self.sub_bucket_half_count_magnitude) + sub_bucket - self.sub_bucket_half_count
+
+    @staticmethod
+    def get(lowest_discernible_value, highest_trackable_value, significant_digits):
+        key = (lowest_discernible_value, highest_trackable_value, significant_digits)
+        layout = Layout.__cache.get(key)
+        if layout is None:
+            layout = Layout(lowest_discernible_value, highest_trackable_value, significant_digits)
+            Layout.__cache[key] = layout
+        return layout
+
+
+def _decode_zigzag_leb128(payload):
+    data = np.frombuffer(payload, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    if len(ends) == 0 or ends[-1] != len(data) - 1:
+        return _decode_zigzag_leb128_slow(payload)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    if lengths.max() > 8:
+        # 9 byte values are very rare; decode them the slow way.
+        return _decode_zigzag_leb128_slow(payload)
+
+    positions = np.arange(len(data), dtype=np.int64) - np.repeat(starts, lengths)
+    shifted = (data & 0x7f).astype(np.uint64) << (positions * 7).astype(np.uint64)
+    raw = np.add.reduceat(shifted, starts)
+    return (raw >> np.uint64(1)).astype(np.int64) ^ -(raw & np.uint64(1)).astype(np.int64)
+
+
+def _decode_zigzag_leb128_slow(payload):
+    values = []
+    i = 0
+    n = len(payload)
+    while i < n:
+        raw = 0
+        shift = 0
+        while True:
+            b = payload[i]
+            i += 1
+            if shift == 56:
+                # the 9th byte carries a full 8 bits.
+                raw |= b << 56
+                break
+            raw |= (b & 0x7f) << shift
+            shift += 7
+            if b < 0x80:
+                break
+        values.append((raw >> 1) ^ -(raw & 1))
+    return np.array(values, dtype=np.int64)
+
+
+def _encode_zigzag_leb128(values, out):
+    for value in values:
+        raw = ((value << 1) ^ (value >> 63)) & 0xffffffffffffffff
+        for _ in range(8):
+            if raw < 0x80:
+                out.append(raw)
+                break
+            out.append((raw & 0x7f) | 0x80)
+            raw >>= 7
+        else:
+            out.append(raw & 0xff)
+
+
+class Histogram:
+
+    def __init__(self, layout, counts=None):
+        self.layout = layout
+        if counts is None:
+            counts = np.zeros(layout.counts_len, dtype=np.int64)
+        self.counts = counts
+
+    @staticmethod
+    def create(lowest_discernible_value=1, highest_trackable_value=86400 * 1000 * 1000 * 1000, significant_digits=3):
+        return Histogram(Layout.get(lowest_discernible_value, highest_trackable_value, significant_digits))
+
+    @staticmethod
+    def decode(data):
+        _import_numpy()
+        cookie, length = struct.unpack_from(">ii", data, 0)
+        if _cookie_base(cookie) == V2_COMPRESSED_ENCODING_COOKIE:
+            data = zlib.decompress(data[8:8 + length])
+            cookie, = struct.unpack_from(">i", data, 0)
+
+        if _cookie_base(cookie) != V2_ENCODING_COOKIE:
+            raise ValueError(f"Unsupported histogram encoding, cookie={hex(cookie)}")
+
+        _, payload_length, normalizing_index_offset, digits, lowest, highest, _ \
+            = struct.unpack_from(">iiiiqqd", data, 0)
+        if normalizing_index_offset != 0:
+            raise ValueError("Shifted histograms (normalizing index offset != 0) are not supported")
+
+        layout = Layout.get(lowest, highest, digits)
+        values = _decode_zigzag_leb128(data[ENCODING_HEADER_SIZE:ENCODING_HEADER_SIZE + payload_length])
+        # negative values are a run of zero counts.
+        widths = np.where(values < 0, -values, 1)
+        positions = np.cumsum(widths) - widths
+        non_zero = values > 0
+        counts = np.zeros(layout.counts_len, dtype=np.int64)
+        counts[positions[non_zero]] = values[non_zero]
+        return Histogram(layout, counts)
+
+    @staticmethod
+    def decode_base64(text):
+        return Histogram.decode(base64.b64decode(text))
+
+    def encode(self):
+        layout = self.layout
+        non_zero = np.flatnonzero(self.counts)
+        payload = bytearray()
+        if len(non_zero) > 0:
+            values = []
+            previous = -1
+            for index in non_zero.tolist():
+                zeros = index - previous - 1
+                if zeros == 1:
+                    values.append(0)
+                elif zeros > 1:
+                    values.append(-zeros)
+                values.append(int(self.counts[index]))
+                previous = index
+            _encode_zigzag_leb128(values, payload)
+
+        header = struct.pack(">iiiiqqd", V2_ENCODING_COOKIE | 0x10, len(payload), 0,
+                             layout.significant_digits, layout.lowest_discernible_value,
+                             layout.highest_trackable_value, 1.0)
+        compressed = zlib.compress(header + payload)
+        return struct.pack(">ii", V2_COMPRESSED_ENCODING_COOKIE | 0x10, len(compressed)) + compressed
+
+    def encode_base64(self):
+        return base64.b64encode(self.encode()).decode("ascii")
+
+    def copy(self):
+        return Histogram(self.layout, self.counts.copy())
+
+    def add(self, other):
+        if other.layout.sub_bucket_key() == self.layout.sub_bucket_key():
+            # same index scheme; only the number of buckets can differ.
+            if other.layout.counts_len > self.layout.counts_len:
+                self.counts = np.concatenate(
+                    [self.counts, np.zeros(other.layout.counts_len - self.layout.counts_len, dtype=np.int64)])
+                self.layout = other.layout
+            self.counts[:other.layout.counts_len] += other.counts
+            return
+
+        # different resolution; re-record every value of the other histogram.
+        for index in np.flatnonzero(other.counts).tolist():
+            self.record(int(other.layout.lowest_equivalent[index]), int(other.counts[index]))
+
+    def record(self, value, count=1):
+        index = self.layout.index_of(value)
+        if index >= self.layout.counts_len:
+            raise ValueError(f"Value {value} is outside of the trackable range of the histogram")
+        self.counts[index] += count
+
+    def total_count(self):
+        return int(self.counts.sum())
+
+    def min(self):
+        non_zero = np.flatnonzero(self.counts)
+        if len(non_zero) == 0:
+            return 0
+        return int(self.layout.lowest_equivalent[non_zero[0]])
+
+    def max(self):
+        non_zero = np.flatnonzero(self.counts)
+        if len(non_zero) == 0:
+            return 0
+        return int(self.layout.highest_equivalent[non_zero[-1]])
+
+    def mean(self):
+        total = self.total_count()
+        if total == 0:
+            return 0.0
+        return float(np.dot(self.layout.median_equivalent[:len(self.counts)].astype(np.float64), self.counts) / total)
+
+    def stddev(self):
+        total = self.total_count()
+        if total == 0:
+            return 0.0
+        deviation = self.layout.median_equivalent[:len(self.counts)] - self.mean()
+        return math.sqrt(float(np.dot(deviation * deviation, self.counts)) / total)
+
+    def value_at_percentile(self, percentile):
+        total = self.total_count()
+        if total == 0:
+            return 0
+        percentile = min(max(percentile, 0.0), 100.0)
+        count_at_percentile = max(int((percentile / 100.0) * total + 0.5), 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), count_at_percentile))
+        if percentile == 0.0:
+            return int(self.layout.lowest_equivalent[index])
+        return int(self.layout.highest_equivalent[index])
+
+    def percentile_distribution(self, ticks_per_half_distance=5):
+        """
+        Returns the (value, percentile, total_count) rows in the same way as the Java
+        PercentileIterator does; so the output matches the HistogramLogProcessor output.
+        """
+        total = self.total_count()
+        rows = []
+        if total == 0:
+            return rows
+
+        non_zero = np.flatnonzero(self.counts)
+        cumulative = np.cumsum(self.counts[non_zero])
+        level = 0.0
+        value = 0
+        for index, total_to_index in zip(non_zero.tolist(), cumulative.tolist()):
+            value = int(self.layout.highest_equivalent[index])
+            while (100.0 * total_to_index) / total >= level:
+                rows.append((value, level, total_to_index))
+                ticks = ticks_per_half_distance * (2 ** (int(math.log2(100.0 / (100.0 - level))) + 1))
+                level += 100.0 / ticks
+                if total_to_index >= total:
+                    break
+        rows.append((value, 100.0, total))
+        return rows
+
+    def output_percentile_distribution(self, out, value_unit_ratio=DEFAULT_VALUE_UNIT_RATIO, csv=False):
+        digits = self.layout.significant_digits
+        rows = self.percentile_distribution()
+        if csv:
+            out.write('"Value","Percentile","TotalCount","1/(1-Percentile)"\n')
+            for value, percentile, count in rows:
+                if percentile != 100.0:
+                    out.write(f"{value / value_unit_ratio:.{digits}f},{percentile / 100.0:.12f},{count},"
+                              f"{1.0 / (1.0 - percentile / 100.0):.2f}\n")
+                else:
+                    out.write(f"{value / value_unit_ratio:.{digits}f},{percentile / 100.0:.12f},{count},Infinity\n")
+            return
+
+        out.write(f"{'Value':>12} {'Percentile':>14} {'TotalCount':>10} {'1/(1-Percentile)':>14}\n\n")
+        for value, percentile, count in rows:
+            if percentile != 100.0:
+                out.write(f"{value / value_unit_ratio:12.{digits}f} {percentile / 100.0:2.12f} {count:10d} "
+                          f"{1.0 / (1.0 - percentile / 100.0):14.2f}\n")
+            else:
+                out.write(f"{value / value_unit_ratio:12.{digits}f} {percentile / 100.0:2.12f} {count:10d}\n")
+
+        out.write(f"#[Mean    = {self.mean() / value_unit_ratio:12.{digits}f}, "
+                  f"StdDeviation   = {self.stddev() / value_unit_ratio:12.{digits}f}]\n")
+        out.write(f"#[Max     = {self.max() / value_unit_ratio:12.{digits}f}, "
+                  f"Total count    = {self.total_count():12d}]\n")
+        out.write(f"#[Buckets = {self.layout.bucket_count:12d}, "
+                  f"SubBuckets     = {self.layout.sub_bucket_count:12d}]\n")
+
+
+class Interval:
+    """
+    A single line of a histogram log. The histogram is decoded lazily, so operations that
+    only look at the timestamps (e.g. trimming) don't pay for the decoding.
+    """
+
+    def __init__(self, tag, start, length, max, encoded=None, histogram=None):
+        self.tag = tag
+        # absolute start time in seconds since epoch.
+        self.start = start
+        self.length = length
+        # the max as written in the log (so already divided by the value unit ratio).
+        self.max = max
+        self.encoded = encoded
+        self.__histogram = histogram
+
+    @property
+    def end(self):
+        return self.start + self.length
+
+    def histogram(self):
+        if self.__histogram is None:
+            self.__histogram = Histogram.decode_base64(self.encoded)
+        return self.__histogram
+
+
+class HistogramLog:
+
+    def __init__(self, start_time=None, intervals=None):
+        self.start_time = start_time
+        self.intervals = intervals if intervals is not None else []
+
+    def tags(self):
+        return sorted({interval.tag for interval in self.intervals}, key=lambda t: "" if t is None else t)
+
+    def time_range(self):
+        if not self.intervals:
+            return None, None
+        return min(i.start for i in self.intervals), max(i.end for i in self.intervals)
+
+    def trim(self, warmup_seconds=None, cooldown_seconds=None):
+        """
+        Returns a new log where the first warmup_seconds and the last cooldown_seconds of the
+        log are removed.
+        """
+        begin, end = self.time_range()
+        if begin is None:
+            return HistogramLog(self.start_time, [])
+        if warmup_seconds is not None:
+            begin = begin + warmup_seconds
+        if cooldown_seconds is not None:
+            end = end - cooldown_seconds
+        # small epsilon so that rounding of the timestamps in the log doesn't drop an interval.
+        intervals = [i for i in self.intervals if i.start >= begin - 0.0005 and i.end <= end + 0.0005]
+        return HistogramLog(self.start_time, intervals)
+
+    def split_by_tag(self):
+        result = {}
+        for interval in self.intervals:
+            result.setdefault(interval.tag, []).append(interval)
+        return {tag: HistogramLog(self.start_time, intervals) for tag, intervals in result.items()}
+
+    def total(self, tag=None):
+        """
+        Returns the accumulated histogram over all intervals (with the given tag) or None if
+        there are no intervals.
+        """
+        result = None
+        for interval in self.intervals:
+            if tag is not None and interval.tag != tag:
+                continue
+            if result is None:
+                result = interval.histogram().copy()
+            else:
+                result.add(interval.histogram())
+        return result
+
+    def write(self, path, value_unit_ratio=DEFAULT_VALUE_UNIT_RATIO):
+        start_time = self.start_time
+        if start_time is None:
+            start_time, _ = self.time_range()
+        if start_time is None:
+            start_time = time.time()
+
+        with open(path, "w") as f:
+            f.write(f"#[Histogram log format version {LOG_FORMAT_VERSION}]\n")
+            date = time.strftime("%a %b %d %H:%M:%S %Z %Y", time.localtime(start_time))
+            f.write(f"#[StartTime: {start_time:.3f} (seconds since epoch), {date}]\n")
+            f.write(f"#[BaseTime: {start_time:.3f} (seconds since epoch)]\n")
+            f.write(LOG_LEGEND + "\n")
+            for interval in self.intervals:
+                encoded = interval.encoded
+                if encoded is None:
+                    encoded = interval.histogram().encode_base64()
+                    max = interval.histogram().max() / value_unit_ratio
+                else:
+                    max = interval.max
+                prefix = "" if interval.tag is None else f"Tag={interval.tag},"
+                f.write(f"{prefix}{interval.start - start_time:.3f},{interval.length:.3f},{max:.3f},{encoded}\n")
+
+
+class LogParser:
+    """
+    Parses a histogram log line by line; so it can also be used on a log that is still being
+    written (e.g. tailed from a load generator).
+    """
+
+    def __init__(self):
+        self.start_time = None
+        self.base_time = None
+
+    def parse(self, line):
+        """
+        Returns the Interval for the line or None if the line isn't an interval line.
+        """
+        line = line.strip()
+        if not line:
+            return None
+        if line.startswith("#"):
+            if line.startswith("#[StartTime: "):
+                self.start_time = float(line[len("#[StartTime: "):].split(" ")[0])
+            elif line.startswith("#[BaseTime: "):
+                self.base_time = float(line[len("#[BaseTime: "):].split(" ")[0])
+            return None
+        if line.startswith('"StartTimestamp"'):
+            return None
+
+        columns = line.split(",")
+        tag = None
+        if columns[0].startswith("Tag="):
+            tag = columns[0][4:]
+            columns = columns[1:]
+        if len(columns) < 4:
+            # a partially written line (e.g. the log is still being written to).
+            return None
+
+        timestamp = float(columns[0])
+        if self.base_time is None:
+            if self.start_time is not None and timestamp < REASONABLE_ABSOLUTE_TIME:
+                self.base_time = self.start_time
+            else:
+                self.base_time = 0.0
+        return Interval(tag, self.base_time + timestamp, float(columns[1]), float(columns[2]), encoded=columns[3])
+
+
+def read_log(path):
+    parser = LogParser()
+    intervals = []
+    with open(path, "r") as f:
+        for line in f:
+            interval = parser.parse(line)
+            if interval is not None:
+                intervals.append(interval)
+
+    start_time = parser.start_time
+    if start_time is None and intervals:
+        start_time = intervals[0].start
+    return HistogramLog(start_time, intervals)
+
+
+def slot_of(start, base_time, interval_seconds):
+    # small epsilon so that rounding of the timestamps in the log doesn't move an interval.
+    return int((start - base_time + 0.0005) // interval_seconds)
+
+
+def union(logs, interval_seconds=None):
+    """
+    Merges the logs (e.g. from different load generators) into a single log. Intervals are
+    aligned on wall clock time; all intervals of the same tag starting in the same time slot
+    are added.
+    """
+    logs = [log for log in logs if log.intervals]
+    if not logs:
+        return HistogramLog()
+
+    base_time = min(log.time_range()[0] for log in logs)
+    if interval_seconds is None:
+        lengths = sorted(i.length for i in logs[0].intervals)
+        interval_seconds = max(round(lengths[len(lengths) // 2], 3), 0.001)
+
+    def slotted(log):
+        for interval in log.intervals:
+            yield slot_of(interval.start, base_time, interval_seconds), \
+                  "" if interval.tag is None else interval.tag, interval
+
+    # the logs are ordered by time, so they can be merged without holding all histograms.
+    merged = []
+    current_key = None
+    current = None
+    key = lambda x: (x[0], x[1])
+    for slot, tag, interval in heapq.merge(*[sorted(slotted(log), key=key) for log in logs], key=key):
+        if (slot, tag) != current_key:
+            if current is not None:
+                merged.append(current)
+            current_key = (slot, tag)
+            current = Interval(interval.tag, base_time + slot * interval_seconds, interval_seconds, None,
+                               histogram=interval.histogram().copy())
+        else:
+            current.histogram().add(interval.histogram())
+    if current is not None:
+        merged.append(current)
+    merged.sort(key=lambda i: (i.start, "" if i.tag is None else i.tag))
+    return HistogramLog(base_time, merged)
+
+
+def response_time_tags(tags):
+    """
+    Returns the tags that should be used for the latency. With a fixed rate, cassandra-stress
+    logs every operation twice: corrected for coordinated omission (-rt, response time) and
+    not corrected (-st, service time); the response time is the one that matters.
+    """
+    rt_tags = [tag for tag in tags if tag is not None and tag.endswith("-rt")]
+    return rt_tags if rt_tags else list(tags)
+
+
+def _java_format_2f(value):
+    # String.format("%.2f"): rounds half up on the shortest decimal representation.
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "Infinity" if value > 0 else "-Infinity"
+    return str(decimal.Decimal(repr(value)).quantize(decimal.Decimal("0.01"), rounding=decimal.ROUND_HALF_UP))
+
+
+def write_summary(out, log, value_unit_ratio=1.0):
+    """
+    Writes the summary in the same layout as 'processor.jar summarize' (the default
+    percentiles summary type), so the summaries are the same with or without numpy. Per tag
+    (prefixed with '<tag>.') the count, period, throughput and the latency statistics; the
+    period is the longest time range of the tags in ms. Like the jar, the values are in the
+    unit of the log (nanoseconds for cassandra-stress) unless a value_unit_ratio is given.
+    """
+    tag_logs = log.split_by_tag()
+    period = 0
+    for tag_log in tag_logs.values():
+        begin = min(int(interval.start * 1000.0) for interval in tag_log.intervals)
+        end = max(int(interval.end * 1000.0) for interval in tag_log.intervals)
+        period = max(period, end - begin)
+
+    for tag, tag_log in sorted(tag_logs.items(), key=lambda x: "" if x[0] is None else x[0]):
+        histogram = tag_log.total()
+        prefix = "" if tag is None else f"{tag}."
+        total = histogram.total_count()
+        if period > 0:
+            throughput = total * 1000.0 / period
+        else:
+            throughput = math.inf if total > 0 else math.nan
+        out.write(f"{prefix}TotalCount={total}\n")
+        out.write(f"{prefix}Period(ms)={period}\n")
+        out.write(f"{prefix}Throughput(ops/sec)={_java_format_2f(throughput)}\n")
+        out.write(f"{prefix}Min={int(histogram.min() / value_unit_ratio)}\n")
+        out.write(f"{prefix}Mean={_java_format_2f(histogram.mean() / value_unit_ratio)}\n")
+        out.write(f"{prefix}StdDev={_java_format_2f(histogram.stddev() / value_unit_ratio)}\n")
+        for percentile in SUMMARY_PERCENTILES:
+            out.write(f"{prefix}{percentile:.3f}ptile={int(histogram.value_at_percentile(percentile) / value_unit_ratio)}\n")
+        out.write(f"{prefix}Max={int(histogram.max() / value_unit_ratio)}\n")
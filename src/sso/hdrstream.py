@@ -0,0 +1,240 @@
+import os
+import time
+from datetime import datetime
+from threading import Thread, Lock, Event
+
+from sso.ssh import SSH
+from sso.util import log_important
+from sso import hdrhistogram
+
+ARMED_MARKER = "sso-hdr-stream-armed"
+
+
+class HdrStream:
+    """
+    Tails the hdr file of cassandra-stress on every load generator while the benchmark is
+    running and merges the intervals on the fly. Every interval the cluster wide throughput
+    and latencies are printed and once the benchmark is done, the merged log is available
+    without downloading and merging the hdr files.
+    """
+
+    def __init__(self, load_ips, ssh_user, ssh_options, hdr_file, interval_seconds=1.0, print_intervals=True):
+        if not hdrhistogram.has_numpy():
+            raise Exception("Streaming hdr files requires numpy")
+        self.load_ips = load_ips
+        self.ssh_user = ssh_user
+        self.ssh_options = ssh_options
+        self.hdr_file = hdr_file
+        self.interval_seconds = interval_seconds
+        self.print_intervals = print_intervals
+        self.base_time = None
+        self.__lock = Lock()
+        self.__stopped = Event()
+        # the raw lines per load generator; so the original hdr files can be written.
+        self.__lines = {ip: [] for ip in load_ips}
+        self.__last_line_time = {ip: 0.0 for ip in load_ips}
+        # slot -> tag -> merged interval
+        self.__slots = {}
+        # slot -> ip -> tag -> count
+        self.__counts = {}
+        self.__printed_slot = -1
+        self.__processes = {}
+        self.__threads = []
+
+    def __new_ssh(self, ip):
+        return SSH(ip, self.ssh_user, self.ssh_options)
+
+    def __tail(self, ip, process, armed):
+        parser = hdrhistogram.LogParser()
+        for line in process.stdout:
+            if not armed.is_set():
+                if line.strip() == ARMED_MARKER:
+                    armed.set()
+                continue
+
+            interval = parser.parse(line)
+            with self.__lock:
+                self.__lines[ip].append(line)
+                self.__last_line_time[ip] = time.time()
+                if interval is not None:
+                    self.__add(ip, interval)
+        armed.set()
+
+    def __add(self, ip, interval):
+        slot = hdrhistogram.slot_of(interval.start, self.base_time, self.interval_seconds)
+        counts = self.__counts.setdefault(slot, {}).setdefault(ip, {})
+        counts[interval.tag] = counts.get(interval.tag, 0) + interval.histogram().total_count()
+        tags = self.__slots.setdefault(slot, {})
+        merged = tags.get(interval.tag)
+        if merged is None:
+            tags[interval.tag] = hdrhistogram.Interval(
+                interval.tag, self.base_time + slot * self.interval_seconds, self.interval_seconds, None,
+                histogram=interval.histogram().copy())
+        else:
+            merged.histogram().add(interval.histogram())
+
+    def start(self):
+        log_important(f"HdrStream [{self.hdr_file}]: started")
+        self.base_time = time.time()
+        armed_events = []
+        for ip in self.load_ips:
+            # The old file is removed first so that its content isn't streamed. The marker is used
+            # to wait till that happened, before the benchmark is started.
+            process = self.__new_ssh(ip).popen(
+                f"rm -f {self.hdr_file}; echo {ARMED_MARKER}; tail -F -n +1 {self.hdr_file} 2>/dev/null")
+            self.__processes[ip] = process
+            armed = Event()
+            armed_events.append(armed)
+            thread = Thread(target=self.__tail, args=(ip, process, armed), daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+        for armed in armed_events:
+            armed.wait()
+
+        if self.print_intervals:
+            thread = Thread(target=self.__report, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def __report(self):
+        while not self.__stopped.wait(self.interval_seconds):
+            self.__print_slots(self.completed_slot())
+
+    def completed_slot(self):
+        """
+        Returns the last slot (interval) that every load generator had a chance to write.
+        """
+        return hdrhistogram.slot_of(time.time(), self.base_time, self.interval_seconds) - 2
+
+    def slot_summary(self, slot):
+        """
+        Returns the merged histogram of the slot and the number of operations per load generator,
+        both for the response time tags (see hdrhistogram.response_time_tags). The histogram is
+        None if there is no data for the slot.
+        """
+        with self.__lock:
+            tags = hdrhistogram.response_time_tags(self.__slots.get(slot, {}).keys())
+            histogram = None
+            for tag in tags:
+                if histogram is None:
+                    histogram = self.__slots[slot][tag].histogram().copy()
+                else:
+                    histogram.add(self.__slots[slot][tag].histogram())
+            counts = self.__counts.get(slot, {})
+            ops = {ip: sum(counts.get(ip, {}).get(tag, 0) for tag in tags) for ip in self.load_ips}
+        return histogram, ops
+
+    def __print_slots(self, last_slot):
+        with self.__lock:
+            slots = sorted(s for s in self.__slots.keys() if self.__printed_slot < s <= last_slot)
+            for slot in slots:
+                for tag, interval in sorted(self.__slots[slot].items(), key=lambda x: "" if x[0] is None else x[0]):
+                    histogram = interval.histogram()
+                    dt = datetime.fromtimestamp(interval.start).strftime("%H:%M:%S")
+                    ratio = hdrhistogram.DEFAULT_VALUE_UNIT_RATIO
+                    print(f"[{dt}] {tag if tag is not None else '':<12} "
+                          f"ops/s={histogram.total_count() / interval.length:>10.0f} "
+                          f"p50={histogram.value_at_percentile(50) / ratio:.3f}ms "
+                          f"p99={histogram.value_at_percentile(99) / ratio:.3f}ms "
+                          f"p99.9={histogram.value_at_percentile(99.9) / ratio:.3f}ms "
+                          f"max={histogram.max() / ratio:.3f}ms")
+                self.__printed_slot = slot
+
+    def stop(self, idle_seconds=2, timeout_seconds=30):
+        """
+        Stops the streaming. Waits till the load generators haven't written to the hdr file for
+        idle_seconds, so the final intervals are included.
+        """
+        stop_time = time.time()
+        deadline = stop_time + timeout_seconds
+        while time.time() < deadline:
+            with self.__lock:
+                last_line_time = max([stop_time] + list(self.__last_line_time.values()))
+            if time.time() - last_line_time >= idle_seconds:
+                break
+            time.sleep(0.1)
+
+        self.__stopped.set()
+        for ip, process in self.__processes.items():
+            process.terminate()
+            # the remote tail doesn't get terminated when the ssh connection is closed.
+            self.__new_ssh(ip).exec(f"pkill -f \"tail -F -n [+]1 {self.hdr_file}\"", ignore_errors=True)
+        for thread in self.__threads:
+            thread.join()
+        if self.print_intervals:
+            self.__print_slots(max(self.__slots.keys(), default=-1))
+        log_important(f"HdrStream [{self.hdr_file}]: done")
+
+    def log(self):
+        """
+        Returns the merged log of all load generators.
+        """
+        with self.__lock:
+            intervals = [interval for slot in sorted(self.__slots.keys())
+                         for _, interval in sorted(self.__slots[slot].items(),
+                                                   key=lambda x: "" if x[0] is None else x[0])]
+        if not intervals:
+            return hdrhistogram.HistogramLog()
+        return hdrhistogram.HistogramLog(intervals[0].start, intervals)
+
+    def logs(self):
+        """
+        Returns the log of every load generator (ip -> HistogramLog).
+        """
+        with self.__lock:
+            lines = {ip: list(ip_lines) for ip, ip_lines in self.__lines.items()}
+        logs = {}
+        for ip, ip_lines in lines.items():
+            parser = hdrhistogram.LogParser()
+            intervals = [interval for interval in map(parser.parse, ip_lines) if interval is not None]
+            start_time = parser.start_time
+            if start_time is None and intervals:
+                start_time = intervals[0].start
+            logs[ip] = hdrhistogram.HistogramLog(start_time, intervals)
+        return logs
+
+    def write(self, dir):
+        """
+        Writes the hdr file of every load generator to dir/<ip>/ and the merged hdr file to dir.
+        """
+        filename = os.path.basename(self.hdr_file)
+        with self.__lock:
+            for ip, lines in self.__lines.items():
+                ip_dir = os.path.join(dir, ip)
+                os.makedirs(ip_dir, exist_ok=True)
+                with open(os.path.join(ip_dir, filename), "w") as f:
+                    f.writelines(lines)
+        # written last, so the merged file is newer than its inputs.
+        self.log().write(os.path.join(dir, filename))
+
+
+def write_all(hdr_streams, dir):
+    """
+    Writes the hdr files of the streams to dir (see HdrStream.write). Streams of the same hdr
+    file (e.g. successive stress runs) are combined: the intervals of all streams are written
+    to the file of each load generator and the merged file is the union of the streams.
+    """
+    by_file = {}
+    for hdr_stream in hdr_streams:
+        by_file.setdefault(os.path.basename(hdr_stream.hdr_file), []).append(hdr_stream)
+
+    for filename, streams in by_file.items():
+        if len(streams) == 1:
+            streams[0].write(dir)
+            continue
+
+        logs_by_ip = {}
+        for hdr_stream in streams:
+            for ip, log in hdr_stream.logs().items():
+                if log.intervals:
+                    logs_by_ip.setdefault(ip, []).append(log)
+        for ip, logs in logs_by_ip.items():
+            ip_dir = os.path.join(dir, ip)
+            os.makedirs(ip_dir, exist_ok=True)
+            intervals = sorted((interval for log in logs for interval in log.intervals), key=lambda i: i.start)
+            hdrhistogram.HistogramLog(min(log.start_time for log in logs), intervals) \
+                .write(os.path.join(ip_dir, filename))
+        # written last, so the merged file is newer than its inputs.
+        hdrhistogram.union([hdr_stream.log() for hdr_stream in streams], streams[0].interval_seconds) \
+            .write(os.path.join(dir, filename))
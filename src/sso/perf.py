@@ -1,14 +1,146 @@
+import glob
+import gzip
+import os
+import shlex
+import subprocess
+import time
+from threading import Thread, Event
 from sso.ssh import PSSH,SSH
-from sso.util import log_important
+from sso.util import log_important, run_parallel
+
+# Where the perf data and folded stacks are kept on the nodes.
+REMOTE_PERF_DIR = "/tmp/sso-perf"
+
+# Where the FlameGraph scripts are cloned on the controller for rendering.
+FLAMEGRAPH_DIR = "~/.cache/sso/FlameGraph"
+FLAMEGRAPH_REPO = "https://github.com/brendangregg/FlameGraph"
+
+
+def _open_folded(path):
+    return gzip.open(path, "rt") if path.endswith(".gz") else open(path)
+
+
+def read_folded(path):
+    """
+    Returns {stack: count} of a file (optionally gzipped) in the folded format of
+    stackcollapse-perf.pl.
+    """
+    stacks = {}
+    with _open_folded(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if not stack or not count.isdigit():
+                continue
+            stacks[stack] = stacks.get(stack, 0) + int(count)
+    return stacks
+
+
+def write_folded(path, stacks):
+    with open(path, "w") as f:
+        for stack in sorted(stacks):
+            f.write(f"{stack} {stacks[stack]}\n")
+
+
+def merge_folded(stacks_list):
+    result = {}
+    for stacks in stacks_list:
+        for stack, count in stacks.items():
+            result[stack] = result.get(stack, 0) + count
+    return result
+
+
+def flamegraph_tools(dir=None):
+    """
+    Returns the directory with the FlameGraph scripts on the controller; cloned on first use.
+    """
+    dir = os.path.expanduser(dir if dir is not None else FLAMEGRAPH_DIR)
+    if not os.path.exists(os.path.join(dir, "flamegraph.pl")):
+        os.makedirs(os.path.dirname(dir), exist_ok=True)
+        subprocess.run(["git", "clone", "--depth=1", FLAMEGRAPH_REPO, dir], check=True)
+    return dir
+
+
+def _folded_name(path):
+    # the name without .folded(.gz)
+    name = os.path.basename(path)
+    for ext in [".gz", ".folded"]:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+
+def render(folded_file, svg_file, title=None, tools=None):
+    tools = flamegraph_tools(tools)
+    args = ["perl", os.path.join(tools, "flamegraph.pl"), "--hash"]
+    if title is not None:
+        args += ["--title", title]
+    with _open_folded(folded_file) as stdin, open(svg_file, "w") as out:
+        subprocess.run(args, stdin=stdin, stdout=out, check=True)
+
+
+def render_diff(before_file, after_file, svg_file, title=None, tools=None, normalize=True):
+    """
+    Renders a differential flamegraph: the 'after' profile, colored red where a stack got more
+    samples and blue where it got less (see difffolded.pl).
+
+    Parameters
+    ----------
+    normalize: bool
+        Scale the 'before' counts to the total of 'after', so profiles of a different length
+        or frequency can be compared.
+    """
+    before = read_folded(before_file)
+    after = read_folded(after_file)
+    scale = 1.0
+    if normalize and before:
+        scale = sum(after.values()) / sum(before.values())
+    diff_file = svg_file[:-len(".svg")] + ".diff" if svg_file.endswith(".svg") else svg_file + ".diff"
+    with open(diff_file, "w") as f:
+        for stack in sorted(before.keys() | after.keys()):
+            f.write(f"{stack} {round(before.get(stack, 0) * scale)} {after.get(stack, 0)}\n")
+    render(diff_file, svg_file, title=title, tools=tools)
+
+
+def diff_flamegraphs(before_dir, after_dir, output_dir, tools=None):
+    """
+    Renders a differential flamegraph for every folded file (cluster, node and cpu) that is in
+    the profile directories of both iterations.
+    """
+    log_important("Perf differential flamegraphs: started")
+    before_files = glob.glob(os.path.join(before_dir, "**", "*.folded"), recursive=True) + \
+        glob.glob(os.path.join(before_dir, "**", "*.folded.gz"), recursive=True)
+    for before_file in sorted(before_files):
+        path = os.path.relpath(before_file, before_dir)
+        after_file = os.path.join(after_dir, path)
+        if not os.path.exists(after_file):
+            continue
+        svg_file = os.path.join(output_dir, os.path.dirname(path), _folded_name(path) + "-diff.svg")
+        os.makedirs(os.path.dirname(svg_file), exist_ok=True)
+        print(f"    {svg_file}")
+        render_diff(before_file, after_file, svg_file, title=f"{path}: {before_dir} -> {after_dir}", tools=tools)
+    log_important("Perf differential flamegraphs: done")
+
 
 class Perf:
 
-    def __init__(self, ip_list, user, ssh_options):
+    def __init__(self, ip_list, user, ssh_options, flamegraph_dir=None, fold_niceness=19):
+        """
+        Parameters
+        ----------
+        flamegraph_dir: str
+            The directory with the FlameGraph scripts on the controller. Defaults to
+            FLAMEGRAPH_DIR; cloned when missing.
+        fold_niceness: int
+            The niceness of 'perf script | stackcollapse-perf.pl' on the nodes, so the folding
+            disturbs the database as little as possible. None to not nice it.
+        """
         print(ip_list)
-        self.updated = False
         self.ip_list = ip_list
         self.user = user
         self.ssh_options = ssh_options
+        self.flamegraph_dir = flamegraph_dir
+        self.fold_niceness = fold_niceness
+        self.__recording = None
 
     def pssh(self):
         return PSSH(self.ip_list, self.user, self.ssh_options)
@@ -23,11 +155,8 @@ class Perf:
 
     def install_debuginfo(self):
         pssh = self.pssh()
-        
-        if not self.updated:
-            pssh.update()
-            self.updated = True
-        
+        pssh.update()
+
         log_important("Installing debuginfo: started")
         pssh.try_install("scylla_debuginfo")
         log_important("Installing debuginfo: done")
@@ -35,22 +164,16 @@ class Perf:
     def install_perf(self):
         log_important("Perf install: started")
         pssh = self.pssh()
-        
-        if not self.updated:
-            pssh.update()
-            self.updated = True
-       
-        # This part sucks.. Should no be a dependency on a particular version 
-        pssh.install_one("perf", "linux-tools-5.4.0-1035-aws")        
+        pssh.update()
+
+        # This part sucks.. Should no be a dependency on a particular version
+        pssh.install_one("perf", "linux-tools-5.4.0-1035-aws")
         log_important("Perf install: done")
 
     def install_flamegraph(self):
         log_important("Perf install flamegraph: started")
         pssh = self.pssh()
-
-        if not self.updated:
-            pssh.update()
-            self.updated = True
+        pssh.update()
 
         pssh.install("git")
         # needed for addr2line
@@ -64,11 +187,145 @@ class Perf:
         log_important("Perf install flamegraph: done")
 
     def flamegraph_cpu(self, cpu, dir, duration_seconds=60, args = "--call-graph lbr -F99", output="flamegraph"):
-        data_file = f"{output}.data"
-        flamegraph_file = f"{output}.svg"
-        cmd = f"--output {data_file} --cpu {cpu} {args} sleep {duration_seconds}"
-        self.record(cmd)
-        self.collect_flamegraph(dir, data_file, flamegraph_file)
+        """
+        Profiles the cpus (a single cpu or a list) on all nodes; see profile.
+        """
+        cpus = cpu if isinstance(cpu, (list, tuple)) else [cpu]
+        self.profile(dir, cpus, duration_seconds=duration_seconds, args=args, name=output)
+
+    def profile(self, dir, cpus=None, duration_seconds=60, args="--call-graph lbr -F99", name="flamegraph"):
+        """
+        Profiles the cpus on all nodes concurrently for duration_seconds; see start and stop.
+        """
+        self.start(cpus, args=args, name=name)
+        time.sleep(duration_seconds)
+        self.stop(dir)
+
+    def start(self, cpus=None, args="--call-graph lbr -F99", name="flamegraph"):
+        """
+        Starts recording on all nodes in the background, a perf record per cpu, until stop is
+        called. Start it just before the stress (e.g. CassandraStress.stress) and stop it
+        directly after, so the profile covers the same period as the benchmark.
+
+        Parameters
+        ----------
+        cpus: list
+            The cpus (shards) to profile. If None, all cpus are profiled together.
+        args: str
+            The extra perf record arguments.
+        name: str
+            The name of the profile; used for the file names.
+        """
+        if self.__recording is not None:
+            raise Exception("Perf: already recording")
+        cpus = [str(cpu) for cpu in cpus] if cpus is not None else ["all"]
+        log_important(f"Perf recording {name} on cpus {','.join(cpus)}: started")
+        records = []
+        for cpu in cpus:
+            data_file = f"{REMOTE_PERF_DIR}/{name}-cpu-{cpu}.data"
+            cpu_arg = "" if cpu == "all" else f"--cpu {cpu}"
+            records.append(f"nohup sudo perf record -o {data_file} -a {cpu_arg} {args} "
+                           f"> {data_file}.log 2>&1 < /dev/null &")
+        records = "\n".join(records)
+        self.pssh().exec(f"""
+                mkdir -p {REMOTE_PERF_DIR}
+                rm -f {REMOTE_PERF_DIR}/{name}-cpu-*
+                {records}
+                """)
+        self.__recording = (name, cpus, time.time())
+
+    def recording(self):
+        return self.__recording is not None
+
+    def stop(self, dir, render=True):
+        """
+        Stops the recording started with start and collects the folded stacks into dir:
+        <ip>/cpu-<cpu>.folded.gz per node and cpu, <ip>/node.folded per node, cpu-<cpu>.folded
+        per cpu over all nodes and cluster.folded; each with a flamegraph if render is True.
+        """
+        if self.__recording is None:
+            raise Exception("Perf: not recording")
+        name, cpus, start_time = self.__recording
+        self.__recording = None
+        end_time = time.time()
+        # the [d] prevents pkill from matching the shell that runs it.
+        self.pssh().exec(f"""
+                sudo pkill -INT -f "perf recor[d] -o {REMOTE_PERF_DIR}/{name}-cpu-"
+                while pgrep -f "perf recor[d] -o {REMOTE_PERF_DIR}/{name}-cpu-" > /dev/null; do sleep 0.5; done
+                """)
+        log_important(f"Perf recording {name}: done")
+
+        os.makedirs(dir, exist_ok=True)
+        with open(os.path.join(dir, "window.txt"), "w") as f:
+            print(f"name={name}", file=f)
+            print(f"cpus={','.join(cpus)}", file=f)
+            print(f"start={start_time:.3f}", file=f)
+            print(f"end={end_time:.3f}", file=f)
+        self.collect_folded(dir, name, cpus)
+        self.merge(dir, cpus, render)
+
+    def collect_folded(self, dir, name, cpus):
+        """
+        Folds the recorded perf data of every node and cpu on the node and streams the
+        compressed folded stacks to dir/<ip>/cpu-<cpu>.folded.gz. Only the folded stacks are
+        transferred; the perf data stays on the nodes (until the next recording with the same
+        name), so it can be folded again without recording again.
+        """
+        log_important(f"Perf collecting folded stacks: started")
+        run_parallel(self.__fold, [(ip, f"{REMOTE_PERF_DIR}/{name}-cpu-{cpu}.data",
+                                    os.path.join(dir, ip, f"cpu-{cpu}.folded.gz")) for ip in self.ip_list for cpu in cpus])
+        log_important(f"Perf collecting folded stacks: done")
+
+    def __fold(self, ip, data_file, folded_file):
+        nice = f"nice -n {self.fold_niceness}" if self.fold_niceness is not None else ""
+        os.makedirs(os.path.dirname(folded_file), exist_ok=True)
+        start = time.time()
+        # pipefail, so a failing perf script isn't mistaken for an empty profile.
+        pipeline = (f"cd /tmp && sudo {nice} perf script -i {data_file} "
+                    f"| {nice} FlameGraph/stackcollapse-perf.pl | {nice} gzip -1")
+        SSH(ip, self.user, self.ssh_options).output_to_file(f"bash -o pipefail -c {shlex.quote(pipeline)}",
+                                                            folded_file)
+        print(f'    [{ip}] Folded {data_file}: {os.path.getsize(folded_file)} bytes in {time.time() - start:.1f}s')
+
+    def merge(self, dir, cpus, render=True):
+        """
+        Merges the folded stacks per node, per cpu and cluster wide and renders the flamegraphs.
+        """
+        log_important(f"Perf merging folded stacks: started")
+        cpus = [str(cpu) for cpu in cpus]
+        per_cpu = {cpu: [] for cpu in cpus}
+        per_node = []
+        for ip in self.ip_list:
+            node_stacks = []
+            for cpu in cpus:
+                file = os.path.join(dir, ip, f"cpu-{cpu}.folded.gz")
+                if not os.path.exists(file):
+                    print(f"    [{ip}] No folded stacks for cpu {cpu}")
+                    continue
+                stacks = read_folded(file)
+                node_stacks.append(stacks)
+                per_cpu[cpu].append(stacks)
+                if render:
+                    self.__render(file, f"{ip} cpu {cpu}")
+            node = merge_folded(node_stacks)
+            per_node.append(node)
+            self.__write_and_render(os.path.join(dir, ip, "node.folded"), node, f"{ip}", render)
+        if len(cpus) > 1 or len(self.ip_list) > 1:
+            for cpu, stacks_list in per_cpu.items():
+                self.__write_and_render(os.path.join(dir, f"cpu-{cpu}.folded"), merge_folded(stacks_list),
+                                        f"cpu {cpu}", render)
+        self.__write_and_render(os.path.join(dir, "cluster.folded"), merge_folded(per_node), "cluster", render)
+        log_important(f"Perf merging folded stacks: done")
+
+    def __write_and_render(self, file, stacks, title, render=True):
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        write_folded(file, stacks)
+        if render:
+            self.__render(file, title)
+
+    def __render(self, file, title):
+        render(file, os.path.join(os.path.dirname(file), _folded_name(file) + ".svg"), title=title,
+               tools=self.flamegraph_dir)
 
     def list(self):
         self.exec("sudo perf list -v")
@@ -80,21 +337,115 @@ class Perf:
     def exec(self, command):
         log_important(f"Perf: started")
         print(command)
-        ssh = SSH(self.ip_list[0], self.user, self.ssh_options)
-        ssh.exec(f"""
+        self.pssh().exec(f"""
                 cd /tmp
                 {command}
                 """)
         log_important(f"Perf: done")
 
     def collect_flamegraph(self, dir, data_file = "perf.data", flamegraph_file = "flamegraph.svg"):
+        """
+        Folds the data_file (in /tmp) on every node and renders the flamegraph locally into
+        dir/<ip>; the folded stacks are kept next to it.
+        """
         log_important(f"Perf collecting flamegraph: started")
-        ssh = SSH(self.ip_list[0], self.user, self.ssh_options)
-        # --no-online
-        ssh.exec(f"""
-                cd /tmp
-                sudo perf script -i {data_file} | FlameGraph/stackcollapse-perf.pl | FlameGraph/flamegraph.pl --hash > {flamegraph_file}
-                """)
-        ssh.scp_from_remote(f"/tmp/{flamegraph_file}", dir)
-        ssh.exec(f"rm /tmp/{flamegraph_file}")
+        name = os.path.splitext(flamegraph_file)[0]
+        args = []
+        for ip in self.ip_list:
+            args.append((ip, f"/tmp/{data_file}", os.path.join(dir, ip, f"{name}.folded.gz")))
+        run_parallel(self.__fold, args)
+        for ip, _, folded_file in args:
+            render(folded_file, os.path.join(dir, ip, flamegraph_file), title=ip, tools=self.flamegraph_dir)
         log_important(f"Perf collecting flamegraph: done")
+
+
+class ContinuousProfiler:
+    """
+    Profiles the cluster in short windows at a low frequency while a benchmark is running, e.g.
+    10 seconds every minute, so a latency spike in the hdr intervals can be correlated with what
+    the cpus were doing at that moment. Every window is stored in <dir>/<start> with start the
+    epoch seconds of the window (the same clock as the hdr intervals) and listed in
+    <dir>/windows.csv. The flamegraphs aren't rendered; see render or bin/flamegraph_diff.
+
+    Pass it to CassandraStress.stress(profiler=...) to run it during the stress.
+    """
+
+    def __init__(self, perf, dir, window_seconds=10, interval_seconds=60, cpus=None,
+                 args="--call-graph lbr -F19", name="window"):
+        """
+        Parameters
+        ----------
+        perf: Perf
+            Profiles the nodes; it shouldn't be used for anything else while profiling.
+        dir: str
+            The directory for the windows, e.g. os.path.join(iteration.dir, "profile").
+        window_seconds: int
+            The length of every window.
+        interval_seconds: int
+            The time between the starts of the windows. If a window (including the folding)
+            takes longer, the next one starts directly after it.
+        cpus: list
+            The cpus (shards) to profile; all cpus if None.
+        args: str
+            The perf record arguments; a low frequency keeps the overhead low.
+        """
+        if window_seconds > interval_seconds:
+            raise Exception("window_seconds can't be larger than interval_seconds")
+        self.perf = perf
+        self.dir = dir
+        self.window_seconds = window_seconds
+        self.interval_seconds = interval_seconds
+        self.cpus = cpus
+        self.args = args
+        self.name = name
+        self.__stopped = Event()
+        self.__thread = None
+        self.exception = None
+
+    def start(self):
+        if self.__thread is not None:
+            raise Exception("ContinuousProfiler already started")
+        os.makedirs(self.dir, exist_ok=True)
+        self.__stopped.clear()
+        self.exception = None
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def __run(self):
+        try:
+            next_start = time.time()
+            while not self.__stopped.wait(max(0.0, next_start - time.time())):
+                next_start += self.interval_seconds
+                start_time = time.time()
+                self.perf.start(self.cpus, args=self.args, name=self.name)
+                # a stop during the window ends the window early.
+                self.__stopped.wait(self.window_seconds)
+                # the end of the recording; stop also downloads and folds the data.
+                end_time = time.time()
+                window_dir = os.path.join(self.dir, str(int(start_time)))
+                self.perf.stop(window_dir, render=False)
+                with open(os.path.join(self.dir, "windows.csv"), "a") as f:
+                    print(f"{start_time:.3f},{end_time:.3f},{os.path.basename(window_dir)}", file=f)
+                next_start = max(next_start, time.time())
+        except Exception as e:
+            # a failing profiler shouldn't fail the benchmark.
+            self.exception = e
+            log_important(f"ContinuousProfiler failed: {e}")
+
+    def stop(self):
+        """
+        Stops profiling; the current window is stopped and collected.
+        """
+        if self.__thread is None:
+            return
+        self.__stopped.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def render(self):
+        """
+        Renders the cluster flamegraph of every window.
+        """
+        for file in sorted(glob.glob(os.path.join(self.dir, "*", "cluster.folded"))):
+            render(file, os.path.join(os.path.dirname(file), "cluster.svg"),
+                   title=f"cluster {os.path.basename(os.path.dirname(file))}", tools=self.perf.flamegraph_dir)
@@ -1,11 +1,38 @@
+import json
+import math
 import os
+import time
+import urllib.parse
+import urllib.request
 import uuid
 from datetime import datetime
+from threading import Lock
 
 from sso.ssh import SSH
 from sso.util import run_parallel,log_important
 
 SCYLLA_MONITORING_VERSION="3.6.3"
+PROMETHEUS_PORT=9090
+# Prometheus rejects range queries with more points per series.
+MAX_POINTS_PER_QUERY=10000
+
+# name -> PromQL; aggregated per node to keep the extracted files small.
+DEFAULT_QUERIES = {
+    "reactor_utilization": 'avg by (instance) (scylla_reactor_utilization)',
+    "cql_reads": 'sum by (instance) (rate(scylla_cql_reads[1m]))',
+    "cql_inserts": 'sum by (instance) (rate(scylla_cql_inserts[1m]))',
+    "cql_updates": 'sum by (instance) (rate(scylla_cql_updates[1m]))',
+    "cache_row_hits": 'sum by (instance) (rate(scylla_cache_row_hits[1m]))',
+    "cache_row_misses": 'sum by (instance) (rate(scylla_cache_row_misses[1m]))',
+    "compactions": 'sum by (instance) (scylla_compaction_manager_compactions)',
+    "pending_compactions": 'sum by (instance) (scylla_compaction_manager_pending_compactions)',
+    "memtable_dirty_bytes": 'sum by (instance) (scylla_lsa_memory_allocated - scylla_lsa_memory_free)',
+    "cpu_busy": '100 * (1 - avg by (instance) (rate(node_cpu_seconds_total{mode="idle"}[1m])))',
+    "disk_read_bytes": 'sum by (instance) (rate(node_disk_read_bytes_total[1m]))',
+    "disk_written_bytes": 'sum by (instance) (rate(node_disk_written_bytes_total[1m]))',
+    "network_receive_bytes": 'sum by (instance) (rate(node_network_receive_bytes_total[1m]))',
+    "network_transmit_bytes": 'sum by (instance) (rate(node_network_transmit_bytes_total[1m]))',
+}
 
 def download(env, props, iteration):
     prometheus = Prometheus(env['prometheus_public_ip'][0],
@@ -15,6 +42,26 @@ def download(env, props, iteration):
     prometheus.data_dir_download(iteration.dir)
     prometheus.start()
 
+def extract(env, props, iteration, queries=None, step_seconds=5, snapshot=False):
+    """
+    Extracts the metrics of the iteration (from its start till now) with the Prometheus HTTP API
+    into iteration.dir/prometheus, without stopping Prometheus. Much cheaper than downloading
+    the data dir. The queries default to the 'prometheus_queries' property or DEFAULT_QUERIES.
+    If snapshot is True, a TSDB snapshot is downloaded as well.
+    """
+    prometheus = Prometheus(env['prometheus_public_ip'][0],
+                            props['prometheus_user'],
+                            props['ssh_options'])
+    if queries is None:
+        queries = props.get('prometheus_queries', DEFAULT_QUERIES)
+    try:
+        prometheus.extract(os.path.join(iteration.dir, "prometheus"), iteration.start_time, time.time(),
+                           queries, step_seconds)
+        if snapshot:
+            prometheus.snapshot_download(iteration.dir)
+    finally:
+        prometheus.close()
+
 def download_and_clear(env, props, iteration):
     prometheus = Prometheus(env['prometheus_public_ip'][0],
                             props['prometheus_user'],
@@ -30,6 +77,49 @@ class Prometheus:
         self.ip = ip
         self.user = user
         self.ssh_options = ssh_options
+        self.__tunnel = None
+        self.__lock = Lock()
+
+    def __api_url(self):
+        # the Prometheus HTTP API is reached over an ssh tunnel; it isn't exposed publicly.
+        with self.__lock:
+            if self.__tunnel is None or self.__tunnel.process.poll() is not None:
+                self.__tunnel = SSH(self.ip, self.user, self.ssh_options).tunnel(PROMETHEUS_PORT)
+            return f"http://localhost:{self.__tunnel.local_port}/api/v1"
+
+    def close(self):
+        """
+        Closes the ssh tunnel to the Prometheus HTTP API.
+        """
+        with self.__lock:
+            if self.__tunnel is not None:
+                self.__tunnel.close()
+                self.__tunnel = None
+
+    def api(self, path, params=None, method="GET", timeout_seconds=60):
+        """
+        Calls the Prometheus HTTP API and returns the 'data' of the response.
+        """
+        url = f"{self.__api_url()}/{path}"
+        data = None
+        if params:
+            if method == "GET":
+                url = f"{url}?{urllib.parse.urlencode(params)}"
+            else:
+                data = urllib.parse.urlencode(params).encode()
+        request = urllib.request.Request(url, data=data, method=method)
+        with urllib.request.urlopen(request, timeout=timeout_seconds) as response:
+            result = json.load(response)
+        if result.get('status') != 'success':
+            raise Exception(f"Prometheus query {path} {params} failed: {result.get('error')}")
+        return result.get('data')
+
+    def query(self, expr, timeout_seconds=10):
+        """
+        Returns the instant vector of the PromQL expression as a list of (labels, value).
+        """
+        data = self.api("query", {'query': expr}, timeout_seconds=timeout_seconds)
+        return [(r['metric'], float(r['value'][1])) for r in data['result']]
 
     def data_dir_upload(self, dir):
         log_important("Prometheus upload: started")
@@ -58,10 +148,67 @@ class Prometheus:
             """)
         log_important("Prometheus start: done")
         
+    def query_range(self, expr, start, end, step_seconds):
+        """
+        Returns the range vector of the PromQL expression as a list of (labels, [(timestamp, value)]).
+        Long ranges are split into multiple queries.
+        """
+        series = {}
+        chunk_start = start
+        while chunk_start <= end:
+            chunk_end = min(end, chunk_start + step_seconds * (MAX_POINTS_PER_QUERY - 1))
+            data = self.api("query_range", {'query': expr, 'start': chunk_start, 'end': chunk_end,
+                                            'step': step_seconds})
+            for r in data['result']:
+                key = tuple(sorted(r['metric'].items()))
+                series.setdefault(key, []).extend((float(t), float(v)) for t, v in r['values'])
+            chunk_start = chunk_end + step_seconds
+        return [(dict(key), values) for key, values in series.items()]
+
+    def extract(self, dir, start, end, queries, step_seconds=5):
+        """
+        Stores the queries over [start, end] in dir: a <name>.npz per query with the 'timestamps',
+        the 'values' (a row per series, NaN where missing) and the 'labels' (json) of every
+        series. The queries are listed in dir/queries.json.
+        """
+        import numpy as np
+
+        log_important("Prometheus extract: started")
+        os.makedirs(dir, exist_ok=True)
+        # aligned to the step, so the timestamps of all queries line up.
+        start = math.floor(start / step_seconds) * step_seconds
+        end = math.ceil(end / step_seconds) * step_seconds
+        timestamps = np.arange(start, end + step_seconds, step_seconds, dtype=np.float64)
+        for name, expr in queries.items():
+            series = self.query_range(expr, start, end, step_seconds)
+            values = np.full((len(series), len(timestamps)), np.nan)
+            for row, (_, points) in enumerate(series):
+                for t, v in points:
+                    values[row, int(round((t - start) / step_seconds))] = v
+            labels = np.array([json.dumps(l, sort_keys=True) for l, _ in series], dtype=str)
+            np.savez_compressed(os.path.join(dir, f"{name}.npz"), timestamps=timestamps, values=values, labels=labels)
+            print(f"    {name}: {len(series)} series")
+        with open(os.path.join(dir, "queries.json"), "w") as f:
+            json.dump({'start': start, 'end': end, 'step_seconds': step_seconds, 'queries': queries}, f, indent=2)
+        log_important("Prometheus extract: done")
+
+    def snapshot_download(self, dir):
+        """
+        Creates a TSDB snapshot with the admin API (Prometheus needs to run with
+        --web.enable-admin-api) and downloads it to dir/<snapshot name>, without stopping Prometheus.
+        """
+        log_important("Prometheus snapshot: started")
+        name = self.api("admin/tsdb/snapshot", method="POST")['name']
+        ssh = SSH(self.ip, self.user, self.ssh_options)
+        ssh.download(f"data/snapshots/{name}", dir)
+        ssh.exec(f"rm -fr data/snapshots/{name}")
+        log_important("Prometheus snapshot: done")
+
     def data_dir_download(self, dir):
         log_important("Prometheus download data: started")
         ssh = SSH(self.ip, self.user, self.ssh_options)
-        ssh.scp_from_remote(f"data", dir)
+        # files that were downloaded before (e.g. older TSDB blocks) are skipped.
+        ssh.download(f"data", dir)
         log_important("Prometheus download data: done")
     
     def data_dir_rm(self):
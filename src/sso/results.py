@@ -0,0 +1,284 @@
+import glob
+import json
+import os
+import sqlite3
+import sys
+
+from sso import stats
+from sso import hdrhistogram
+
+# The catalog of all iterations of all trials; stored in the trials directory.
+DB_NAME = "results.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS iterations (
+    id INTEGER PRIMARY KEY,
+    trial TEXT NOT NULL,
+    name TEXT NOT NULL,
+    dir TEXT NOT NULL UNIQUE,
+    experimental INTEGER NOT NULL,
+    git_hash TEXT,
+    description TEXT,
+    config TEXT,
+    signature TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    iteration_id INTEGER NOT NULL REFERENCES iterations(id) ON DELETE CASCADE,
+    file TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    throughput REAL NOT NULL,
+    min REAL, mean REAL, p50 REAL, p90 REAL, p99 REAL, p999 REAL, p9999 REAL, max REAL,
+    PRIMARY KEY (iteration_id, file, tag)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    iteration_id INTEGER NOT NULL REFERENCES iterations(id) ON DELETE CASCADE,
+    file TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    start REAL NOT NULL,
+    throughput REAL NOT NULL,
+    p99 REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_by_iteration ON samples (iteration_id, file, tag);
+"""
+
+# The latencies are stored in milliseconds.
+PERCENTILES = [("p50", 50.0), ("p90", 90.0), ("p99", 99.0), ("p999", 99.9), ("p9999", 99.99)]
+
+
+def _read_text(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _hdr_files(dir):
+    # only the merged files; the files per load generator are in the sub directories.
+    return sorted(glob.glob(os.path.join(dir, "*.hdr")))
+
+
+def _signature(dir):
+    files = _hdr_files(dir) + [os.path.join(dir, "description.txt"), os.path.join(dir, "HEAD")]
+    signature = []
+    for file in files:
+        if os.path.exists(file):
+            stat = os.stat(file)
+            signature.append([os.path.basename(file), stat.st_size, stat.st_mtime])
+    return json.dumps(signature)
+
+
+def trials_dir_of(iteration_dir):
+    """
+    Returns the trials directory of an iteration directory (trials/<trial>/<iteration>) or None.
+    """
+    trials_dir = os.path.dirname(os.path.dirname(os.path.realpath(iteration_dir)))
+    return trials_dir if os.path.basename(trials_dir) == "trials" else None
+
+
+def add_iteration(iteration_dir, properties=None):
+    """
+    Adds (or updates) the iteration to the catalog of its trials directory; does nothing if the
+    directory isn't an iteration directory.
+    """
+    trials_dir = trials_dir_of(iteration_dir)
+    if trials_dir is None:
+        return
+    index = ResultsIndex(trials_dir)
+    try:
+        index.add(iteration_dir, properties)
+    finally:
+        index.close()
+
+
+class ResultsIndex:
+    """
+    A SQLite catalog of the results of the iterations in a trials directory: per merged hdr file
+    and tag the throughput and latency percentiles, and the throughput and p99 per interval
+    for significance testing. An iteration is only parsed again when its files changed.
+    """
+
+    def __init__(self, trials_dir):
+        self.trials_dir = os.path.realpath(trials_dir)
+        self.db = sqlite3.connect(os.path.join(self.trials_dir, DB_NAME))
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, iteration_dir, properties=None, force=False):
+        """
+        Indexes the iteration. Returns True if it was (re)parsed.
+        """
+        if not hdrhistogram.has_numpy():
+            raise Exception("Indexing results requires numpy")
+        dir = os.path.realpath(iteration_dir)
+        signature = _signature(dir)
+        row = self.db.execute("SELECT id, signature, config FROM iterations WHERE dir = ?", (dir,)).fetchone()
+        if row is not None and row['signature'] == signature and not force:
+            return False
+
+        config = json.dumps(properties, sort_keys=True, default=str) if properties is not None else None
+        if config is None and row is not None:
+            config = row['config']
+        name = os.path.basename(dir)
+        with self.db:
+            if row is not None:
+                self.db.execute("DELETE FROM iterations WHERE id = ?", (row['id'],))
+            cursor = self.db.execute(
+                "INSERT INTO iterations (trial, name, dir, experimental, git_hash, description, config, signature) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (os.path.basename(os.path.dirname(dir)), name, dir, int(name.endswith("_experimental")),
+                 _read_text(os.path.join(dir, "HEAD")), _read_text(os.path.join(dir, "description.txt")),
+                 config, signature))
+            iteration_id = cursor.lastrowid
+            for file in _hdr_files(dir):
+                self.__add_file(iteration_id, file)
+        return True
+
+    def __add_file(self, iteration_id, file):
+        ratio = hdrhistogram.DEFAULT_VALUE_UNIT_RATIO
+        filename = os.path.basename(file)
+        for tag, log in hdrhistogram.read_log(file).split_by_tag().items():
+            tag = tag if tag is not None else ""
+            begin, end = log.time_range()
+            histogram = log.total()
+            duration = end - begin
+            count = histogram.total_count()
+            values = [histogram.min() / ratio, histogram.mean() / ratio] + \
+                     [histogram.value_at_percentile(p) / ratio for _, p in PERCENTILES] + [histogram.max() / ratio]
+            self.db.execute(
+                "INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (iteration_id, filename, tag, count, duration, count / duration if duration > 0 else 0.0, *values))
+            self.db.executemany(
+                "INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?)",
+                [(iteration_id, filename, tag, interval.start,
+                  interval.histogram().total_count() / interval.length if interval.length > 0 else 0.0,
+                  interval.histogram().value_at_percentile(99) / ratio)
+                 for interval in log.intervals])
+
+    def index(self, force=False):
+        """
+        Indexes all iterations in the trials directory that are new or changed. Returns the number
+        of (re)parsed iterations.
+        """
+        count = 0
+        for dir in sorted(glob.glob(os.path.join(self.trials_dir, "*", "*"))):
+            if os.path.islink(dir) or not os.path.isdir(dir):
+                continue
+            if self.add(dir, force=force):
+                print(f"Indexed {dir}")
+                count += 1
+        # iterations that have been removed.
+        with self.db:
+            for row in self.db.execute("SELECT id, dir FROM iterations").fetchall():
+                if not os.path.isdir(row['dir']):
+                    self.db.execute("DELETE FROM iterations WHERE id = ?", (row['id'],))
+        return count
+
+    def iterations(self, trial=None):
+        if trial is None:
+            return self.db.execute("SELECT * FROM iterations ORDER BY trial, name").fetchall()
+        return self.db.execute("SELECT * FROM iterations WHERE trial = ? ORDER BY name", (trial,)).fetchall()
+
+    def find(self, ref):
+        """
+        Returns the iteration by id, directory or '<trial>/<iteration>' (e.g. 'foo/latest').
+        """
+        if str(ref).isdigit():
+            row = self.db.execute("SELECT * FROM iterations WHERE id = ?", (int(ref),)).fetchone()
+        else:
+            candidates = [ref, os.path.join(self.trials_dir, ref)]
+            row = None
+            for candidate in candidates:
+                if os.path.isdir(candidate):
+                    dir = os.path.realpath(candidate)
+                    if self.db.execute("SELECT 1 FROM iterations WHERE dir = ?", (dir,)).fetchone() is None:
+                        self.add(dir)
+                    row = self.db.execute("SELECT * FROM iterations WHERE dir = ?", (dir,)).fetchone()
+                    break
+        if row is None:
+            raise Exception(f"Unknown iteration [{ref}]")
+        return row
+
+    def metrics(self, iteration_id):
+        rows = self.db.execute("SELECT * FROM metrics WHERE iteration_id = ?", (iteration_id,)).fetchall()
+        return {(row['file'], row['tag']): row for row in rows}
+
+    def samples(self, iteration_id, file, tag):
+        """
+        Returns (starts, throughputs, p99s) of the intervals in time order.
+        """
+        rows = self.db.execute("SELECT start, throughput, p99 FROM samples WHERE iteration_id = ? AND file = ? "
+                               "AND tag = ? ORDER BY start", (iteration_id, file, tag)).fetchall()
+        return [row['start'] for row in rows], [row['throughput'] for row in rows], [row['p99'] for row in rows]
+
+
+def _block_means(starts, values, block_seconds):
+    """
+    Returns the means of the values per block of block_seconds. Consecutive intervals are strongly
+    correlated, so they aren't independent samples; means of long enough blocks are much closer
+    to that. A trailing block that covers less than half of block_seconds is dropped.
+    """
+    if not starts:
+        return []
+    blocks = {}
+    for start, value in zip(starts, values):
+        blocks.setdefault(int((start - starts[0]) // block_seconds), []).append(value)
+    interval_seconds = (starts[-1] - starts[0]) / max(len(starts) - 1, 1)
+    full = max(1, int(block_seconds / max(interval_seconds, 1e-9) / 2))
+    return [sum(block) / len(block) for _, block in sorted(blocks.items()) if len(block) >= full]
+
+
+def diff(index, refs, alpha=0.05, threshold=3.0, block_seconds=30, file=None, out=sys.stdout):
+    """
+    Compares the iterations with the first one (the baseline). The means of the throughput and
+    p99 per block of block_seconds are compared with Welch's t-test; a significant (p < alpha)
+    change for the worse of more than threshold percent is a regression. At least 2 blocks
+    per iteration are needed for a p-value.
+
+    Returns
+    -------
+    The number of regressions.
+    """
+    baseline = index.find(refs[0])
+    baseline_metrics = index.metrics(baseline['id'])
+    regressions = 0
+    print(f"baseline [{baseline['id']}] {baseline['trial']}/{baseline['name']} {baseline['git_hash'] or ''}", file=out)
+    for ref in refs[1:]:
+        other = index.find(ref)
+        other_metrics = index.metrics(other['id'])
+        print(f"\n[{other['id']}] {other['trial']}/{other['name']} {other['git_hash'] or ''}", file=out)
+        print(f"{'file':<28}{'tag':<12}{'metric':<12}{'baseline':>12}{'other':>12}{'delta':>9}{'p-value':>10}",
+              file=out)
+        for key in sorted(baseline_metrics.keys() & other_metrics.keys()):
+            if file is not None and key[0] != file:
+                continue
+            a = baseline_metrics[key]
+            b = other_metrics[key]
+            a_starts, a_throughput, a_p99 = index.samples(baseline['id'], *key)
+            b_starts, b_throughput, b_p99 = index.samples(other['id'], *key)
+            a_throughput, a_p99 = (_block_means(a_starts, values, block_seconds) for values in (a_throughput, a_p99))
+            b_throughput, b_p99 = (_block_means(b_starts, values, block_seconds) for values in (b_throughput, b_p99))
+            # (metric, baseline, other, samples baseline, samples other, higher is better)
+            rows = [("throughput", a['throughput'], b['throughput'], a_throughput, b_throughput, True),
+                    ("p50 ms", a['p50'], b['p50'], None, None, False),
+                    ("p99 ms", a['p99'], b['p99'], a_p99, b_p99, False),
+                    ("p99.9 ms", a['p999'], b['p999'], None, None, False),
+                    ("max ms", a['max'], b['max'], None, None, False)]
+            for metric, a_value, b_value, a_samples, b_samples, higher_is_better in rows:
+                delta = (b_value - a_value) / a_value * 100 if a_value else 0.0
+                p_value = None
+                if a_samples and b_samples and len(a_samples) > 1 and len(b_samples) > 1:
+                    _, _, p_value = stats.welch_t_test(a_samples, b_samples)
+                worse = delta < -threshold if higher_is_better else delta > threshold
+                regression = p_value is not None and p_value < alpha and worse
+                regressions += regression
+                p_text = f"{p_value:.4f}" if p_value is not None else "-"
+                print(f"{key[0]:<28}{key[1]:<12}{metric:<12}{a_value:>12.3f}{b_value:>12.3f}{delta:>8.1f}%{p_text:>10}"
+                      f"{'  REGRESSION' if regression else ''}", file=out)
+    return regressions
@@ -1,9 +1,130 @@
 import os
+import re
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
-from sso.ssh import PSSH
+from sso.ssh import PSSH, SSH
+from sso.util import log_important
 
+CQL_PORT = 9042
 
-def clear_cluster(cluster_public_ips, cluster_user, ssh_options, duration_seconds=90):
+# One ssh call per probe; the sections are parsed by _parse_probe.
+_PROBE_COMMAND = f"""
+echo "cql_listening=$( (ss -ltn || netstat -ltn) 2>/dev/null | grep -c ':{CQL_PORT} ')"
+echo "---status"
+nodetool status 2>&1
+echo "---describecluster"
+{{describecluster}}
+true
+"""
+
+_STATUS_LINE = re.compile(r'^([UD][NLJM])\s+(\S+)')
+_SCHEMA_VERSION_LINE = re.compile(r'^\s*([0-9a-fA-F-]{36}|UNREACHABLE):')
+
+
+def _parse_probe(output):
+    sections = {}
+    name = "cql"
+    for line in output.splitlines():
+        if line.startswith("---"):
+            name = line[3:]
+            continue
+        sections.setdefault(name, []).append(line)
+    cql = "".join(sections.get("cql", []))
+    listening = cql.startswith("cql_listening=") and cql[len("cql_listening="):].strip() not in ("", "0")
+    states = {}
+    for line in sections.get("status", []):
+        match = _STATUS_LINE.match(line)
+        if match:
+            states[match.group(2)] = match.group(1)
+    versions = [match.group(1) for match in map(_SCHEMA_VERSION_LINE.match, sections.get("describecluster", []))
+                if match]
+    return listening, states, versions, "\n".join(sections.get("status", []))
+
+
+def _probe(ip, cluster_user, ssh_options, expected_nodes, schema_agreement):
+    """
+    Returns None if the node is ready, otherwise the reason why it isn't.
+    """
+    describecluster = "nodetool describecluster 2>&1" if schema_agreement else ""
+    try:
+        output = SSH(ip, cluster_user, ssh_options).output(_PROBE_COMMAND.replace("{describecluster}", describecluster))
+    except Exception as e:
+        return f"ssh failed: {e}"
+    listening, states, versions, status = _parse_probe(output)
+    if not listening:
+        return f"CQL port {CQL_PORT} not listening"
+    if not states:
+        return f"nodetool status failed: {status.strip()[-200:]}"
+    not_up = {node: state for node, state in states.items() if state != "UN"}
+    if expected_nodes is None:
+        # only the node itself matters; nodes can have been stopped on purpose.
+        not_up = {node: state for node, state in not_up.items() if state in ("UJ", "UL", "UM")}
+    if not_up:
+        return f"nodetool status: {', '.join(f'{node} {state}' for node, state in sorted(not_up.items()))}"
+    if expected_nodes is not None and len(states) < expected_nodes:
+        return f"nodetool status: {len(states)} of {expected_nodes} nodes"
+    if schema_agreement and (len(versions) != 1 or versions[0] == "UNREACHABLE"):
+        return f"no schema agreement: {len(versions)} schema versions"
+    return None
+
+
+def wait_for_cluster(public_ips, cluster_user, ssh_options, timeout_seconds=600, expected_nodes=None,
+                     schema_agreement=False, poll_seconds=2):
+    """
+    Waits until every node serves CQL and sees all nodes as UN in 'nodetool status'. All nodes
+    are probed in parallel every poll_seconds; on a timeout an exception with the reason per
+    node (and the tail of the scylla-server journal) is raised.
+
+    Parameters
+    ----------
+    expected_nodes: int
+        The number of nodes every node should see as UN; defaults to len(public_ips). If 0,
+        only the nodes themselves need to be up (e.g. when other nodes are stopped).
+    schema_agreement: bool
+        Also wait until 'nodetool describecluster' reports a single schema version.
+    """
+    if expected_nodes is None:
+        expected_nodes = len(public_ips)
+    log_important(f"Waiting for {len(public_ips)} nodes to be ready: started")
+    start = time.time()
+    pending = list(public_ips)
+    reasons = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(public_ips))) as executor:
+        while True:
+            results = list(executor.map(lambda ip: _probe(ip, cluster_user, ssh_options, expected_nodes or None,
+                                                          schema_agreement), pending))
+            for ip, reason in zip(pending, results):
+                if reason is None:
+                    print(f'    [{ip}] Ready after {time.time() - start:.1f}s')
+            reasons = {ip: reason for ip, reason in zip(pending, results) if reason is not None}
+            pending = list(reasons.keys())
+            if not pending:
+                break
+            if time.time() - start > timeout_seconds:
+                break
+            sleep(poll_seconds)
+
+    if pending:
+        for ip in pending:
+            print(f'    [{ip}] Not ready: {reasons[ip]}')
+            SSH(ip, cluster_user, ssh_options).exec(
+                "systemctl is-active scylla-server; sudo journalctl -u scylla-server -n 20 --no-pager",
+                ignore_errors=True)
+        raise Exception(f"Nodes {pending} not ready after {timeout_seconds}s: "
+                        + "; ".join(f"{ip}: {reason}" for ip, reason in reasons.items()))
+    log_important(f"Waiting for {len(public_ips)} nodes to be ready: done in {time.time() - start:.1f}s")
+
+
+def clear_cluster(cluster_public_ips, cluster_user, ssh_options, duration_seconds=None, timeout_seconds=600,
+                  schema_agreement=False):
+    """
+    Parameters
+    ----------
+    duration_seconds: int
+        If set, waits this long after starting instead of probing until the cluster is ready.
+    """
     print("Shutting down cluster and removing all data")
     pssh = PSSH(cluster_public_ips, cluster_user, ssh_options);
     #pssh.exec("nodetool flush")
@@ -15,25 +136,39 @@ def clear_cluster(cluster_public_ips, cluster_user, ssh_options, duration_second
     pssh.exec("sudo rm -fr /var/lib/scylla/commitlog/*")
     print("Starting scylla")
     pssh.exec("sudo systemctl start scylla-server")
-    print(f"Waiting {duration_seconds} seconds")
-    sleep(duration_seconds)
+    _wait(cluster_public_ips, cluster_user, ssh_options, duration_seconds, timeout_seconds, schema_agreement)
     print("Cluster cleared and restarted")
 
-    
-def restart_cluster(cluster_public_ips, cluster_user, ssh_options, duration_seconds=90):
+
+def restart_cluster(cluster_public_ips, cluster_user, ssh_options, duration_seconds=None, timeout_seconds=600,
+                    schema_agreement=False):
+    """
+    Parameters
+    ----------
+    duration_seconds: int
+        If set, waits this long after starting instead of probing until the cluster is ready.
+    """
     print("Restart cluster ")
     pssh = PSSH(cluster_public_ips, cluster_user, ssh_options);
     print("nodetool drain")
     pssh.exec("nodetool drain")
-    print("sudo systemctl stop scylla-server")    
+    print("sudo systemctl stop scylla-server")
     pssh.exec("sudo systemctl stop scylla-server")
-    print("sudo systemctl start scylla-server")    
+    print("sudo systemctl start scylla-server")
     pssh.exec("sudo systemctl start scylla-server")
-    print(f"Waiting {duration_seconds} seconds")
-    sleep(duration_seconds)
+    _wait(cluster_public_ips, cluster_user, ssh_options, duration_seconds, timeout_seconds, schema_agreement)
     print("Cluster restarted")
 
 
+def _wait(cluster_public_ips, cluster_user, ssh_options, duration_seconds, timeout_seconds, schema_agreement):
+    if duration_seconds is not None:
+        print(f"Waiting {duration_seconds} seconds")
+        sleep(duration_seconds)
+    else:
+        wait_for_cluster(cluster_public_ips, cluster_user, ssh_options, timeout_seconds=timeout_seconds,
+                         schema_agreement=schema_agreement)
+
+
 def nodes_remove_data(cluster_user, ssh_options, *public_ips):
     print(f"Removing data from nodes {public_ips}")
     pssh = PSSH(public_ips, cluster_user, ssh_options);
@@ -50,8 +185,186 @@ def nodes_stop(cluster_user, ssh_options, *public_ips):
     print(f"Stopping nodes {public_ips}: done")
 
 
-def nodes_start(cluster_user, ssh_options, *public_ips):
+def nodes_start(cluster_user, ssh_options, *public_ips, wait=True, timeout_seconds=600):
+    """
+    Parameters
+    ----------
+    wait: bool
+        Wait until the started nodes serve CQL and are UN; other nodes can be down.
+    """
     print(f"Starting nodes {public_ips}")
     pssh = PSSH(public_ips, cluster_user, ssh_options);
     pssh.exec("sudo systemctl start scylla-server")
+    if wait:
+        wait_for_cluster(public_ips, cluster_user, ssh_options, timeout_seconds=timeout_seconds, expected_nodes=0)
     print(f"Starting nodes {public_ips}: done")
+
+
+SCYLLA_DIR = "/var/lib/scylla"
+
+# Restores the snapshot {tag} of the user keyspaces {keyspaces} by hard linking the sstables of
+# the snapshot into the table directories; the system keyspaces (and so the schema) are kept.
+_RESTORE_SCRIPT = """
+set -e
+cd {scylla_dir}/data
+restored=0
+for snapshot in {keyspaces}/*/snapshots/{tag}; do
+    [ -d "$snapshot" ] || continue
+    case "$snapshot" in system*) continue;; esac
+    table_dir=$(dirname "$(dirname "$snapshot")")
+    find "$table_dir" -maxdepth 1 -type f -delete
+    find "$snapshot" -maxdepth 1 -type f ! -name manifest.json ! -name schema.cql -exec ln {{}} "$table_dir/" \\;
+    restored=$((restored + 1))
+done
+if [ $restored -eq 0 ]; then
+    echo "No snapshot {tag} found"
+    exit 2
+fi
+echo "Restored $restored tables"
+rm -fr {scylla_dir}/commitlog/* {scylla_dir}/hints/*
+"""
+
+
+def snapshot_cluster(cluster_public_ips, cluster_user, ssh_options, tag="sso-dataset", keyspaces=None):
+    """
+    Flushes and snapshots the keyspaces (default all) on all nodes, so the dataset can be
+    restored with restore_snapshot instead of loading it again. A snapshot hard links the
+    sstables, so it takes no time and no space as long as the sstables exist.
+    """
+    log_important(f"Snapshot {tag}: started")
+    keyspaces = " ".join(keyspaces) if keyspaces else ""
+    pssh = PSSH(cluster_public_ips, cluster_user, ssh_options)
+    pssh.exec(f"nodetool flush {keyspaces}")
+    pssh.exec(f"nodetool clearsnapshot -t {tag} {keyspaces} && nodetool snapshot -t {tag} {keyspaces}")
+    log_important(f"Snapshot {tag}: done")
+
+
+def has_snapshot(cluster_public_ips, cluster_user, ssh_options, tag="sso-dataset"):
+    """
+    Returns True if every node has the snapshot.
+    """
+    command = f"sudo sh -c 'ls -d {SCYLLA_DIR}/data/*/*/snapshots/{tag}' > /dev/null 2>&1"
+    with ThreadPoolExecutor(max_workers=max(1, len(cluster_public_ips))) as executor:
+        return all(executor.map(lambda ip: SSH(ip, cluster_user, ssh_options).test(command), cluster_public_ips))
+
+
+def restore_snapshot(cluster_public_ips, cluster_user, ssh_options, tag="sso-dataset", keyspaces=None,
+                     timeout_seconds=600):
+    """
+    Resets the keyspaces (default all user keyspaces) to the snapshot taken by snapshot_cluster:
+    the nodes are stopped, the sstables of the tables are replaced by hard links to the sstables
+    of the snapshot, the commitlog and hints are removed and the nodes are started again. The
+    time it takes doesn't depend on the size of the dataset. The snapshot is kept, so it can
+    be restored again.
+    """
+    log_important(f"Restore snapshot {tag}: started")
+    pattern = "{" + ",".join(keyspaces) + "}" if keyspaces and len(keyspaces) > 1 else (keyspaces[0] if keyspaces else "*")
+    script = _RESTORE_SCRIPT.format(scylla_dir=SCYLLA_DIR, keyspaces=pattern, tag=tag)
+    pssh = PSSH(cluster_public_ips, cluster_user, ssh_options)
+    pssh.exec("sudo systemctl stop scylla-server")
+    pssh.exec(f"sudo bash -c {shlex.quote(script)}")
+    pssh.exec("sudo systemctl start scylla-server")
+    wait_for_cluster(cluster_public_ips, cluster_user, ssh_options, timeout_seconds=timeout_seconds)
+    log_important(f"Restore snapshot {tag}: done")
+
+
+def reset_dataset(cluster_public_ips, cluster_user, ssh_options, populate, tag="sso-dataset", keyspaces=None):
+    """
+    Resets the cluster to a checkpoint of the dataset: the first time (no snapshot on every
+    node) the cluster is cleared, populate is called (e.g. to CassandraStress.insert the data)
+    and a snapshot is taken; every next time the snapshot is restored.
+    """
+    if has_snapshot(cluster_public_ips, cluster_user, ssh_options, tag):
+        restore_snapshot(cluster_public_ips, cluster_user, ssh_options, tag, keyspaces)
+        return
+    clear_cluster(cluster_public_ips, cluster_user, ssh_options)
+    populate()
+    snapshot_cluster(cluster_public_ips, cluster_user, ssh_options, tag, keyspaces)
+
+
+_PENDING_TASKS = re.compile(r'pending tasks:\s*(\d+|n/a)')
+
+
+def _parse_compactionstats(output):
+    """
+    Returns (pending tasks, active compactions) or None if the output can't be parsed. If the
+    number of pending tasks isn't available ('pending tasks: n/a'), it's 0 and only the active
+    compactions count.
+    """
+    match = _PENDING_TASKS.search(output)
+    if not match:
+        return None
+    active = 0
+    in_table = False
+    for line in output.splitlines():
+        if "compaction type" in line:
+            in_table = True
+        elif in_table and line.strip() and not line.startswith("Active compaction remaining time"):
+            active += 1
+    return 0 if match.group(1) == "n/a" else int(match.group(1)), active
+
+
+def wait_for_compactions(cluster_public_ips, cluster_user, ssh_options, dir=None, flush=False, major=False,
+                         keyspaces=None, quiet_seconds=30, poll_seconds=5, timeout_seconds=3600):
+    """
+    Waits until the cluster is quiescent: no node has pending or active compactions for
+    quiet_seconds. Call it between loading the data and the benchmark, so compactions of the
+    load don't pollute the measured latencies.
+
+    Parameters
+    ----------
+    dir: str
+        If set (e.g. the iteration dir), the time it took is appended to compactions.txt.
+    flush: bool
+        Flush the memtables first.
+    major: bool
+        Run a major compaction (nodetool compact) on all nodes first.
+    keyspaces: list
+        The keyspaces to flush/compact; all if None.
+
+    Returns
+    -------
+    The number of seconds it took.
+    """
+    log_important("Waiting for compactions: started")
+    start = time.time()
+    keyspaces = " ".join(keyspaces) if keyspaces else ""
+    pssh = PSSH(cluster_public_ips, cluster_user, ssh_options)
+    if flush:
+        pssh.exec(f"nodetool flush {keyspaces}")
+    if major:
+        pssh.exec(f"nodetool compact {keyspaces}")
+
+    def stats(ip):
+        try:
+            return _parse_compactionstats(SSH(ip, cluster_user, ssh_options).output("nodetool compactionstats"))
+        except Exception:
+            return None
+
+    quiet_since = None
+    states = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(cluster_public_ips))) as executor:
+        while True:
+            states = dict(zip(cluster_public_ips, executor.map(stats, cluster_public_ips)))
+            busy = {ip: state for ip, state in states.items() if state is None or state != (0, 0)}
+            now = time.time()
+            if busy:
+                quiet_since = None
+                print(f"    {len(busy)} nodes busy: " + ", ".join(
+                    f"[{ip}] {'unknown' if state is None else f'{state[0]} pending, {state[1]} active'}"
+                    for ip, state in busy.items()))
+            elif quiet_since is None:
+                quiet_since = now
+            if quiet_since is not None and now - quiet_since >= quiet_seconds:
+                break
+            if now - start > timeout_seconds:
+                raise Exception(f"Compactions not settled after {timeout_seconds}s: {busy}")
+            sleep(poll_seconds)
+
+    duration = time.time() - start
+    if dir is not None:
+        with open(os.path.join(dir, "compactions.txt"), "a") as f:
+            print(f"start={start:.3f} duration_seconds={duration:.1f} flush={flush} major={major} "
+                  f"quiet_seconds={quiet_seconds}", file=f)
+    log_important(f"Waiting for compactions: done in {duration:.1f}s")
+    return duration
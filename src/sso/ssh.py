@@ -1,32 +1,188 @@
+import asyncio
+import atexit
 import os
+import shlex
+import shutil
+import socket
 import subprocess
+import tempfile
 import time
-from sso.util import run_parallel
+from threading import Lock
+from sso import util
+from sso.artifacts import sha512sum
+from sso.util import run_parallel, WorkerThread
+
+# The ssh/scp calls to a host are multiplexed over a single master connection (OpenSSH
+# ControlMaster), so that not every call needs to do a full handshake. Set to False to
+# disable.
+multiplexing = True
+# How long an idle master connection stays alive.
+CONTROL_PERSIST = "15m"
+
+_control_dir = None
+# (user, ip, ssh options) -> [lock, alive] of the master connection; once a master is known to
+# be alive, it is only checked again after a command failed to connect.
+_masters = {}
+_lock = Lock()
+
+
+def _control_options(ssh_options):
+    global _control_dir
+    if not multiplexing or "ControlPath" in ssh_options:
+        return ""
+
+    with _lock:
+        if _control_dir is None:
+            _control_dir = tempfile.mkdtemp(prefix="sso-ssh-")
+    # %C is a hash of the connection; keeps the path short enough for a unix socket.
+    return f"-o ControlPath={_control_dir}/%C"
+
+
+def _master(user, ip, ssh_options):
+    with _lock:
+        key = (user, ip, ssh_options)
+        entry = _masters.get(key)
+        if entry is None:
+            entry = [Lock(), False]
+            _masters[key] = entry
+        return entry
+
+
+def close_connections():
+    """
+    Closes all master connections. Is called automatically on exit.
+    """
+    global _control_dir
+    with _lock:
+        for user, ip, ssh_options in _masters.keys():
+            subprocess.call(f'ssh {ssh_options} -O exit {user}@{ip}', shell=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _masters.clear()
+        if _control_dir is not None:
+            shutil.rmtree(_control_dir, ignore_errors=True)
+            _control_dir = None
+
+
+atexit.register(close_connections)
+
+# The hosts that have been updated by this process; so repeated updates are skipped.
+_updated_hosts = {}
+
+
+def _update_entry(user, ip):
+    with _lock:
+        entry = _updated_hosts.get((user, ip))
+        if entry is None:
+            entry = [Lock(), False]
+            _updated_hosts[(user, ip)] = entry
+        return entry
+
+_print_lock = Lock()
+# The longest line of remote output that is streamed.
+MAX_LINE_LENGTH = 16 * 1024 * 1024
+
+
+# Lists the files matching {src}: the first line tells if zstd is available, followed by a line
+# per file: absolute parent dir, size, modification time and the path relative to that dir.
+_LIST_SCRIPT = """
+if hash zstd 2>/dev/null; then echo zstd; else echo gzip; fi
+for p in {src}; do
+    [ -e "$p" ] || continue
+    d=$(cd "$(dirname "$p")" && pwd)
+    (cd "$d" && find "$(basename "$p")" -type f -printf "$d\\t%s\\t%T@\\t%p\\n")
+done
+"""
+
+
+def _unchanged(dst_dir, file):
+    dir, size, mtime, path = file
+    try:
+        stat = os.stat(os.path.join(dst_dir, path))
+    except FileNotFoundError:
+        return False
+    return stat.st_size == size and int(stat.st_mtime) == mtime
+
+
+def _print_line(prefix, line):
+    with _print_lock:
+        print(f"{prefix}{line.decode(errors='replace').rstrip()}", flush=True)
+
+
+async def _run_streamed(args, prefix, timeout_seconds=None, stdin_path=None):
+    """
+    Runs the process and prints its stdout/stderr line by line with the given prefix; so the
+    output of processes running in parallel doesn't get interleaved. Returns the exit code.
+    """
+    if stdin_path is None:
+        return await _run_process_streamed(args, prefix, timeout_seconds, subprocess.DEVNULL)
+    with open(stdin_path, "rb") as stdin:
+        return await _run_process_streamed(args, prefix, timeout_seconds, stdin)
+
+
+async def _run_process_streamed(args, prefix, timeout_seconds, stdin):
+    process = await asyncio.create_subprocess_exec(*args, stdin=stdin, stdout=subprocess.PIPE,
+                                                   stderr=subprocess.STDOUT, limit=MAX_LINE_LENGTH)
+
+    async def stream():
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            _print_line(prefix, line)
+        return await process.wait()
+
+    try:
+        return await asyncio.wait_for(stream(), timeout_seconds)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise TimeoutError(f"{prefix}Timed out after {timeout_seconds} seconds")
 
 
 # Parallel SSH
 class PSSH:
 
-    def __init__(self, ip_list, user, ssh_options, wait_for_connect=True, silent_seconds=30):
+    def __init__(self, ip_list, user, ssh_options, wait_for_connect=True, silent_seconds=30,
+                 max_in_flight=None, timeout_seconds=None):
+        """
+        Parameters
+        ----------
+        max_in_flight: int
+            The maximum number of hosts a command is executed on concurrently. Defaults to 
+            util.max_parallelism.
+        timeout_seconds: int
+            The maximum time a command can take on a single host. No timeout if None.
+        """
         self.ip_list = ip_list
         self.user = user
         self.ssh_options = ssh_options
         self.wait_for_connect = wait_for_connect
         self.silent_seconds = silent_seconds
+        self.max_in_flight = max_in_flight if max_in_flight is not None else util.max_parallelism
+        self.timeout_seconds = timeout_seconds
         self.log_ssh = False
 
     def __new_ssh(self, ip):
         return SSH(ip, self.user, self.ssh_options, wait_for_connect=self.wait_for_connect,
                    silent_seconds=self.silent_seconds)
 
-    def __exec(self, ip, cmd):
-        self.__new_ssh(ip).exec(cmd)
+    async def __exec(self, ip, cmd, semaphore, ignore_errors):
+        async with semaphore:
+            await self.__new_ssh(ip).exec_async(cmd, ignore_errors=ignore_errors, timeout_seconds=self.timeout_seconds)
 
-    def exec(self, cmd):
-        run_parallel(self.__exec, [(ip, cmd) for ip in self.ip_list])
+    async def __exec_all(self, cmd, ignore_errors):
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        results = await asyncio.gather(*[self.__exec(ip, cmd, semaphore, ignore_errors) for ip in self.ip_list],
+                                       return_exceptions=True)
+        failures = [(ip, result) for ip, result in zip(self.ip_list, results) if isinstance(result, BaseException)]
+        if failures:
+            raise Exception(f"Failed to execute on {[ip for ip, _ in failures]}") from failures[0][1]
+
+    def exec(self, cmd, ignore_errors=False):
+        asyncio.run(self.__exec_all(cmd, ignore_errors))
 
     def async_exec(self, command):
-        thread = WorkerThread(self.exec, (command))
+        thread = WorkerThread(self.exec, (command,))
         thread.start()
         return thread.future
 
@@ -34,43 +190,69 @@ class PSSH:
         self.__new_ssh(ip).update()
 
     def update(self):
-        # todo: needs to be fixed; should be parallel, now sequential
-        for ip in self.ip_list:
-            ssh = SSH(ip, self.user, self.ssh_options)
-            ssh.update()
-
-        # can't get this to run correctly.
-        #run_parallel(self.__update, [ip for ip in self.ip_list])
+        run_parallel(self.__update, [(ip,) for ip in self.ip_list], max_workers=self.max_in_flight)
 
     def __install_one(self, ip, *packages):
         self.__new_ssh(ip).install_one(*packages)
 
     def install_one(self, *packages):
-        run_parallel(self.__install_one, [(ip, *packages) for ip in self.ip_list])
+        run_parallel(self.__install_one, [(ip, *packages) for ip in self.ip_list], max_workers=self.max_in_flight)
 
     def __try_install(self, ip, *packages):
         self.__new_ssh(ip).try_install(*packages)
 
     def try_install(self, *packages):
-        run_parallel(self.__try_install, [(ip, *packages) for ip in self.ip_list])
+        run_parallel(self.__try_install, [(ip, *packages) for ip in self.ip_list], max_workers=self.max_in_flight)
 
     def __install(self, ip, *packages):
         self.__new_ssh(ip).install(*packages)
 
     def install(self, *packages):
-        run_parallel(self.__install, [(ip, *packages) for ip in self.ip_list])
+        run_parallel(self.__install, [(ip, *packages) for ip in self.ip_list], max_workers=self.max_in_flight)
 
     def __scp_from_remote(self, src, dst_dir, ip):
         self.__new_ssh(ip).scp_from_remote(src,  os.path.join(dst_dir, ip))
 
     def scp_from_remote(self, src, dst_dir):
-        run_parallel(self.__scp_from_remote, [(src, dst_dir, ip) for ip in self.ip_list])
+        run_parallel(self.__scp_from_remote, [(src, dst_dir, ip) for ip in self.ip_list],
+                     max_workers=self.max_in_flight)
+
+    def __download(self, src, dst_dir, ip):
+        self.__new_ssh(ip).download(src, os.path.join(dst_dir, ip))
+
+    def download(self, src, dst_dir):
+        """
+        Downloads src from every host into dst_dir/<ip>; see SSH.download.
+        """
+        run_parallel(self.__download, [(src, dst_dir, ip) for ip in self.ip_list], max_workers=self.max_in_flight)
 
     def __scp_to_remote(self, src, dst, ip):
          self.__new_ssh(ip).scp_to_remote(src, dst)
          
-    def scp_to_remote(self, src, dst):
-        run_parallel(self.__scp_to_remote, [(src, dst, ip) for ip in self.ip_list])
+    def __is_dir(self, dst, ip, result):
+        result[ip] = self.__new_ssh(ip).test(f"[ -d {dst} ]")
+
+    def scp_to_remote(self, src, dst, relay_fanout=None):
+        """
+        Copies src to dst on all hosts, like scp. If dst is a directory (ends with '/' or is a
+        directory on all hosts), an existing local file or directory is archived once and
+        skipped on hosts that already have it; see Distributor.
+        """
+        to_dir = os.path.exists(src) and (dst == "" or dst.endswith("/"))
+        if os.path.exists(src) and not to_dir:
+            is_dir = {}
+            run_parallel(self.__is_dir, [(dst, ip, is_dir) for ip in self.ip_list], max_workers=self.max_in_flight)
+            to_dir = all(is_dir.values())
+        if not to_dir:
+            # e.g. a glob or a target file; copied by scp to every host.
+            run_parallel(self.__scp_to_remote, [(src, dst, ip) for ip in self.ip_list],
+                         max_workers=self.max_in_flight)
+            return
+
+        # imported here because sso.distribute depends on this module.
+        from sso.distribute import Distributor
+        Distributor(self.ip_list, self.user, self.ssh_options, relay_fanout=relay_fanout,
+                    max_in_flight=self.max_in_flight).distribute(src, dst)
 
   
 class SSH:
@@ -78,16 +260,56 @@ class SSH:
     def __init__(self, ip, user, ssh_options, wait_for_connect=True, silent_seconds=30):
         self.ip = ip
         self.user = user
-        self.ssh_options = ssh_options
+        control_options = _control_options(ssh_options)
+        self.multiplexed = control_options != ""
+        self.ssh_options = f"{ssh_options} {control_options}" if self.multiplexed else ssh_options
         self.wait_for_connect = wait_for_connect
         self.silent_seconds = silent_seconds
         self.log_ssh = False
 
+    def __master_alive(self):
+        cmd = f'ssh {self.ssh_options} -O check {self.user}@{self.ip}'
+        return subprocess.call(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
     def __wait_for_connect(self):
-        if not self.wait_for_connect:
+        if not self.multiplexed:
+            if self.wait_for_connect:
+                self.__connect(f'ssh {self.ssh_options} {self.user}@{self.ip} ls')
+            return
+
+        master = _master(self.user, self.ip, self.ssh_options)
+        if master[1]:
+            self.wait_for_connect = False
             return
 
-        cmd = f'ssh {self.ssh_options} {self.user}@{self.ip} ls'
+        # only one thread should start the master connection for a host.
+        with master[0]:
+            if master[1]:
+                self.wait_for_connect = False
+                return
+            if self.__master_alive():
+                master[1] = True
+                self.wait_for_connect = False
+                return
+
+            # starts the master connection in the background once it is connected.
+            cmd = f'ssh {self.ssh_options} -o ControlMaster=yes -o ControlPersist={CONTROL_PERSIST} -N -f {self.user}@{self.ip}'
+            if self.wait_for_connect:
+                self.__connect(cmd)
+                master[1] = True
+            else:
+                # best effort; without a master ssh falls back to a direct connection.
+                master[1] = subprocess.call(cmd, shell=True, stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.DEVNULL) == 0
+
+    def __check_connection(self, exitcode):
+        # ssh exits with 255 if it failed to connect (e.g. the master connection is gone); the
+        # master is checked again by the next command.
+        if exitcode == 255 and self.multiplexed:
+            _master(self.user, self.ip, self.ssh_options)[1] = False
+        return exitcode
+
+    def __connect(self, cmd):
         exitcode = None
         for i in range(1, 300):
             if i > self.silent_seconds:
@@ -112,28 +334,215 @@ class SSH:
         cmd = f'scp {self.ssh_options} -r -q {src} {self.user}@{self.ip}:{dst}'
         self.__scp(cmd)
 
+    def download(self, src, dst_dir, compress=True, checksum=False, exclude=None):
+        """
+        Downloads src (a remote path or glob, like scp_from_remote) into dst_dir. The files are
+        streamed as a single (compressed) tar over the ssh connection and extracted on the fly.
+        Files that already exist locally with the same size and modification time are skipped.
+
+        Parameters
+        ----------
+        compress: bool
+            Compress with zstd, or gzip if zstd isn't available on both ends.
+        checksum: bool
+            Also compare the sha512 of the files that look unchanged, before skipping them.
+        exclude: list
+            File names that aren't downloaded.
+        """
+        os.makedirs(dst_dir, exist_ok=True)
+        listing = self.output(f"bash -c {shlex.quote(_LIST_SCRIPT.replace('{src}', src))}").splitlines()
+        remote_zstd = listing[0] == "zstd"
+        files = []
+        for line in listing[1:]:
+            dir, size, mtime, path = line.split("\t", 3)
+            if exclude and os.path.basename(path) in exclude:
+                continue
+            files.append((dir, int(size), int(float(mtime)), path))
+
+        skipped = [f for f in files if _unchanged(dst_dir, f)]
+        if checksum and skipped:
+            skipped = self.__same_checksum(dst_dir, skipped)
+        skipped_paths = set((dir, path) for dir, _, _, path in skipped)
+        files = [f for f in files if (f[0], f[3]) not in skipped_paths]
+        if not files:
+            print(f'    [{self.ip}] Download of {src}: up to date, skipped {len(skipped)} files')
+            return
+
+        if not compress:
+            compressor, decompressor = "cat", "cat"
+        elif remote_zstd and shutil.which("zstd"):
+            compressor, decompressor = "zstd -q -T0 -3 -c", "zstd -q -d -c"
+        else:
+            compressor, decompressor = "gzip -1 -c", "gzip -d -c"
+
+        # -C entries in the file list change the directory for the files that follow.
+        file_list = ""
+        previous_dir = None
+        for dir, _, _, path in files:
+            if dir != previous_dir:
+                file_list += f"-C{dir}\n"
+                previous_dir = dir
+            file_list += f"{path}\n"
+        self.__wait_for_connect()
+        args = ['ssh'] + shlex.split(self.ssh_options) + [
+            f'{self.user}@{self.ip}', f"tar -cf - --no-recursion -T - | {compressor}"]
+        start = time.time()
+        transferred = 0
+        ssh_process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        extract = subprocess.Popen(
+            ['bash', '-o', 'pipefail', '-c', f"{decompressor} | tar -xf - -C {shlex.quote(dst_dir)}"],
+            stdin=subprocess.PIPE)
+        # tar starts sending while it is still reading the file list; writing the list from a
+        # separate thread prevents a deadlock when both pipes are full.
+        feeder = WorkerThread(self.__write_file_list, (ssh_process.stdin, file_list.encode()))
+        feeder.start()
+        try:
+            for chunk in iter(lambda: ssh_process.stdout.read(1024 * 1024), b""):
+                transferred += len(chunk)
+                extract.stdin.write(chunk)
+        finally:
+            extract.stdin.close()
+            ssh_exitcode = ssh_process.wait()
+            extract_exitcode = extract.wait()
+            feeder.join()
+        if ssh_exitcode != 0 or extract_exitcode != 0:
+            raise Exception(f"Failed to download {src} from {self.ip}, exitcodes={ssh_exitcode},{extract_exitcode}")
+
+        duration = max(time.time() - start, 0.001)
+        size = sum(f[1] for f in files)
+        print(f'    [{self.ip}] Downloaded {len(files)} files ({size / (1024 * 1024):.1f} MB, '
+              f'{transferred / (1024 * 1024):.1f} MB transferred) in {duration:.1f}s '
+              f'({size / duration / (1024 * 1024):.1f} MB/s), skipped {len(skipped)} files')
+
+    @staticmethod
+    def __write_file_list(stdin, file_list):
+        try:
+            stdin.write(file_list)
+        except BrokenPipeError:
+            # ssh failed; reported by its exit code.
+            pass
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def __same_checksum(self, dst_dir, files):
+        paths = "".join(f"{dir}/{path}\n" for dir, _, _, path in files)
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write(paths)
+            f.flush()
+            output = self.output("xargs -r -d '\\n' sha512sum", stdin_path=f.name)
+        remote = {}
+        for line in output.splitlines():
+            checksum, path = line.split("  ", 1)
+            remote[path] = checksum
+        return [f for f in files
+                if remote.get(f"{f[0]}/{f[3]}") == sha512sum(os.path.join(dst_dir, f[3]))]
+
+    def output(self, command, stdin_path=None):
+        """
+        Returns the stdout (text) of the command. Raises an exception if the command fails.
+        """
+        self.__wait_for_connect()
+
+        args = ['ssh'] + shlex.split(self.ssh_options) + [f'{self.user}@{self.ip}', command]
+        if stdin_path is None:
+            result = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, text=True)
+        else:
+            with open(stdin_path, "rb") as stdin:
+                result = subprocess.run(args, stdin=stdin, stdout=subprocess.PIPE)
+            result.stdout = result.stdout.decode(errors='replace')
+        if self.__check_connection(result.returncode) != 0:
+            raise Exception(f"Failed to execute {shlex.join(args)}, exitcode={result.returncode}")
+        return result.stdout
+
+    def output_to_file(self, command, path):
+        """
+        Writes the stdout (binary) of the command to the local file, without buffering it in
+        memory. Raises an exception if the command fails.
+        """
+        self.__wait_for_connect()
+
+        args = ['ssh'] + shlex.split(self.ssh_options) + [f'{self.user}@{self.ip}', command]
+        with open(path, "wb") as out:
+            exitcode = self.__check_connection(subprocess.call(args, stdin=subprocess.DEVNULL, stdout=out))
+        if exitcode != 0:
+            raise Exception(f"Failed to execute {shlex.join(args)}, exitcode={exitcode}")
+
     def __scp(self, cmd):
         self.__wait_for_connect()
-        exitcode = subprocess.call(cmd, shell=True)
+        exitcode = self.__check_connection(subprocess.call(cmd, shell=True))
         # raise Exception(f"Failed to execute {cmd} after {self.max_attempts} attempts")
 
-    def exec(self, command, ignore_errors=False):
-        self.__wait_for_connect()
+    def exec(self, command, ignore_errors=False, timeout_seconds=None, stdin_path=None):
+        asyncio.run(self.exec_async(command, ignore_errors=ignore_errors, timeout_seconds=timeout_seconds,
+                                    stdin_path=stdin_path))
+
+    async def exec_async(self, command, ignore_errors=False, timeout_seconds=None, stdin_path=None):
+        """
+        Parameters
+        ----------
+        stdin_path: str
+            The local file that is fed to the stdin of the remote command.
+        """
+        await asyncio.to_thread(self.__wait_for_connect)
 
-        cmd = f'ssh {self.ssh_options} {self.user}@{self.ip} \'{command}\''
-        exitcode = subprocess.call(cmd, shell=True)
+        args = ['ssh'] + shlex.split(self.ssh_options) + [f'{self.user}@{self.ip}', command]
+        exitcode = self.__check_connection(await _run_streamed(args, f'[{self.ip}] ', timeout_seconds, stdin_path))
 
         if ignore_errors or exitcode == 0 or exitcode == 1:  # todo: we need to deal better with exit code
             return
         else:
-            raise Exception(f"Failed to execute {cmd}, exitcode={exitcode}")
+            raise Exception(f"Failed to execute {shlex.join(args)}, exitcode={exitcode}")
 
     def async_exec(self, command):
-        thread = WorkerThread(self.exec, (command))
+        thread = WorkerThread(self.exec, (command,))
         thread.start()
         return thread.future
 
-    def update(self):
+    def test(self, command):
+        """
+        Returns True if the command exits with 0. The output of the command is discarded.
+        """
+        self.__wait_for_connect()
+
+        args = ['ssh'] + shlex.split(self.ssh_options) + [f'{self.user}@{self.ip}', command]
+        return self.__check_connection(subprocess.call(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                                       stderr=subprocess.DEVNULL)) == 0
+
+    def popen(self, command):
+        """
+        Starts the command on the remote machine without waiting for it to complete. The
+        stdout of the remote command can be read (text) from the returned process.
+        """
+        self.__wait_for_connect()
+
+        # exec so that terminating the process terminates ssh and not just the shell.
+        cmd = f'exec ssh {self.ssh_options} {self.user}@{self.ip} \'{command}\''
+        return subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL, text=True)
+
+    def tunnel(self, remote_port, remote_host="localhost"):
+        """
+        Forwards a free local port to remote_host:remote_port (as seen from the host).
+        """
+        self.__wait_for_connect()
+        return Tunnel(self, remote_port, remote_host)
+
+    def update(self, force=False):
+        """
+        Updates the package index. A host is only updated once per process unless force is True.
+        """
+        entry = _update_entry(self.user, self.ip)
+        # prevents concurrent updates of the same host from fighting over the package manager lock.
+        with entry[0]:
+            if entry[1] and not force:
+                print(f'    [{self.ip}] Update: skipped, already updated')
+                return
+            self.__update()
+            entry[1] = True
+
+    def __update(self):
         print(f'    [{self.ip}] Update: started')
         self.exec(
             f"""
@@ -196,3 +605,34 @@ class SSH:
                     exit 1
                 fi
                 """, ignore_errors=ignore_errors)
+
+
+class Tunnel:
+    """
+    A local port forwarded over ssh; see SSH.tunnel.
+    """
+
+    def __init__(self, ssh, remote_port, remote_host, timeout_seconds=30):
+        with socket.socket() as s:
+            s.bind(("localhost", 0))
+            self.local_port = s.getsockname()[1]
+        args = ['ssh'] + shlex.split(ssh.ssh_options) + [
+            '-N', '-o', 'ExitOnForwardFailure=yes', '-L', f'{self.local_port}:{remote_host}:{remote_port}',
+            f'{ssh.user}@{ssh.ip}']
+        self.process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+        deadline = time.time() + timeout_seconds
+        while True:
+            try:
+                socket.create_connection(("localhost", self.local_port), timeout=1).close()
+                return
+            except OSError:
+                if self.process.poll() is not None or time.time() > deadline:
+                    self.close()
+                    raise Exception(f"Failed to forward port {self.local_port} to {ssh.ip}:{remote_port}")
+                time.sleep(0.1)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
@@ -0,0 +1,132 @@
+import math
+
+# Statistics for comparing benchmark results, without depending on scipy.
+
+
+def mean(samples):
+    return sum(samples) / len(samples)
+
+
+def variance(samples):
+    """
+    Returns the sample variance (n - 1).
+    """
+    if len(samples) < 2:
+        return 0.0
+    m = mean(samples)
+    return sum((x - m) ** 2 for x in samples) / (len(samples) - 1)
+
+
+def _betacf(a, b, x):
+    # continued fraction for the incomplete beta function (modified Lentz).
+    tiny = 1e-300
+    qab = a + b
+    qap = a + 1.0
+    qam = a - 1.0
+    c = 1.0
+    d = 1.0 - qab * x / qap
+    d = tiny if abs(d) < tiny else d
+    d = 1.0 / d
+    h = d
+    for m in range(1, 300):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1.0 + aa * d
+        d = tiny if abs(d) < tiny else d
+        c = 1.0 + aa / c
+        c = tiny if abs(c) < tiny else c
+        d = 1.0 / d
+        h *= d * c
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1.0 + aa * d
+        d = tiny if abs(d) < tiny else d
+        c = 1.0 + aa / c
+        c = tiny if abs(c) < tiny else c
+        d = 1.0 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < 1e-15:
+            break
+    return h
+
+
+def betainc(a, b, x):
+    """
+    Returns the regularized incomplete beta function I_x(a, b).
+    """
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log(1.0 - x))
+    if x < (a + 1.0) / (a + b + 2.0):
+        return front * _betacf(a, b, x) / a
+    return 1.0 - front * _betacf(b, a, 1.0 - x) / b
+
+
+def student_t_cdf(t, df):
+    if math.isinf(t):
+        return 1.0 if t > 0 else 0.0
+    tail = 0.5 * betainc(df / 2.0, 0.5, df / (df + t * t))
+    return 1.0 - tail if t > 0 else tail
+
+
+def student_t_ppf(p, df):
+    """
+    Returns t such that student_t_cdf(t, df) == p.
+    """
+    low, high = -1e6, 1e6
+    for i in range(200):
+        middle = (low + high) / 2
+        if student_t_cdf(middle, df) < p:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def welch_t_test(a, b):
+    """
+    Welch's t-test for the means of two samples with possibly different variances.
+
+    Returns
+    -------
+    (t, degrees of freedom, two sided p-value)
+    """
+    va = variance(a) / len(a)
+    vb = variance(b) / len(b)
+    difference = mean(b) - mean(a)
+    if va + vb == 0:
+        # no variance at all; any difference is significant.
+        return (0.0, math.inf, 1.0) if difference == 0 else (math.copysign(math.inf, difference), math.inf, 0.0)
+    t = difference / math.sqrt(va + vb)
+    df = (va + vb) ** 2 / ((va ** 2 / (len(a) - 1) if len(a) > 1 else 0) + (vb ** 2 / (len(b) - 1) if len(b) > 1 else 0))
+    p = 2 * (1 - student_t_cdf(abs(t), df))
+    return t, df, p
+
+
+def confidence_interval(samples, confidence=0.95):
+    """
+    Returns (mean, half width) of the confidence interval of the mean.
+    """
+    m = mean(samples)
+    if len(samples) < 2:
+        return m, math.inf
+    t = student_t_ppf(1 - (1 - confidence) / 2, len(samples) - 1)
+    return m, t * math.sqrt(variance(samples) / len(samples))
+
+
+def difference_confidence_interval(a, b, confidence=0.95):
+    """
+    Returns (mean(b) - mean(a), half width) of the (Welch) confidence interval of the difference.
+    """
+    va = variance(a) / len(a)
+    vb = variance(b) / len(b)
+    difference = mean(b) - mean(a)
+    if len(a) < 2 or len(b) < 2:
+        return difference, math.inf
+    if va + vb == 0:
+        return difference, 0.0
+    df = (va + vb) ** 2 / (va ** 2 / (len(a) - 1) + vb ** 2 / (len(b) - 1))
+    t = student_t_ppf(1 - (1 - confidence) / 2, df)
+    return difference, t * math.sqrt(va + vb)
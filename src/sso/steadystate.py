@@ -0,0 +1,154 @@
+import math
+
+from sso import hdrhistogram
+
+# Detection of the steady state of a benchmark from the intervals of an hdr log, so the warmup
+# and cooldown don't have to be guessed.
+
+
+def interval_series(log):
+    """
+    Returns (starts, ends, ops per second, p99 in ms) per interval of the log. The intervals
+    of the response time tags (see response_time_tags) starting at the same time are combined.
+    """
+    tags = set(hdrhistogram.response_time_tags(log.tags()))
+    by_start = {}
+    for interval in log.intervals:
+        if interval.tag not in tags:
+            continue
+        key = round(interval.start, 3)
+        if key not in by_start:
+            by_start[key] = (interval.start, interval.end, interval.histogram().copy())
+        else:
+            by_start[key][2].add(interval.histogram())
+    starts, ends, ops, p99 = [], [], [], []
+    for key in sorted(by_start):
+        start, end, histogram = by_start[key]
+        if end <= start:
+            continue
+        starts.append(start)
+        ends.append(end)
+        ops.append(histogram.total_count() / (end - start))
+        p99.append(histogram.value_at_percentile(99) / hdrhistogram.DEFAULT_VALUE_UNIT_RATIO)
+    return starts, ends, ops, p99
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def _noise(series):
+    """
+    Estimates the standard deviation of the noise from the differences of consecutive values;
+    unlike the standard deviation it isn't inflated by the level shifts that are searched for.
+    """
+    differences = [b - a for a, b in zip(series, series[1:])]
+    if not differences:
+        return 1.0
+    center = _median(differences)
+    sigma = _median([abs(d - center) for d in differences]) / 0.6745 / math.sqrt(2)
+    if sigma <= 0:
+        mean = sum(series) / len(series)
+        sigma = math.sqrt(sum((x - mean) ** 2 for x in series) / len(series))
+    # a constant series only has the rounding errors of the mean left; scaling by them would
+    # turn them into change points.
+    return sigma if sigma > 1e-9 * max(abs(x) for x in series) else 1.0
+
+
+class _Cost:
+    # the sum of the squared deviations from the mean of a segment, over all series, in O(1).
+
+    def __init__(self, series_list):
+        self.prefix = []
+        for series in series_list:
+            sums = [0.0]
+            squares = [0.0]
+            for x in series:
+                sums.append(sums[-1] + x)
+                squares.append(squares[-1] + x * x)
+            self.prefix.append((sums, squares))
+
+    def __call__(self, begin, end):
+        n = end - begin
+        cost = 0.0
+        for sums, squares in self.prefix:
+            total = sums[end] - sums[begin]
+            cost += squares[end] - squares[begin] - total * total / n
+        return cost
+
+
+def change_points(series_list, min_size=5, penalty=None):
+    """
+    Binary segmentation: splits [0, n) recursively at the point that reduces the cost the
+    most, as long as the reduction is larger than the penalty. The series should be scaled
+    to a noise of 1 (see _noise).
+
+    Returns
+    -------
+    The sorted indexes where a new segment starts.
+    """
+    n = len(series_list[0])
+    if penalty is None:
+        # BIC like: a mean per series and a location per change point.
+        penalty = 2 * (len(series_list) + 1) * math.log(max(n, 2))
+    cost = _Cost(series_list)
+    points = []
+    segments = [(0, n)]
+    while segments:
+        begin, end = segments.pop()
+        if end - begin < 2 * min_size:
+            continue
+        whole = cost(begin, end)
+        best, best_gain = None, penalty
+        for split in range(begin + min_size, end - min_size + 1):
+            gain = whole - cost(begin, split) - cost(split, end)
+            if gain > best_gain:
+                best, best_gain = split, gain
+        if best is not None:
+            points.append(best)
+            segments += [(begin, best), (best, end)]
+    return sorted(points)
+
+
+def detect(log, min_size=5, tolerance=0.1, penalty=None):
+    """
+    Detects the steady state window of the log. The intervals are split into segments at the
+    change points of the ops per second and the (log of the) p99; the longest segment is the
+    reference level. The steady state runs from the first to the last segment whose mean ops
+    and p99 are within tolerance (relative) of the reference; disturbances in between (e.g. a
+    compaction) are part of the steady state and are kept.
+
+    Returns
+    -------
+    A dict with begin and end (seconds since epoch) of the steady state, warmup_seconds and
+    cooldown_seconds relative to the begin and end of the log, the number of intervals and the
+    change_points (seconds since epoch); or None if the log has no intervals.
+    """
+    starts, ends, ops, p99 = interval_series(log)
+    if not starts:
+        return None
+    log_p99 = [math.log(max(value, 1e-6)) for value in p99]
+    scaled = [[x / _noise(series) for x in series] for series in (ops, log_p99)]
+    points = change_points(scaled, min_size=min_size, penalty=penalty)
+
+    bounds = [0] + points + [len(starts)]
+    segments = []
+    for begin, end in zip(bounds, bounds[1:]):
+        segments.append((begin, end, sum(ops[begin:end]) / (end - begin), sum(p99[begin:end]) / (end - begin)))
+    _, _, reference_ops, reference_p99 = max(segments, key=lambda segment: segment[1] - segment[0])
+    steady = [segment for segment in segments
+              if abs(segment[2] - reference_ops) <= tolerance * reference_ops
+              and abs(segment[3] - reference_p99) <= tolerance * reference_p99]
+    begin, end = steady[0][0], steady[-1][1]
+
+    log_begin, log_end = log.time_range()
+    return {
+        "begin": starts[begin],
+        "end": ends[end - 1],
+        "warmup_seconds": starts[begin] - log_begin,
+        "cooldown_seconds": log_end - ends[end - 1],
+        "change_points": [starts[point] for point in points],
+        "intervals": end - begin,
+    }
@@ -0,0 +1,228 @@
+import csv
+import json
+import os
+import struct
+
+from sso import telemetry_agent
+from sso.ssh import PSSH
+from sso.util import log_important
+
+# Where the agent and the ring file are kept on the hosts.
+REMOTE_TELEMETRY_DIR = ".sso/telemetry"
+RING_FILE = "telemetry.ring"
+
+
+def read_ring(path):
+    """
+    Returns (header, records) of a ring file written by telemetry_agent; records is a list of
+    (timestamp, {field: counter}) in time order.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:8] != telemetry_agent.MAGIC:
+        raise Exception(f"{path} isn't a telemetry ring file")
+    header_length = struct.unpack_from("<I", data, 8)[0]
+    header = json.loads(data[12:12 + header_length])
+    data_offset = (12 + header_length + 8 + 7) // 8 * 8
+    count = struct.unpack_from("<Q", data, data_offset - 8)[0]
+    fields = header['fields']
+    record = struct.Struct(f"<d{len(fields)}Q")
+    capacity = header['capacity']
+    records = []
+    for n in range(max(0, count - capacity), count):
+        values = record.unpack_from(data, data_offset + (n % capacity) * record.size)
+        records.append((values[0], dict(zip(fields, values[1:]))))
+    return header, records
+
+
+def _delta(previous, current, field):
+    return current.get(field, 0) - previous.get(field, 0)
+
+
+def _cpu_utilization(previous, current, cpu):
+    """
+    Returns (busy, softirq, steal) as fraction of the time of the cpu ('cpu' is all cpus).
+    """
+    deltas = {name: _delta(previous, current, f"{cpu}.{name}") for name in telemetry_agent.CPU_FIELDS}
+    total = sum(deltas.values())
+    if total <= 0:
+        return 0.0, 0.0, 0.0
+    idle = deltas['idle'] + deltas['iowait']
+    return (total - idle) / total, deltas['softirq'] / total, deltas['steal'] / total
+
+
+def to_series(header, records):
+    """
+    Converts the counters to a time series of rates: a list of rows (dicts) per interval.
+    """
+    fields = header['fields']
+    cpus = sorted({field.split(".")[0] for field in fields if field.startswith("cpu") and field[3:4].isdigit()},
+                  key=lambda cpu: int(cpu[3:]))
+    interfaces = sorted({field.split(".")[1] for field in fields if field.startswith("net.")})
+    disks = sorted({field.split(".")[1] for field in fields if field.startswith("disk.")})
+    softirqs = sorted({field.split(".")[1] for field in fields if field.startswith("softirq.")})
+
+    rows = []
+    for (previous_time, previous), (time, current) in zip(records, records[1:]):
+        seconds = time - previous_time
+        if seconds <= 0:
+            continue
+        busy, softirq, steal = _cpu_utilization(previous, current, "cpu")
+        row = {"time": round(time, 3), "cpu_busy": busy, "cpu_softirq": softirq, "cpu_steal": steal}
+        per_cpu = [_cpu_utilization(previous, current, cpu)[0] for cpu in cpus]
+        row["cpu_busy_max"] = max(per_cpu) if per_cpu else 0.0
+        row["cpu_busy_max_cpu"] = cpus[per_cpu.index(row["cpu_busy_max"])][3:] if per_cpu else ""
+        for interface in interfaces:
+            for name in ["rx_bytes", "tx_bytes", "rx_packets", "tx_packets", "rx_drop", "tx_drop"]:
+                row[f"net.{interface}.{name}/s"] = _delta(previous, current, f"net.{interface}.{name}") / seconds
+        for disk in disks:
+            # sectors are always 512 bytes in /proc/diskstats.
+            row[f"disk.{disk}.read_bytes/s"] = _delta(previous, current, f"disk.{disk}.read_sectors") * 512 / seconds
+            row[f"disk.{disk}.write_bytes/s"] = _delta(previous, current, f"disk.{disk}.write_sectors") * 512 / seconds
+            row[f"disk.{disk}.iops"] = (_delta(previous, current, f"disk.{disk}.reads") +
+                                        _delta(previous, current, f"disk.{disk}.writes")) / seconds
+            row[f"disk.{disk}.util"] = min(1.0, _delta(previous, current, f"disk.{disk}.io_ticks") / (seconds * 1000))
+        for name in softirqs:
+            row[f"softirq.{name}/s"] = sum(_delta(previous, current, field) for field in fields
+                                           if field.startswith(f"softirq.{name}.")) / seconds
+        rows.append(row)
+    return rows
+
+
+def find_saturation(rows, link_speeds, cpu_busy=0.9, single_cpu_busy=0.98, nic_utilization=0.9,
+                    min_fraction=0.1):
+    """
+    Returns the reasons (list of str) why the host was saturated in at least min_fraction of
+    the intervals: the cpus on average, a single cpu (e.g. the one handling the interrupts of
+    the NIC) or the NIC bandwidth (if the link speed is known).
+    """
+    if not rows:
+        return []
+    reasons = []
+    limit = min_fraction * len(rows)
+
+    count = sum(1 for row in rows if row["cpu_busy"] >= cpu_busy)
+    if count >= limit:
+        reasons.append(f"cpu busy >= {cpu_busy * 100:.0f}% in {count}/{len(rows)} intervals")
+
+    count = sum(1 for row in rows if row["cpu_busy_max"] >= single_cpu_busy)
+    if count >= limit:
+        cpus = sorted({row["cpu_busy_max_cpu"] for row in rows if row["cpu_busy_max"] >= single_cpu_busy})
+        reasons.append(f"single cpu busy >= {single_cpu_busy * 100:.0f}% in {count}/{len(rows)} intervals "
+                       f"(cpus {','.join(cpus)})")
+
+    for interface, speed_mbit in link_speeds.items():
+        limit_bytes = speed_mbit * 1_000_000 / 8 * nic_utilization
+        for direction in ["rx", "tx"]:
+            key = f"net.{interface}.{direction}_bytes/s"
+            count = sum(1 for row in rows if row.get(key, 0) >= limit_bytes)
+            if count >= limit:
+                reasons.append(f"{interface} {direction} >= {nic_utilization * 100:.0f}% of {speed_mbit} Mbit/s "
+                               f"in {count}/{len(rows)} intervals")
+    return reasons
+
+
+class Telemetry:
+    """
+    Collects host level metrics (cpu, softirqs, network and disk counters) every second on the
+    cluster nodes and the load generators with a small agent that writes into a binary ring
+    file, so it can run for a long time without growing. After a run the ring files are
+    downloaded and converted into a time series per host, and load generators that were
+    saturated are flagged: their numbers say more about the load generator than about the
+    cluster.
+    """
+
+    def __init__(self, properties, cluster_public_ips, load_public_ips, interval_seconds=1, capacity=7200):
+        """
+        Parameters
+        ----------
+        capacity: int
+            The number of samples kept on a host; older samples are overwritten.
+        """
+        self.properties = properties
+        self.ssh_options = properties['ssh_options']
+        # (role, user, ips)
+        self.groups = [("cluster", properties['cluster_user'], cluster_public_ips),
+                       ("loadgenerator", properties['load_generator_user'], load_public_ips)]
+        self.interval_seconds = interval_seconds
+        self.capacity = capacity
+
+    def __pssh_all(self):
+        return [PSSH(ips, user, self.ssh_options) for _, user, ips in self.groups if ips]
+
+    def start(self):
+        log_important("Telemetry start: started")
+        agent = telemetry_agent.__file__
+        command = (f"cd {REMOTE_TELEMETRY_DIR} && nohup python3 telemetry_agent.py --output {RING_FILE} "
+                   f"--interval {self.interval_seconds} --capacity {self.capacity} > telemetry.log 2>&1 < /dev/null &")
+        for pssh in self.__pssh_all():
+            pssh.exec(f"mkdir -p {REMOTE_TELEMETRY_DIR}")
+            pssh.scp_to_remote(agent, REMOTE_TELEMETRY_DIR)
+            # an agent left behind by an earlier run; the [t] prevents pkill from matching its own shell.
+            pssh.exec("pkill -f 'telemetry_agen[t].py'", ignore_errors=True)
+            pssh.exec(command)
+        log_important("Telemetry start: done")
+
+    def stop(self):
+        log_important("Telemetry stop: started")
+        for pssh in self.__pssh_all():
+            # the [t] prevents pkill from matching the shell that runs it.
+            pssh.exec("pkill -f 'telemetry_agen[t].py'", ignore_errors=True)
+        log_important("Telemetry stop: done")
+
+    def collect(self, dir, **saturation_args):
+        """
+        Downloads the ring files into dir/telemetry/<ip>/ and writes the time series per host to
+        dir/telemetry/<ip>.csv. Saturated load generators are reported and listed in
+        dir/telemetry/saturation.txt.
+
+        Parameters
+        ----------
+        saturation_args:
+            Thresholds passed to find_saturation.
+
+        Returns
+        -------
+        {ip: reasons} of the saturated load generators.
+        """
+        log_important("Telemetry collect: started")
+        telemetry_dir = os.path.join(dir, "telemetry")
+        for pssh in self.__pssh_all():
+            pssh.download(f"{REMOTE_TELEMETRY_DIR}/{RING_FILE}", telemetry_dir)
+
+        saturated = {}
+        for role, _, ips in self.groups:
+            for ip in ips:
+                ring_file = os.path.join(telemetry_dir, ip, RING_FILE)
+                if not os.path.exists(ring_file):
+                    print(f"    [{ip}] No telemetry found")
+                    continue
+                header, records = read_ring(ring_file)
+                rows = to_series(header, records)
+                self.__write_csv(os.path.join(telemetry_dir, f"{ip}.csv"), rows)
+                if role == "loadgenerator":
+                    reasons = find_saturation(rows, header['link_speeds'], **saturation_args)
+                    if reasons:
+                        saturated[ip] = reasons
+
+        with open(os.path.join(telemetry_dir, "saturation.txt"), "w") as f:
+            for ip, reasons in saturated.items():
+                for reason in reasons:
+                    print(f"{ip}: {reason}", file=f)
+        for ip, reasons in saturated.items():
+            log_important(f"Telemetry: load generator {ip} saturated")
+            for reason in reasons:
+                print(f"    [{ip}] {reason}")
+        log_important("Telemetry collect: done")
+        return saturated
+
+    def __write_csv(self, path, rows):
+        columns = []
+        for row in rows:
+            for column in row:
+                if column not in columns:
+                    columns.append(column)
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
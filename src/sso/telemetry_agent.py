@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+#
+# Samples /proc/stat, /proc/net/dev, /proc/diskstats and /proc/softirqs every interval into a
+# binary ring file. Uploaded to and run on the hosts by sso.telemetry, so it only uses the
+# standard library (python 3.6+).
+#
+# File layout (little endian):
+#   0   8 bytes  magic MAGIC
+#   8   uint32   length of the json header
+#   12  json     header: fields, capacity, record_size, interval_seconds, link_speeds
+#   ..  uint64   number of records written so far (at data_offset - 8)
+#   data_offset  capacity records of record_size: double timestamp + uint64 per field
+#
+# The record n is stored in slot n % capacity.
+
+import argparse
+import json
+import os
+import signal
+import struct
+import time
+
+MAGIC = b"SSOTELE1"
+CPU_FIELDS = ["user", "nice", "system", "idle", "iowait", "irq", "softirq", "steal"]
+NET_FIELDS = {"rx_bytes": 0, "rx_packets": 1, "rx_drop": 3, "tx_bytes": 8, "tx_packets": 9, "tx_drop": 11}
+DISK_FIELDS = {"reads": 3, "read_sectors": 5, "writes": 7, "write_sectors": 9, "io_ticks": 12}
+
+
+def read_stat():
+    values = {}
+    with open("/proc/stat") as f:
+        for line in f:
+            parts = line.split()
+            if parts and parts[0].startswith("cpu"):
+                for name, value in zip(CPU_FIELDS, parts[1:]):
+                    values[f"{parts[0]}.{name}"] = int(value)
+    return values
+
+
+def read_net():
+    values = {}
+    with open("/proc/net/dev") as f:
+        for line in f.readlines()[2:]:
+            interface, _, rest = line.partition(":")
+            interface = interface.strip()
+            if interface == "lo":
+                continue
+            parts = rest.split()
+            for name, index in NET_FIELDS.items():
+                values[f"net.{interface}.{name}"] = int(parts[index])
+    return values
+
+
+def read_disks():
+    values = {}
+    # only whole devices; partitions would count the io twice.
+    devices = set(os.listdir("/sys/block")) if os.path.isdir("/sys/block") else None
+    with open("/proc/diskstats") as f:
+        for line in f:
+            parts = line.split()
+            device = parts[2]
+            if devices is not None and device not in devices:
+                continue
+            if device.startswith("loop") or device.startswith("ram"):
+                continue
+            for name, index in DISK_FIELDS.items():
+                values[f"disk.{device}.{name}"] = int(parts[index])
+    return values
+
+
+def read_softirqs():
+    values = {}
+    with open("/proc/softirqs") as f:
+        cpus = f.readline().split()
+        for line in f:
+            parts = line.split()
+            name = parts[0].rstrip(":")
+            for cpu, value in zip(cpus, parts[1:]):
+                values[f"softirq.{name}.{cpu.lower()}"] = int(value)
+    return values
+
+
+def sample():
+    values = {}
+    values.update(read_stat())
+    values.update(read_net())
+    values.update(read_disks())
+    values.update(read_softirqs())
+    return values
+
+
+def link_speeds():
+    # Mbit/s per interface; unknown (e.g. virtual interfaces) is left out.
+    speeds = {}
+    for interface in os.listdir("/sys/class/net"):
+        try:
+            with open(f"/sys/class/net/{interface}/speed") as f:
+                speed = int(f.read().strip())
+            if speed > 0:
+                speeds[interface] = speed
+        except (OSError, ValueError):
+            pass
+    return speeds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument("--capacity", type=int, default=7200)
+    args = parser.parse_args()
+
+    fields = sorted(sample().keys())
+    record = struct.Struct(f"<d{len(fields)}Q")
+    header = json.dumps({"fields": fields, "capacity": args.capacity, "record_size": record.size,
+                         "interval_seconds": args.interval, "link_speeds": link_speeds(),
+                         "cpu_count": os.cpu_count()}).encode()
+    data_offset = (12 + len(header) + 8 + 7) // 8 * 8
+    count_offset = data_offset - 8
+
+    stopped = []
+    signal.signal(signal.SIGTERM, lambda *_: stopped.append(True))
+    fd = os.open(args.output, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.pwrite(fd, MAGIC + struct.pack("<I", len(header)) + header, 0)
+        os.pwrite(fd, struct.pack("<Q", 0), count_offset)
+        count = 0
+        next_time = time.time()
+        while not stopped:
+            values = sample()
+            # counters of devices that appeared after the start are ignored.
+            os.pwrite(fd, record.pack(time.time(), *[values.get(field, 0) for field in fields]),
+                      data_offset + (count % args.capacity) * record.size)
+            count += 1
+            os.pwrite(fd, struct.pack("<Q", count), count_offset)
+            next_time += args.interval
+            time.sleep(max(0.0, next_time - time.time()))
+    finally:
+        os.close(fd)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from threading import Thread
 from threading import Lock, Condition
@@ -33,8 +34,8 @@ class Future:
  
 class WorkerThread(Thread):
     
-    def __init__(self, target, args):
-        super().__init__(target=target, args=args)
+    def __init__(self, target, args, kwargs=None):
+        super().__init__(target=target, args=args, kwargs=kwargs)
         self.future = Future()
         
     def run(self):
@@ -47,20 +48,28 @@ class WorkerThread(Thread):
             self.future.set(e)
 
 
-def run_parallel(target, args_list, ignore_errors = False):
-    # print(f"parallel{type(args_list)}")
-    # print(args_list)
-    threads = []
-    for args in args_list:
-        # print(f"run_parallel loop |{args}|")
-        # print(f"type {type(args)}")
-        thread = WorkerThread(target, args)
-        thread.start()
-        threads.append(thread)
-    for thread in threads:
-        thread.join()
-        if not ignore_errors and thread.exception:
-            raise Exception() from thread.exception
+# The default maximum number of hosts PSSH runs a (short) command on concurrently.
+max_parallelism = 64
+
+
+def run_parallel(target, args_list, ignore_errors = False, max_workers = None):
+    """
+    Runs target for every args in args_list, by default all concurrently (one worker per task);
+    long running tasks, like a cassandra-stress per load generator, must not wait for a free
+    worker. max_workers bounds the concurrency for short tasks.
+    """
+    args_list = list(args_list)
+    if not args_list:
+        return
+    if max_workers is None:
+        max_workers = len(args_list)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(args_list))) as executor:
+        futures = [executor.submit(target, *args) for args in args_list]
+    for future in futures:
+        exception = future.exception()
+        if not ignore_errors and exception:
+            raise Exception() from exception
 
 def find_java(properties):
     path = properties.get("jvm_path")
@@ -0,0 +1,44 @@
+#!/bin/python3
+
+import sys
+import os
+
+sys.path.insert(1, f"{os.environ['SSO']}/src/")
+
+from sso import common
+from sso.abtest import ABTest, Variant
+from sso.cs import CassandraStress
+
+# Load the properties
+props = common.load_yaml('properties.yml')
+
+# Load information about the created machines.
+env = common.load_yaml('environment.yml')
+cluster_public_ips = env['cluster_public_ips']
+cluster_private_ips = env['cluster_private_ips']
+
+# Setup cassandra stress
+cs = CassandraStress(env['loadgenerator_public_ips'], props)
+cs.install()
+cs.prepare()
+cs.upload("stress_example.yaml")
+
+# Total number of items.
+items = 1_000_000
+
+# The configurations to compare. The setup functions put the cluster in the configuration,
+# e.g. install a Scylla version; here both variants use the cluster as it is.
+baseline = Variant("baseline", cluster_public_ips, cluster_private_ips, setup=None)
+candidate = Variant("candidate", cluster_public_ips, cluster_private_ips, setup=None)
+
+test = ABTest("ab-test", cs, props, baseline, candidate,
+              f'user profile=./stress_example.yaml "ops(insert=1)" duration=2m -pop seq=1..{items} '
+              f'-log hdrfile=profile.hdr -mode native cql3 -rate threads=200 -node {{nodes}}',
+              trials=5,
+              populate=lambda variant, nodes: cs.insert("stress_example.yaml", items, nodes),
+              warmup_seconds=20,
+              threshold_percent=2.0)
+
+# Exits with a non zero exit code when the candidate is significantly worse.
+regressions = test.run()
+exit(1 if regressions else 0)
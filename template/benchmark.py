@@ -11,6 +11,7 @@ from sso import terraform
 from sso.cs import CassandraStress
 from sso.common import Iteration
 from sso import prometheus
+from sso import scylla
 
 # Load the properties
 props = common.load_yaml('properties.yml')
@@ -43,6 +44,9 @@ cs.upload("stress_example.yaml")
 
 # Insert the test data.
 cs.insert("stress_example.yaml", items, cluster_string)
+
+# Wait until the compactions caused by the insert are done.
+scylla.wait_for_compactions(env['cluster_public_ips'], props['cluster_user'], props['ssh_options'], dir=iteration.dir)
  
 # Actual benchmark
 cs.stress(f'user profile=./stress_example.yaml "ops(insert=1)" duration={duration} -pop seq=1..{items} -log hdrfile=profile.hdr -graph file=report.html title=benchmark revision=benchmark-0 -mode native cql3 -rate threads={threads} -node {cluster_string}')  
@@ -50,8 +54,11 @@ cs.stress(f'user profile=./stress_example.yaml "ops(insert=1)" duration={duratio
 # collect the results.
 cs.collect_results(iteration.dir)
 
-# Download and clear the prometheus data (can take a lot of time/space)
-prometheus.download_and_clear(env, props, iteration)
+# Extract the metrics of this iteration from prometheus.
+prometheus.extract(env, props, iteration)
+
+# Or download and clear the prometheus data (can take a lot of time/space)
+#prometheus.download_and_clear(env, props, iteration)
 
 # Automatically terminates the cluster.
 #terraform.destroy(props['terraform_plan'])
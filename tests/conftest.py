@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts in bin/ add src/ to the path in the same way.
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
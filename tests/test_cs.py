@@ -0,0 +1,50 @@
+import pytest
+
+from sso.cs import _split, _split_weighted
+
+
+@pytest.mark.parametrize("total,parts", [(10, 3), (9, 3), (2, 5), (0, 4), (1, 1), (10 ** 18 + 7, 6)])
+def test_split(total, parts):
+    result = _split(total, parts)
+    assert len(result) == parts
+    assert sum(result) == total
+    assert max(result) - min(result) <= 1
+
+
+def test_split_first_parts_get_the_remainder():
+    assert _split(10, 3) == [4, 3, 3]
+    assert _split(2, 5) == [1, 1, 0, 0, 0]
+
+
+@pytest.mark.parametrize("total,weights", [
+    (100, [1, 1, 1]),
+    (100, [1, 2, 3]),
+    (1000, [0.3, 1234.5, 77.7, 1e-9]),
+    (100, [5, 0, 5]),
+    (7, [1e-300, 1e300]),
+    (2, [1, 1, 1, 1, 1]),
+    (0, [1, 2]),
+    (986500832984747723, [6032.292298193686, 3, 7, 0, 3, 3]),
+])
+def test_split_weighted_sums_to_total(total, weights):
+    result = _split_weighted(total, weights)
+    assert len(result) == len(weights)
+    assert sum(result) == total
+    assert min(result) >= 0
+    weight_sum = sum(weights)
+    for part, weight in zip(result, weights):
+        assert abs(part - total * weight / weight_sum) < 1 + total * 1e-12
+        if weight == 0:
+            assert part == 0
+
+
+def test_split_weighted_proportional():
+    assert _split_weighted(100, [1, 3]) == [25, 75]
+    # the remainder goes to the largest fractions.
+    assert _split_weighted(10, [1, 1, 1]) == [4, 3, 3]
+    assert _split_weighted(10, [1, 2, 2]) == [2, 4, 4]
+    assert _split_weighted(1, [1, 2]) == [0, 1]
+
+
+def test_split_weighted_without_weight():
+    assert _split_weighted(10, [0, 0, 0]) == [4, 3, 3]
@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+from sso.hdr import _trim_range
+
+STRESS_HDR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cassandra-stress.hdr")
+
+
+def test_trim_range():
+    # the intervals start at 0.113, 1.113, ... 9.113 seconds after the start time.
+    start, end = _trim_range(STRESS_HDR, 2, 3)
+    assert start == pytest.approx(2.113 - 0.0005)
+    assert end == pytest.approx(6.113 + 0.0005)
+
+
+def test_trim_range_without_trimming():
+    start, end = _trim_range(STRESS_HDR, None, None)
+    assert start == pytest.approx(0.113 - 0.0005)
+    assert end == pytest.approx(9.113 + 0.0005)
+
+
+def test_trim_range_empty(tmp_path):
+    assert _trim_range(STRESS_HDR, 20, None) == (0.0, -1.0)
+    empty = tmp_path / "empty.hdr"
+    empty.write_text("#[StartTime: 1600000000.000 (seconds since epoch)]\n")
+    assert _trim_range(str(empty), 2, 3) == (None, None)
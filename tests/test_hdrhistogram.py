@@ -0,0 +1,234 @@
+import io
+import os
+import struct
+
+import pytest
+
+from sso import hdrhistogram
+from sso.hdrhistogram import Histogram, HistogramLog, Interval, LogParser
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+STRESS_HDR = os.path.join(DATA_DIR, "cassandra-stress.hdr")
+
+requires_numpy = pytest.mark.skipif(not hdrhistogram.has_numpy(), reason="requires numpy")
+
+
+def test_encode_zigzag_leb128():
+    out = bytearray()
+    hdrhistogram._encode_zigzag_leb128([0, -1, 1, 63, -64, 64, 300, -300], out)
+    assert bytes(out) == bytes([0x00, 0x01, 0x02, 0x7e, 0x7f, 0x80, 0x01, 0xd8, 0x04, 0xd7, 0x04])
+
+
+@requires_numpy
+@pytest.mark.parametrize("values", [
+    [],
+    [0, -1, 1, 63, -64, 64, 300, -300],
+    [5, -2 ** 40, 2 ** 55],
+    # the 9th byte of a LEB128 value carries 8 bits.
+    [2 ** 62, 1, -(2 ** 62)],
+])
+def test_zigzag_leb128_roundtrip(values):
+    hdrhistogram._import_numpy()
+    out = bytearray()
+    hdrhistogram._encode_zigzag_leb128(values, out)
+    assert hdrhistogram._decode_zigzag_leb128(bytes(out)).tolist() == values
+    assert hdrhistogram._decode_zigzag_leb128_slow(bytes(out)).tolist() == values
+
+
+@requires_numpy
+def test_histogram_roundtrip():
+    histogram = Histogram.create()
+    for value in [1, 2, 2, 1000, 1001, 123456, 10 ** 9, 10 ** 12]:
+        histogram.record(value)
+    histogram.record(5000, count=7)
+
+    data = histogram.encode()
+    cookie, length = struct.unpack_from(">ii", data, 0)
+    assert cookie == hdrhistogram.V2_COMPRESSED_ENCODING_COOKIE | 0x10
+    assert length == len(data) - 8
+    encoded = histogram.encode_base64()
+    # the prefix of every compressed V2 histogram in a log.
+    assert encoded.startswith("HISTF")
+
+    decoded = Histogram.decode_base64(encoded)
+    assert decoded.layout is histogram.layout
+    assert decoded.counts.tolist() == histogram.counts.tolist()
+    assert decoded.total_count() == 15
+
+
+@requires_numpy
+def test_decode_rejects_unknown_cookie():
+    with pytest.raises(ValueError):
+        Histogram.decode(struct.pack(">ii", 0x12345678, 0) + bytes(32))
+
+
+@requires_numpy
+def test_percentiles():
+    # the reference values of the HdrHistogram test suite.
+    histogram = Histogram.create(1, 3600 * 1000 * 1000, 3)
+    histogram.record(1000, count=10000)
+    histogram.record(100000000)
+
+    assert histogram.total_count() == 10001
+    assert histogram.value_at_percentile(30.0) == pytest.approx(1000, rel=0.001)
+    assert histogram.value_at_percentile(99.0) == pytest.approx(1000, rel=0.001)
+    assert histogram.value_at_percentile(99.99) == pytest.approx(1000, rel=0.001)
+    assert histogram.value_at_percentile(99.999) == pytest.approx(100000000, rel=0.001)
+    assert histogram.value_at_percentile(100.0) == pytest.approx(100000000, rel=0.001)
+    assert histogram.max() == pytest.approx(100000000, rel=0.001)
+    assert histogram.mean() == pytest.approx((1000.0 * 10000 + 100000000.0) / 10001, rel=0.001)
+
+
+@requires_numpy
+def test_percentiles_are_equivalent_values():
+    histogram = Histogram.create()
+    for value in range(1, 10001):
+        histogram.record(value)
+
+    assert histogram.min() == 1
+    # with 3 significant digits, the values 4096-8191 are tracked in steps of 4 and the
+    # values 8192-16383 in steps of 8; a percentile is the highest equivalent value.
+    assert histogram.value_at_percentile(50.0) == 5003
+    assert histogram.value_at_percentile(99.0) == 9903
+    assert histogram.value_at_percentile(0.0) == 1
+    assert histogram.max() == 10007
+
+
+def test_log_parser_relative_to_start_time():
+    parser = LogParser()
+    assert parser.parse("#[Histogram log format version 1.3]") is None
+    assert parser.parse("#[StartTime: 1600000000.000 (seconds since epoch), Sun Sep 13 12:26:40 UTC 2020]") is None
+    assert parser.parse(hdrhistogram.LOG_LEGEND) is None
+    assert parser.parse("") is None
+
+    interval = parser.parse("Tag=WRITE-rt,1.500,1.000,2.419,HISTFAAA")
+    assert interval.tag == "WRITE-rt"
+    assert interval.start == pytest.approx(1600000001.5)
+    assert interval.end == pytest.approx(1600000002.5)
+    assert interval.max == pytest.approx(2.419)
+    assert interval.encoded == "HISTFAAA"
+
+
+def test_log_parser_base_time():
+    parser = LogParser()
+    parser.parse("#[BaseTime: 1600000000.000 (seconds since epoch)]")
+    parser.parse("#[StartTime: 1600000005.000 (seconds since epoch), Sun Sep 13 12:26:45 UTC 2020]")
+    interval = parser.parse("1.500,1.000,2.000,HISTFAAA")
+    assert interval.tag is None
+    assert interval.start == pytest.approx(1600000001.5)
+
+
+def test_log_parser_absolute_timestamps():
+    parser = LogParser()
+    parser.parse("#[StartTime: 1600000000.000 (seconds since epoch), Sun Sep 13 12:26:40 UTC 2020]")
+    interval = parser.parse("1600000001.500,1.000,2.000,HISTFAAA")
+    assert interval.start == pytest.approx(1600000001.5)
+
+    interval = LogParser().parse("Tag=READ,1600000001.500,1.000,2.000,HISTFAAA")
+    assert interval.start == pytest.approx(1600000001.5)
+
+
+def test_log_parser_partial_line():
+    parser = LogParser()
+    assert parser.parse("Tag=WRITE-rt,1.500,1.0") is None
+
+
+def _log():
+    intervals = []
+    for second in range(10):
+        for tag in ["A", "B"]:
+            intervals.append(Interval(tag, 100.0 + second, 1.0, 1.0, encoded="HISTFAAA"))
+    return HistogramLog(100.0, intervals)
+
+
+def test_trim():
+    log = _log()
+    assert log.time_range() == (100.0, 110.0)
+
+    trimmed = log.trim(2, 3)
+    assert trimmed.start_time == 100.0
+    assert sorted({i.start for i in trimmed.intervals}) == [102.0, 103.0, 104.0, 105.0, 106.0]
+    assert len(trimmed.intervals) == 10
+
+    assert len(log.trim().intervals) == 20
+    assert log.trim(20).intervals == []
+    assert HistogramLog(100.0).trim(2, 3).intervals == []
+
+
+def test_trim_tolerates_rounding():
+    log = HistogramLog(100.0, [Interval(None, 100.0 + s + 0.0004, 0.999, 1.0) for s in range(5)])
+    assert len(log.trim(1, 1).intervals) == 3
+
+
+def test_split_by_tag():
+    logs = _log().split_by_tag()
+    assert sorted(logs) == ["A", "B"]
+    for tag, log in logs.items():
+        assert log.start_time == 100.0
+        assert len(log.intervals) == 10
+        assert all(i.tag == tag for i in log.intervals)
+
+
+def test_read_log():
+    log = hdrhistogram.read_log(STRESS_HDR)
+    assert log.start_time == 1600000000.0
+    assert log.tags() == ["WRITE-rt", "WRITE-st"]
+    assert len(log.intervals) == 20
+    begin, end = log.time_range()
+    assert begin == pytest.approx(1600000000.113)
+    assert end == pytest.approx(1600000010.113)
+
+
+@requires_numpy
+def test_read_log_histograms():
+    log = hdrhistogram.read_log(STRESS_HDR)
+    assert log.total("WRITE-rt").total_count() == 2450
+    for interval in log.intervals:
+        assert interval.histogram().max() / hdrhistogram.DEFAULT_VALUE_UNIT_RATIO == pytest.approx(interval.max, abs=0.0005)
+
+
+@requires_numpy
+def test_write_summary():
+    # the layout of 'processor.jar summarize'.
+    out = io.StringIO()
+    hdrhistogram.write_summary(out, hdrhistogram.read_log(STRESS_HDR))
+    with open(os.path.join(DATA_DIR, "cassandra-stress-summary.txt")) as f:
+        assert out.getvalue() == f.read()
+
+
+@requires_numpy
+def test_write_summary_untagged():
+    histogram = Histogram.create()
+    histogram.record(1500000, count=3)
+    log = HistogramLog(100.0, [Interval(None, 100.0, 2.0, 1.5, histogram=histogram)])
+    out = io.StringIO()
+    hdrhistogram.write_summary(out, log, value_unit_ratio=1000.0)
+    assert out.getvalue().splitlines()[:6] == [
+        "TotalCount=3",
+        "Period(ms)=2000",
+        "Throughput(ops/sec)=1.50",
+        "Min=1499",
+        "Mean=1499.65",
+        "StdDev=0.00",
+    ]
+
+
+def test_java_format():
+    assert hdrhistogram._java_format_2f(0.125) == "0.13"
+    assert hdrhistogram._java_format_2f(245.0) == "245.00"
+    assert hdrhistogram._java_format_2f(float("inf")) == "Infinity"
+    assert hdrhistogram._java_format_2f(float("nan")) == "NaN"
+
+
+@requires_numpy
+def test_union():
+    first = Histogram.create()
+    first.record(1000)
+    second = Histogram.create()
+    second.record(2000, count=2)
+    logs = [HistogramLog(100.0, [Interval("A", 100.0, 1.0, 0.0, histogram=first)]),
+            HistogramLog(100.2, [Interval("A", 100.2, 1.0, 0.0, histogram=second)])]
+    merged = hdrhistogram.union(logs, interval_seconds=1.0)
+    assert len(merged.intervals) == 1
+    assert merged.intervals[0].start == 100.0
+    assert merged.total("A").total_count() == 3
@@ -0,0 +1,51 @@
+import os
+from threading import Event
+from types import SimpleNamespace
+
+import pytest
+
+from sso import hdrhistogram, hdrstream
+from sso.hdrstream import HdrStream
+
+pytestmark = pytest.mark.skipif(not hdrhistogram.has_numpy(), reason="requires numpy")
+
+
+def _stream(ips, start, seconds, count):
+    # feeds the lines of a hdr log to the stream, as if they were tailed from the load generators.
+    hdr_stream = HdrStream(ips, "root", "", "cs.hdr", print_intervals=False)
+    hdr_stream.base_time = start
+    for ip in ips:
+        lines = [hdrstream.ARMED_MARKER + "\n",
+                 f"#[StartTime: {start:.3f} (seconds since epoch), Sun Sep 13 12:26:40 UTC 2020]\n",
+                 hdrhistogram.LOG_LEGEND + "\n"]
+        for second in range(seconds):
+            histogram = hdrhistogram.Histogram.create()
+            histogram.record(1000000, count=count)
+            lines.append(f"Tag=WRITE-rt,{second:.3f},1.000,1.000,{histogram.encode_base64()}\n")
+        hdr_stream._HdrStream__tail(ip, SimpleNamespace(stdout=lines), Event())
+    return hdr_stream
+
+
+def test_write_all_single_stream(tmp_path):
+    hdrstream.write_all([_stream(["10.0.0.1", "10.0.0.2"], 1600000000.0, 3, 10)], str(tmp_path))
+
+    for ip in ["10.0.0.1", "10.0.0.2"]:
+        assert hdrhistogram.read_log(os.path.join(tmp_path, ip, "cs.hdr")).total("WRITE-rt").total_count() == 30
+    assert hdrhistogram.read_log(os.path.join(tmp_path, "cs.hdr")).total("WRITE-rt").total_count() == 60
+
+
+def test_write_all_combines_streams_of_the_same_file(tmp_path):
+    first = _stream(["10.0.0.1", "10.0.0.2"], 1600000000.0, 3, 10)
+    second = _stream(["10.0.0.1"], 1600000100.0, 2, 5)
+    hdrstream.write_all([first, second], str(tmp_path))
+
+    log = hdrhistogram.read_log(os.path.join(tmp_path, "10.0.0.1", "cs.hdr"))
+    assert len(log.intervals) == 5
+    assert log.total("WRITE-rt").total_count() == 40
+    assert log.time_range() == pytest.approx((1600000000.0, 1600000102.0))
+    assert hdrhistogram.read_log(os.path.join(tmp_path, "10.0.0.2", "cs.hdr")).total("WRITE-rt").total_count() == 30
+
+    merged = hdrhistogram.read_log(os.path.join(tmp_path, "cs.hdr"))
+    assert merged.total("WRITE-rt").total_count() == 70
+    assert os.path.getmtime(os.path.join(tmp_path, "cs.hdr")) >= \
+        os.path.getmtime(os.path.join(tmp_path, "10.0.0.1", "cs.hdr"))
@@ -0,0 +1,62 @@
+import os
+
+from sso.scylla import _parse_compactionstats, _parse_probe
+
+NODETOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "nodetool")
+
+
+def _read(name):
+    with open(os.path.join(NODETOOL_DIR, name)) as f:
+        return f.read()
+
+
+def _probe_output(cql_listening, status, describecluster=""):
+    # the layout of scylla._PROBE_COMMAND.
+    return f"cql_listening={cql_listening}\n---status\n{status}---describecluster\n{describecluster}"
+
+
+def test_parse_probe():
+    listening, states, versions, status = _parse_probe(
+        _probe_output(1, _read("status.txt"), _read("describecluster.txt")))
+    assert listening
+    assert states == {"10.0.0.1": "UN", "10.0.0.2": "UN", "10.0.0.3": "UJ"}
+    assert versions == ["3c3e1bc8-4b0f-36a8-8b2e-0a3f3c2e7a3b"]
+    assert status.startswith("Datacenter: datacenter1")
+
+
+def test_parse_probe_schema_disagreement():
+    _, _, versions, _ = _parse_probe(_probe_output(1, _read("status.txt"), _read("describecluster-disagreement.txt")))
+    assert versions == ["3c3e1bc8-4b0f-36a8-8b2e-0a3f3c2e7a3b", "59adb24e-f3cd-3e02-97f0-5b395827453f", "UNREACHABLE"]
+
+
+def test_parse_probe_not_listening():
+    listening, states, versions, status = _parse_probe(_probe_output(0, _read("status-connection-refused.txt")))
+    assert not listening
+    assert states == {}
+    assert versions == []
+    assert "Connection refused" in status
+
+
+def test_parse_probe_empty():
+    assert _parse_probe("") == (False, {}, [], "")
+    listening, states, _, _ = _parse_probe(_probe_output("", ""))
+    assert not listening
+    assert states == {}
+
+
+def test_parse_compactionstats():
+    assert _parse_compactionstats(_read("compactionstats.txt")) == (3, 2)
+
+
+def test_parse_compactionstats_idle():
+    assert _parse_compactionstats(_read("compactionstats-idle.txt")) == (0, 0)
+
+
+def test_parse_compactionstats_pending_not_available():
+    assert _parse_compactionstats(_read("compactionstats-na.txt")) == (0, 1)
+    assert _parse_compactionstats("pending tasks: n/a\n") == (0, 0)
+
+
+def test_parse_compactionstats_unparsable():
+    assert _parse_compactionstats("") is None
+    assert _parse_compactionstats(_read("status-connection-refused.txt")) is None
@@ -0,0 +1,109 @@
+import math
+
+import pytest
+
+from sso import stats
+from sso.results import _block_means
+
+# the samples of the examples of Welch's t-test on Wikipedia.
+A1 = [27.5, 21.0, 19.0, 23.6, 17.0, 17.9, 16.9, 20.1, 21.9, 22.6, 23.1, 19.6, 19.0, 21.7, 21.4]
+A2 = [27.1, 22.0, 20.8, 23.4, 23.4, 23.5, 25.8, 22.0, 24.8, 20.2, 21.9, 22.1, 22.9, 20.5, 24.4]
+B1 = [17.2, 20.9, 22.6, 18.1, 21.7, 21.4, 23.5, 24.2, 14.7, 21.8]
+B2 = [21.5, 22.8, 21.0, 23.0, 21.6, 23.6, 22.5, 20.7, 23.4, 21.8,
+      20.7, 21.7, 21.5, 22.5, 23.6, 21.5, 22.5, 23.5, 21.5, 21.8]
+
+
+def test_mean_and_variance():
+    assert stats.mean([1, 2, 3, 4]) == 2.5
+    assert stats.variance([1, 2, 3, 4]) == pytest.approx(5 / 3)
+    assert stats.variance([42]) == 0.0
+
+
+def test_betainc():
+    # for integer a and b, I_x(a, b) is a binomial tail: P(X >= a), X ~ B(a + b - 1, x).
+    assert stats.betainc(2, 3, 0.4) == pytest.approx(0.5248, abs=1e-12)
+    assert stats.betainc(0.5, 0.5, 0.5) == pytest.approx(0.5, abs=1e-12)
+    assert stats.betainc(1, 1, 0.3) == pytest.approx(0.3, abs=1e-12)
+    assert stats.betainc(2, 3, 0.0) == 0.0
+    assert stats.betainc(2, 3, 1.0) == 1.0
+
+
+def test_student_t_cdf():
+    assert stats.student_t_cdf(0.0, 7) == pytest.approx(0.5)
+    assert stats.student_t_cdf(2.0, 5) == pytest.approx(0.949030260585071, abs=1e-9)
+    assert stats.student_t_cdf(-2.0, 5) == pytest.approx(1 - 0.949030260585071, abs=1e-9)
+    # with 1 degree of freedom, the Cauchy distribution.
+    assert stats.student_t_cdf(1.0, 1) == pytest.approx(0.75, abs=1e-12)
+    assert stats.student_t_cdf(math.inf, 3) == 1.0
+
+
+@pytest.mark.parametrize("p,df,expected", [
+    (0.975, 10, 2.228138852),
+    (0.975, 1, 12.70620474),
+    (0.95, 30, 1.697260887),
+    (0.995, 4, 4.604094871),
+    (0.5, 12, 0.0),
+])
+def test_student_t_ppf(p, df, expected):
+    assert stats.student_t_ppf(p, df) == pytest.approx(expected, abs=1e-6)
+
+
+def test_welch_t_test():
+    t, df, p = stats.welch_t_test(A1, A2)
+    assert t == pytest.approx(2.46, abs=0.005)
+    assert df == pytest.approx(24.99, abs=0.005)
+    assert p == pytest.approx(0.021, abs=0.0005)
+
+    t, df, p = stats.welch_t_test(B1, B2)
+    assert t == pytest.approx(1.57, abs=0.005)
+    assert df == pytest.approx(9.90, abs=0.005)
+    assert p == pytest.approx(0.149, abs=0.0005)
+
+    # the sign follows mean(b) - mean(a).
+    t, _, _ = stats.welch_t_test(A2, A1)
+    assert t == pytest.approx(-2.46, abs=0.005)
+
+
+def test_welch_t_test_without_variance():
+    assert stats.welch_t_test([1, 1], [1, 1]) == (0.0, math.inf, 1.0)
+    t, df, p = stats.welch_t_test([1, 1], [2, 2])
+    assert (t, df, p) == (math.inf, math.inf, 0.0)
+
+
+def test_confidence_interval():
+    m, half_width = stats.confidence_interval([1, 2, 3, 4, 5])
+    assert m == 3.0
+    # t(0.975, 4) * sqrt(2.5 / 5)
+    assert half_width == pytest.approx(2.776445105 * math.sqrt(0.5), abs=1e-6)
+    assert stats.confidence_interval([1]) == (1, math.inf)
+
+
+def test_difference_confidence_interval():
+    difference, half_width = stats.difference_confidence_interval(A1, A2)
+    assert difference == pytest.approx(stats.mean(A2) - stats.mean(A1))
+    # the interval excludes 0 exactly when the t-test is significant at 0.05.
+    assert 0 < difference - half_width
+    difference, half_width = stats.difference_confidence_interval(B1, B2)
+    assert difference - half_width < 0
+
+
+def test_block_means():
+    starts = [1000.0 + i for i in range(120)]
+    values = [10.0 * (i // 30) + (i % 2) for i in range(120)]
+    assert _block_means(starts, values, 30) == pytest.approx([0.5, 10.5, 20.5, 30.5])
+
+
+def test_block_means_drops_short_trailing_block():
+    starts = [float(i) for i in range(100)]
+    values = [1.0] * 100
+    # the last block only covers 10 of the 30 seconds.
+    assert _block_means(starts, values, 30) == [1.0, 1.0, 1.0]
+    # but more than half.
+    assert len(_block_means([float(i) for i in range(110)], [1.0] * 110, 30)) == 4
+
+
+def test_block_means_with_longer_intervals():
+    starts = [5.0 * i for i in range(24)]
+    values = [float(i // 6) for i in range(24)]
+    assert _block_means(starts, values, 30) == [0.0, 1.0, 2.0, 3.0]
+    assert _block_means([], [], 30) == []
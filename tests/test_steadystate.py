@@ -0,0 +1,117 @@
+import random
+
+import pytest
+
+from sso import hdrhistogram, steadystate
+from sso.steadystate import _noise, change_points
+
+START = 1600000000.0
+
+requires_numpy = pytest.mark.skipif(not hdrhistogram.has_numpy(), reason="requires numpy")
+
+
+def _scaled(series):
+    return [x / _noise(series) for x in series]
+
+
+def _series(levels, seed=1):
+    # a noisy series with the given (level, length) segments.
+    rng = random.Random(seed)
+    return [level + rng.gauss(0, 1) for level, length in levels for _ in range(length)]
+
+
+def test_change_points():
+    series = _series([(0, 30), (20, 50), (5, 20)])
+    assert change_points([_scaled(series)]) == [30, 80]
+
+
+def test_change_points_of_a_constant_series():
+    assert change_points([[7.0] * 100]) == []
+    assert change_points([_scaled(_series([(10, 100)]))]) == []
+
+
+def test_change_points_of_a_short_series():
+    # a split needs min_size intervals on both sides.
+    series = _scaled([0.0] * 5 + [100.0] * 4)
+    assert change_points([series], min_size=5) == []
+    assert change_points([series], min_size=4) == [5]
+    assert change_points([[]]) == []
+
+
+def _log(ops, p99_ms, tags=("WRITE-rt", "WRITE-st")):
+    # one interval per second per tag; the -st intervals have a much lower latency and must be ignored.
+    intervals = []
+    for second, (count, p99) in enumerate(zip(ops, p99_ms)):
+        for tag in tags:
+            histogram = hdrhistogram.Histogram.create()
+            value = int(p99 * hdrhistogram.DEFAULT_VALUE_UNIT_RATIO)
+            if tag.endswith("-st"):
+                value //= 100
+            histogram.record(value, count=int(count))
+            intervals.append(hdrhistogram.Interval(tag, START + second, 1.0, value, histogram=histogram))
+    return hdrhistogram.HistogramLog(START, intervals)
+
+
+def _warmup_steady_cooldown():
+    rng = random.Random(7)
+    # 30 seconds of ramp up, 140 seconds of steady state and 10 seconds of cooldown.
+    ops = [1000 + 300 * second + rng.gauss(0, 50) for second in range(30)] \
+        + [10000 + rng.gauss(0, 100) for _ in range(140)] \
+        + [3000 + rng.gauss(0, 100) for _ in range(10)]
+    p99 = [20 - 0.5 * second + rng.gauss(0, 0.2) for second in range(30)] \
+        + [5 + rng.gauss(0, 0.2) for _ in range(140)] \
+        + [2 + rng.gauss(0, 0.1) for _ in range(10)]
+    return ops, p99
+
+
+@requires_numpy
+def test_interval_series():
+    starts, ends, ops, p99 = steadystate.interval_series(_log([1000, 2000], [5, 10]))
+    assert starts == [START, START + 1]
+    assert ends == [START + 1, START + 2]
+    assert ops == [1000, 2000]
+    assert p99 == pytest.approx([5, 10], rel=1e-3)
+
+
+@requires_numpy
+def test_detect():
+    result = steadystate.detect(_log(*_warmup_steady_cooldown()))
+    # the end of the ramp up is only found to within min_size intervals.
+    assert 27 <= result["warmup_seconds"] <= 32
+    assert result["cooldown_seconds"] == 10
+    assert result["begin"] == START + result["warmup_seconds"]
+    assert result["end"] == START + 170
+    assert result["intervals"] == 170 - result["warmup_seconds"]
+    assert START + 170 in result["change_points"]
+    assert all(point <= result["begin"] for point in result["change_points"][:-1])
+
+
+@requires_numpy
+def test_detect_constant_load():
+    result = steadystate.detect(_log([5000] * 60, [3] * 60))
+    assert result["change_points"] == []
+    assert result["warmup_seconds"] == 0
+    assert result["cooldown_seconds"] == 0
+    assert result["intervals"] == 60
+
+
+@requires_numpy
+def test_detect_short_log():
+    # too short to split: the whole log is the steady state.
+    result = steadystate.detect(_log([100, 5000, 5000, 5000, 100], [50, 3, 3, 3, 50]))
+    assert result["change_points"] == []
+    assert (result["begin"], result["end"]) == (START, START + 5)
+
+
+@requires_numpy
+def test_detect_keeps_a_disturbance():
+    # a stall in the middle of the steady state (e.g. a compaction) doesn't trim the log.
+    ops = [5000] * 50 + [4000] * 10 + [5000] * 50
+    p99 = [3] * 50 + [3.2] * 10 + [3] * 50
+    result = steadystate.detect(_log(ops, p99))
+    assert (result["warmup_seconds"], result["cooldown_seconds"]) == (0, 0)
+    assert result["intervals"] == 110
+
+
+def test_detect_empty_log():
+    assert steadystate.detect(hdrhistogram.HistogramLog(START)) is None
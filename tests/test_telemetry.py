@@ -0,0 +1,100 @@
+import json
+import struct
+
+import pytest
+
+from sso import telemetry, telemetry_agent
+
+
+def _counters(n):
+    counters = {name: 0 for cpu in ["cpu", "cpu0", "cpu1"] for name in
+                [f"{cpu}.{field}" for field in telemetry_agent.CPU_FIELDS]}
+    counters.update({
+        "cpu.user": 50 * n, "cpu.idle": 50 * n,
+        "cpu0.user": 99 * n, "cpu0.idle": n,
+        "cpu1.user": n, "cpu1.idle": 99 * n,
+        # 1 Gbit/s received; the transmitted bytes grow quadratically, so the order matters.
+        "net.eth0.rx_bytes": 125_000_000 * n, "net.eth0.tx_bytes": n * n,
+        "disk.sda.read_sectors": 2 * n, "disk.sda.write_sectors": 0,
+        "disk.sda.reads": n, "disk.sda.writes": n, "disk.sda.io_ticks": 500 * n,
+        "softirq.NET_RX.cpu0": 10 * n, "softirq.NET_RX.cpu1": 5 * n,
+    })
+    return counters
+
+
+def _write_ring(path, count, capacity):
+    # the same layout as telemetry_agent.main writes.
+    fields = sorted(_counters(0).keys())
+    record = struct.Struct(f"<d{len(fields)}Q")
+    header = json.dumps({"fields": fields, "capacity": capacity, "record_size": record.size,
+                         "interval_seconds": 1.0, "link_speeds": {"eth0": 1000}, "cpu_count": 2}).encode()
+    data_offset = (12 + len(header) + 8 + 7) // 8 * 8
+    data = bytearray(data_offset + capacity * record.size)
+    data[0:12 + len(header)] = telemetry_agent.MAGIC + struct.pack("<I", len(header)) + header
+    for n in range(count):
+        counters = _counters(n)
+        record.pack_into(data, data_offset + (n % capacity) * record.size, 1000.0 + n,
+                         *[counters[field] for field in fields])
+    struct.pack_into("<Q", data, data_offset - 8, count)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_read_wrapped_ring(tmp_path):
+    path = tmp_path / "telemetry.ring"
+    _write_ring(path, count=13, capacity=5)
+
+    header, records = telemetry.read_ring(path)
+    assert header["capacity"] == 5
+    assert header["link_speeds"] == {"eth0": 1000}
+    # the last capacity records, oldest first.
+    assert [timestamp for timestamp, _ in records] == [1008.0, 1009.0, 1010.0, 1011.0, 1012.0]
+    assert [counters["net.eth0.tx_bytes"] for _, counters in records] == [64, 81, 100, 121, 144]
+
+
+def test_read_partial_ring(tmp_path):
+    path = tmp_path / "telemetry.ring"
+    _write_ring(path, count=3, capacity=5)
+    _, records = telemetry.read_ring(path)
+    assert [timestamp for timestamp, _ in records] == [1000.0, 1001.0, 1002.0]
+
+
+def test_read_ring_rejects_other_files(tmp_path):
+    path = tmp_path / "other"
+    path.write_bytes(b"not a ring file")
+    with pytest.raises(Exception):
+        telemetry.read_ring(path)
+
+
+def test_to_series(tmp_path):
+    path = tmp_path / "telemetry.ring"
+    _write_ring(path, count=13, capacity=5)
+    rows = telemetry.to_series(*telemetry.read_ring(path))
+
+    assert [row["time"] for row in rows] == [1009.0, 1010.0, 1011.0, 1012.0]
+    for row in rows:
+        assert row["cpu_busy"] == pytest.approx(0.5)
+        assert row["cpu_busy_max"] == pytest.approx(0.99)
+        assert row["cpu_busy_max_cpu"] == "0"
+        assert row["net.eth0.rx_bytes/s"] == pytest.approx(125_000_000)
+        assert row["disk.sda.read_bytes/s"] == pytest.approx(1024)
+        assert row["disk.sda.iops"] == pytest.approx(2)
+        assert row["disk.sda.util"] == pytest.approx(0.5)
+        assert row["softirq.NET_RX/s"] == pytest.approx(15)
+    # n * n - (n - 1) * (n - 1)
+    assert [row["net.eth0.tx_bytes/s"] for row in rows] == [17, 19, 21, 23]
+
+
+def test_find_saturation(tmp_path):
+    path = tmp_path / "telemetry.ring"
+    _write_ring(path, count=13, capacity=5)
+    header, records = telemetry.read_ring(path)
+    rows = telemetry.to_series(header, records)
+
+    reasons = telemetry.find_saturation(rows, header["link_speeds"])
+    assert len(reasons) == 2
+    assert reasons[0].startswith("single cpu busy >= 98% in 4/4 intervals (cpus 0)")
+    assert reasons[1].startswith("eth0 rx >= 90% of 1000 Mbit/s in 4/4 intervals")
+
+    assert telemetry.find_saturation(rows, {"eth0": 10000}, single_cpu_busy=1.0) == []
+    assert telemetry.find_saturation([], {"eth0": 1000}) == []